@@ -22,13 +22,22 @@
 Output file is 'program.hex', which contains the hexadecimal encoded
 instruction memory, starting at address 0. Each entry in the hex file
 is a 16 bit value value, separated with a newline.
+
+This can also be imported and used from other python programs:
+
+    program = compile.compile_program(sources=['($printstr "hello")'])
+    program.instructions    # List of instruction words
+    program.write_files()   # Create program.hex and program.lst
 """
 
+import argparse
 import copy
+import hashlib
+import io
 import math
 import os
+import pickle
 import re
-import shlex
 import sys
 
 # 2 bits associated with each data memory location, stored in hardware
@@ -38,6 +47,11 @@ TAG_CONS = 1
 TAG_FUNCTION = 2
 TAG_CLOSURE = 3
 
+# Tag of the first word of a vector ($vector-header-tag in runtime.lisp).
+# Vectors are pointed to by values tagged TAG_CONS, with the address of their
+# first element.
+TAG_VECTOR_HEADER = 6
+
 # Upper 5 bits in each instruction that indicates the operation.
 OP_NOP = 0
 OP_CALL = 1
@@ -69,9 +83,16 @@ OP_GETLOCAL = 29
 OP_SETLOCAL = 30
 OP_CLEANUP = 31
 
+# Garbage collector linked with the runtime library, unless another is
+# chosen (see COLLECTORS).
+DEFAULT_COLLECTOR = 'mark-sweep'
+
 
 class CompileError(Exception):
-    pass
+
+    def __init__(self, message, location=None):
+        super().__init__(message)
+        self.location = location    # SourceLocation, if known
 
 
 class Symbol(object):
@@ -86,6 +107,7 @@ class Symbol(object):
         self.initialized = False    # For globals
         self.function = None
         self.closure_source = None
+        self.literal = None         # Contents, for static data (see StaticData)
 
 
 class Label(object):
@@ -96,6 +118,23 @@ class Label(object):
         self.offset = 0
 
 
+class Instruction(object):
+    """A decoded instruction, for passes that rewrite generated code.
+
+    Attributes:
+        opcode (int): operation (OP_xxx)
+        param (int): signed immediate field.
+        target (Label|Function|Symbol): if the param refers to a memory
+            location that will be filled in by apply_fixups, this is it.
+            Otherwise None.
+    """
+
+    def __init__(self, opcode, param=0, target=None):
+        self.opcode = opcode
+        self.param = param
+        self.target = target
+
+
 class Function(object):
     """This is a builder pattern that is used while generating code for a function.
 
@@ -110,6 +149,9 @@ class Function(object):
         self.fixups = []
         self.base_address = None
         self.num_local_variables = 0
+        self.num_local_variables_before_reuse = 0
+        self.local_lifetimes = []       # [symbol, start, end] for each local
+        self.num_params = 0
         self.prologue = None
         self.instructions = []
         self.environment = [{}]         # Stack of scopes
@@ -117,8 +159,15 @@ class Function(object):
         self.enclosing_function = None
         self.referenced = False         # Used to strip dead functions
         self.referenced_funcs = []
+        self.tail_calls = []            # Symbols called with compile_tail_call
+        self.stack_depth = None
         self.entry = Label()
         self.emit_label(self.entry)
+        self.peephole_words_saved = 0
+        self.peephole_cycles_saved = 0
+        self.unreachable_words_removed = 0
+        self.loops_rotated = 0
+        self.closure_checks_removed = 0
 
     def enter_scope(self):
         """Start a new region of code where local variables are live."""
@@ -126,7 +175,9 @@ class Function(object):
 
     def exit_scope(self):
         """Any local variables defined in the previous scope are no longer live."""
-        self.environment.pop()
+        for sym in self.environment.pop().values():
+            if sym.index < 0:
+                self.local_lifetimes[-sym.index - 2][2] = len(self.instructions)
 
     def lookup_local_variable(self, name):
         """Attempt to find a local variable visible at the current code location.
@@ -165,8 +216,64 @@ class Function(object):
         # Skip return address and base pointer
         sym.index = -(self.num_local_variables + 2)
         self.num_local_variables += 1
+        self.local_lifetimes.append([sym, len(self.instructions), None])
         return sym
 
+    def allocate_stack_slots(self):
+        """Share stack slots between local variables that aren't live at once.
+
+        Each local variable is initially given its own slot. A variable is
+        live from where it was reserved until the end of its scope, except
+        that free variables are copied in by the prologue, so they are live
+        from the start of the function. Slots are reassigned so variables
+        whose lifetimes don't overlap use the same one, and the getlocal and
+        setlocal instructions are updated to match. This must be called
+        before optimize_instructions and add_prologue.
+        """
+        self.num_local_variables_before_reuse = self.num_local_variables
+        lifetimes = []
+        for sym, start, end in self.local_lifetimes:
+            if sym in self.free_variables:
+                start = 0
+
+            if end is None:
+                end = len(self.instructions) + 1
+
+            lifetimes.append((start, end, sym))
+
+        slot_map = {}   # original index -> new index
+        free_slots = []
+        active = []     # (end, slot) for variables that are live
+        num_slots = 0
+        for start, end, sym in sorted(lifetimes, key=lambda lifetime: lifetime[:2]):
+            for active_end, slot in list(active):
+                if active_end <= start:
+                    active.remove((active_end, slot))
+                    free_slots.append(slot)
+
+            if free_slots:
+                slot = min(free_slots)
+                free_slots.remove(slot)
+            else:
+                slot = num_slots
+                num_slots += 1
+
+            active.append((end, slot))
+            slot_map[sym.index] = -(slot + 2)
+            sym.index = slot_map[sym.index]
+
+        self.num_local_variables = num_slots
+        for offset, word in enumerate(self.instructions):
+            opcode = word >> 16
+            if opcode in (OP_GETLOCAL, OP_SETLOCAL):
+                param = word & 0xffff
+                if param & 0x8000:
+                    param -= 0x10000
+
+                if param in slot_map:
+                    self.instructions[offset] = (opcode << 16) | \
+                        (slot_map[param] & 0xffff)
+
     def set_param(self, name, index):
         """Record information about a paramter to this function.
 
@@ -179,6 +286,7 @@ class Function(object):
         sym = Symbol(Symbol.LOCAL_VARIABLE)
         self.environment[-1][name] = sym
         sym.index = index + 1
+        self.num_params = max(self.num_params, index + 1)
 
     def emit_label(self, label):
         """Set the instruction address of a label.
@@ -305,6 +413,53 @@ class Function(object):
                 raise CompileError(
                     'internal error: unknown fixup type ' + target.__name__)
 
+    def unpack_instructions(self):
+        """Convert instructions into a form that is easier to rewrite.
+
+        Returns:
+            List of Instruction objects, with each Label that is referenced
+            by a fixup (and the entry label) inserted before the instruction
+            it points to.
+        """
+        targets = dict(self.fixups)
+        labels = {}
+        for label in [self.entry] + [target for target in targets.values()
+                                     if isinstance(target, Label)]:
+            at_offset = labels.setdefault(label.offset, [])
+            if label not in at_offset:
+                at_offset.append(label)
+
+        code = []
+        for pc, word in enumerate(self.instructions):
+            code += labels.get(pc, [])
+            param = word & 0xffff
+            if param & 0x8000:
+                param -= 0x10000
+
+            code.append(Instruction(word >> 16, param, targets.get(pc)))
+
+        code += labels.get(len(self.instructions), [])
+        return code
+
+    def pack_instructions(self, code):
+        """Replace instructions with rewritten code.
+
+        This is the inverse of unpack_instructions. It updates label offsets
+        and fixups to match the new instruction locations.
+
+        Args:
+            code (List<Instruction|Label>): new contents of the function
+        """
+        self.instructions = []
+        self.fixups = []
+        for entry in code:
+            if isinstance(entry, Label):
+                entry.offset = len(self.instructions)
+            else:
+                self.emit_instruction(entry.opcode, entry.param)
+                if entry.target is not None:
+                    self.add_fixup(entry.target)
+
     def mark_callees(self):
         """Recursively mark all functions called indirectly or directly by this one.
 
@@ -322,78 +477,429 @@ class Function(object):
             if not function.referenced:
                 function.mark_callees()
 
+class SourceLocation(object):
+    """Where a form was read from, for error messages and listings."""
+    __slots__ = ('filename', 'line', 'column')
+
+    def __init__(self, filename, line, column):
+        self.filename = filename
+        self.line = line
+        self.column = column
+
+    def __str__(self):
+        return '{}:{}:{}'.format(self.filename, self.line, self.column)
+
+
+class SourceForm(list):
+    """A list read by the parser, which remembers its SourceLocation.
+
+    This behaves like (and compares equal to) an ordinary list, so passes
+    that don't care about locations can ignore it.
+    """
+
+    def __init__(self, items=(), location=None):
+        list.__init__(self, items)
+        self.location = location
+
+
+def get_location(expr):
+    """Return the SourceLocation of expr, or None if it doesn't have one."""
+    return getattr(expr, 'location', None)
+
+
+# Characters that can be part of an identifier or number. Anything else that
+# isn't whitespace is a token by itself.
+WORD_CHARS = r'[A-Za-z0-9_?+<>!@#$%^&*:.=\\-]'
+
+# finditer skips over anything that doesn't match, which is how whitespace
+# is ignored.
+TOKEN_RE = re.compile(r"""
+    (?P<comment>;[^\n]*)
+    |(?P<string>"[^"]*"?)
+    |(?P<char>\#\\(?:{word}+|.))
+    |(?P<vector>\#\()
+    |(?P<word>{word}+)
+    |(?P<open>\()
+    |(?P<close>\))
+    |(?P<prefix>['`,])
+    |(?P<other>\S)
+    """.format(word=WORD_CHARS), re.VERBOSE)
+
+QUOTE_PREFIXES = {
+    '\'': 'quote',
+    '`': 'backquote',
+    ',': 'unquote'
+}
+
+# First element of the list the parser creates for a vector literal, #(...).
+VECTOR_HEAD = '#('
+
+
 class Parser(object):
-    """Convert text LISP source into a nested set of python lists."""
+    """Convert text LISP source into a nested set of python lists.
+
+    Lists are returned as SourceForms, which record the file, line, and
+    column they started at.
+    """
 
     def __init__(self):
-        self.lexer = None
         self.program = []
         self.filename = None
+        self.source = ''
+        self.line = 1
+        self.line_offset = 0    # Character offset where self.line was found
 
     def parse_file(self, filename):
-        self.filename = filename
         with open(filename, 'r') as stream:
-            self.lexer = shlex.shlex(stream)
-            self.lexer.commenters = ';'
-            self.lexer.quotes = '"'
-            self.lexer.wordchars += '?+<>!@#$%^&*;:.=-_\\'
+            self.parse_stream(stream, filename)
 
-            while True:
-                expr = self.parse_expr()
-                if expr == '':
-                    break
+    def parse_string(self, source, filename='<string>'):
+        self.filename = filename
+        self.source = source
+        self.line = 1
+        self.line_offset = 0
+        self.parse_tokens()
 
-                self.program.append(expr)
+    def parse_stream(self, stream, filename):
+        self.parse_string(stream.read(), filename)
+
+    def get_location(self, offset):
+        """Convert a character offset into a SourceLocation.
+
+        Tokens are read in order, so this only needs to count the newlines
+        since the last call.
+        """
+        self.line += self.source.count('\n', self.line_offset, offset)
+        self.line_offset = offset
+        column = offset - self.source.rfind('\n', 0, offset)
+        return SourceLocation(self.filename, self.line, column)
+
+    def parse_tokens(self):
+        """Build forms from tokens.
+
+        This uses an explicit stack rather than recursion, so deeply nested
+        source doesn't hit the python recursion limit. Each stack entry is
+        an enclosing list, along with the quote prefixes that preceded it
+        and whether it was quoted. Tokens are checked roughly in order of
+        how common they are.
+
+        A vector literal #(a b c) becomes (#( a b c). Its elements aren't
+        evaluated, so unless it is already part of a quoted expression, it
+        is wrapped in (quote ...).
+        """
+        stack = []
+        current = self.program  # List that values are being added to
+        prefixes = ()   # (name, location) of quotes applying to the next value
+        quoted = False  # current is inside a quote or backquote
+        for match in TOKEN_RE.finditer(self.source):
+            kind = match.lastgroup
+            if kind == 'word':
+                value = match.group()
+                if value.isdigit() or (value[0] == '-' and len(value) > 1):
+                    try:
+                        value = int(value)
+                    except ValueError:
+                        raise CompileError('invalid number ' + value,
+                                           self.get_location(match.start()))
+            elif kind == 'open' or kind == 'vector':
+                stack.append((current, prefixes, quoted))
+                quoted = kind == 'vector' or self.is_quoted(quoted, prefixes)
+                current = SourceForm(location=self.get_location(match.start()))
+                if kind == 'vector':
+                    current.append(VECTOR_HEAD)
+
+                prefixes = ()
+                continue
+            elif kind == 'close':
+                if not stack or prefixes:
+                    raise CompileError('unmatched )',
+                                       self.get_location(match.start()))
+
+                value = current
+                current, prefixes, quoted = stack.pop()
+                if value and value[0] == VECTOR_HEAD \
+                        and not self.is_quoted(quoted, prefixes):
+                    value = SourceForm(['quote', value], value.location)
+            elif kind == 'comment':
+                continue
+            elif kind == 'prefix':
+                prefixes += ((QUOTE_PREFIXES[match.group()],
+                              self.get_location(match.start())),)
+                continue
+            elif kind == 'char':
+                value = self.parse_character(match.group())
+            elif kind == 'string':
+                value = match.group()
+                if len(value) < 2 or value[-1] != '"':
+                    raise CompileError('missing "',
+                                       self.get_location(match.start()))
+            else:
+                value = match.group()
+
+            if prefixes:
+                for name, location in reversed(prefixes):
+                    value = SourceForm([name, value], location)
+
+                prefixes = ()
+
+            current.append(value)
+
+        if stack:
+            raise CompileError('missing )', current.location)
+        elif prefixes:
+            raise CompileError('missing expression after quote',
+                               prefixes[-1][1])
+
+    @staticmethod
+    def is_quoted(quoted, prefixes):
+        """Check if a value is part of a quoted expression.
+
+        Args:
+            quoted (bool): the list containing the value is.
+            prefixes (tuple): quotes in front of the value, from parse_tokens.
+        """
+        for name, _ in prefixes:
+            quoted = name != 'unquote'
+
+        return quoted
+
+    @staticmethod
+    def parse_character(token):
+        """Convert a character literal like #\\a to its character code."""
+        if token[2:] == 'newline':
+            return ord('\n')
+        elif token[2:] == 'space':
+            return ord(' ')
+        else:
+            return ord(token[2])
+
+
+def make_literal_list(elements, tail=0):
+    """Build the static representation of a list.
+
+    Cons cells are (first, rest) tuples and integers are themselves, so
+    identical literals compare (and hash) equal.
+
+    Args:
+        elements (List): static values of each element.
+        tail: value of the rest field of the last cell (0 is nil).
+
+    Returns:
+        Head of the list (0 for an empty list).
+    """
+    result = tail
+    for element in reversed(elements):
+        result = (element, result)
+
+    return result
+
+
+class LiteralVector(object):
+    """Static representation of a vector literal.
+
+    Unlike the tuples used for lists, these compare (and hash) by identity,
+    so identical vectors in different places aren't shared. Vectors are
+    meant to be modified, and changing one shouldn't change the other.
+    """
+
+    def __init__(self, elements):
+        self.elements = tuple(elements)
 
-    def parse_paren_list(self):
-        parenlist = []
-        while True:
-            lookahead = self.lexer.get_token()
-            if lookahead == '':
-                raise CompileError('missing )')
-            elif lookahead == ')':
-                break
 
-            self.lexer.push_token(lookahead)
-            parenlist.append(self.parse_expr())
-
-        return parenlist
-
-    def parse_expr(self):
-        token = self.lexer.get_token()
-        if token == '':
-            return ''
-        elif token == '\'':
-            return ['quote', self.parse_expr()]
-        elif token == '`':
-            return ['backquote', self.parse_expr()]
-        elif token == ',':
-            return ['unquote', self.parse_expr()]
-        elif token == '(':
-            return self.parse_paren_list()
-        elif token.isdigit() or (token[0] == '-' and len(token) > 1):
-            return int(token)
-        elif token == ')':
-            raise CompileError('unmatched )')
-        elif token[:2] == '#\\': # character code
-            if token[2:] == 'newline':
-                return ord('\n')
-            elif token[2:] == 'space':
-                return ord(' ')
+def get_string_literal(string):
+    """Strings are lists of character codes; there isn't a native type."""
+    return make_literal_list([ord(char) for char in string])
+
+
+class StaticData(object):
+    """Initial contents of data memory for strings, quoted lists, and vectors.
+
+    These are laid out as cons cells (or vectors, in the format described in
+    runtime.lisp) when the program is compiled, so they don't need to be
+    constructed at runtime. The region comes after the
+    global variables and before $heapstart. The garbage collector scans it
+    like the globals, so cells it points to stay live if the program
+    modifies a literal.
+
+    Each literal also has a word containing a tagged pointer to it, which
+    code loads like a global variable.
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.words = []
+
+    def end_address(self):
+        return self.base + len(self.words)
+
+    def add_literal(self, sym):
+        """Assign a Symbol for a literal its address, if it doesn't have one.
+
+        Args:
+            sym (Symbol): symbol created by Compiler.compile_literal
+        """
+        if sym.index == -1:
+            sym.index = self.end_address()
+            self.words.append(0)
+            self.words[sym.index - self.base] = self.encode(sym.literal)
+
+    def encode(self, value):
+        """Convert a static value into a data memory word.
+
+        This allocates any cons cells it references.
+        """
+        if isinstance(value, int):
+            return value & 0xffff
+
+        if isinstance(value, LiteralVector):
+            # Header, mark word, then the elements. This is padded to a
+            # whole number of cells, with room for at least one element,
+            # like the ones make-vector allocates. The pointer is to the
+            # first element.
+            length = len(value.elements)
+            head = self.end_address()
+            self.words += [(TAG_VECTOR_HEADER << 16) | length, 0] \
+                + [0] * ((length | 1) + 1)
+            for index, element in enumerate(value.elements):
+                self.words[head - self.base + index + 2] = self.encode(element)
+
+            return (TAG_CONS << 16) | (head + 2)
+
+        # Walk the rest pointers iteratively, since strings may be long.
+        elements = []
+        while isinstance(value, tuple):
+            elements.append(value[0])
+            value = value[1]
+
+        head = self.end_address()
+        self.words += [0] * (len(elements) * 2)
+        for index, element in enumerate(elements):
+            offset = head - self.base + index * 2
+            self.words[offset] = self.encode(element)
+            if index == len(elements) - 1:
+                self.words[offset + 1] = self.encode(value)
             else:
-                return ord(token[2])
+                self.words[offset + 1] = (TAG_CONS << 16) | (head + index * 2 + 2)
+
+        return (TAG_CONS << 16) | head
+
+
+class CompiledProgram(object):
+    """The result of compiling a program.
+
+    Attributes:
+        instructions (List<int>): instruction memory contents, starting at
+            address 0.
+        data (List<int>): initial data memory contents, starting at address
+            0. This covers the globals and static data (see StaticData).
+        functions (List<Function>): all functions that were emitted, in
+            address order. base_address is the location of each.
+        globals (dict): global variable name -> Symbol
+        symbols (dict): quoted symbol name -> integer ID
+        recursive_functions (List<str>): names of functions that may call
+            themselves (except with a self tail call), which prevents
+            determining how much stack the program needs.
+        listing (str): human readable disassembly, which is written to
+            program.lst
+    """
+
+    def __init__(self, instructions, data, functions, global_vars, symbols,
+                 recursive_functions=()):
+        self.instructions = instructions
+        self.data = data
+        self.functions = functions
+        self.globals = global_vars
+        self.symbols = symbols
+        self.recursive_functions = recursive_functions
+        self.listing = self.create_listing()
+
+    def create_listing(self):
+        listfile = io.StringIO()
+
+        # Write out table of global variables
+        listfile.write('Globals:\n')
+        for var in sorted(self.globals, key=lambda key: self.globals[key].index):
+            sym = self.globals[var]
+            if sym.type != Symbol.FUNCTION:
+                listfile.write(' {:4d} {} \n'.format(sym.index, var))
+
+        if self.symbols:
+            listfile.write('\nSymbols:\n')
+            for name in sorted(self.symbols, key=self.symbols.get):
+                listfile.write(' {:4d} {}\n'.format(self.symbols[name], name))
+
+        num_variables = sum(1 for sym in self.globals.values()
+                            if sym.type != Symbol.FUNCTION)
+        listfile.write('\nStatic data: {} words, heap starts at {}\n'.format(
+            len(self.data) - num_variables, len(self.data)))
+        listfile.write('\nPeephole optimizer saved {} words, ~{} cycles\n'.format(
+            sum(function.peephole_words_saved for function in self.functions),
+            sum(function.peephole_cycles_saved for function in self.functions)))
+        listfile.write('Removed {} unreachable words, rotated {} loops\n'.format(
+            sum(function.unreachable_words_removed for function in self.functions),
+            sum(function.loops_rotated for function in self.functions)))
+        listfile.write('Removed {} closure checks from calls through variables\n'.format(
+            sum(function.closure_checks_removed for function in self.functions)))
+        stack_size = self.data[self.globals['$stack-size'].index]
+        if self.recursive_functions:
+            listfile.write('Stack size unknown, reserved {} words. Recursive functions: {}\n'
+                           .format(stack_size, ', '.join(self.recursive_functions)))
         else:
-            return token
+            listfile.write('Stack size {} words\n'.format(stack_size))
+
+        listfile.write('Local variables use {} stack slots, {} before reuse\n'.format(
+            sum(function.num_local_variables for function in self.functions),
+            sum(function.num_local_variables_before_reuse
+                for function in self.functions)))
+
+        disassemble(listfile, self.instructions, self.functions)
+        return listfile.getvalue()
+
+    def write_hex_file(self, filename='program.hex'):
+        with open(filename, 'w') as outfile:
+            for instr in self.instructions:
+                outfile.write('{:06x}\n'.format(instr))
+
+    def write_data_file(self, filename='data.hex'):
+        with open(filename, 'w') as outfile:
+            for word in self.data:
+                outfile.write('{:05x}\n'.format(word))
+
+    def write_listing(self, filename='program.lst'):
+        with open(filename, 'w') as listfile:
+            listfile.write(self.listing)
+
+    def write_files(self, directory='.'):
+        """Create program.hex, data.hex, and program.lst in the given directory."""
+        self.write_hex_file(os.path.join(directory, 'program.hex'))
+        self.write_data_file(os.path.join(directory, 'data.hex'))
+        self.write_listing(os.path.join(directory, 'program.lst'))
 
 
 class Compiler(object):
 
-    def __init__(self):
+    def __init__(self, inline_cons=False, collector=DEFAULT_COLLECTOR):
+        """
+        Args:
+            inline_cons (bool): Emit the common case of cons inline at each
+              call, rather than calling the runtime function. See
+              compile_cons.
+            collector (str): The garbage collector the runtime library was
+              loaded with (a key of COLLECTORS). The inline cons code
+              depends on this.
+        """
+        self.inline_cons = inline_cons
+        self.collector = collector
         self.globals = {}
         self.next_global_slot = 0
         self.current_function = None
         self.function_list = []
         self.break_stack = []
+        self.literals = {}
+        self.vector_literals = {}   # id of source form -> (form, LiteralVector)
+        self.symbol_ids = {}
+        self.call_graph = None
+        self.closure_analysis = None
 
     def lookup_symbol(self, name):
         """Given an identifier, find its type and where it's stored.
@@ -471,6 +977,9 @@ class Compiler(object):
 
         All code not in function blocks will be emitted into an implicitly
         created dummy function 'main'
+
+        Returns:
+            CompiledProgram
         """
         self.current_function = Function('main')
         self.function_list.append(self.current_function)
@@ -492,20 +1001,34 @@ class Compiler(object):
         closure_ptr = self.lookup_symbol('$closure')
         closure_ptr.initialized = True
 
+        # Number of words the runtime leaves between the heap and the stack.
+        # Its initial value is set in the data image below.
+        stack_size = self.lookup_symbol('$stack-size')
+        stack_size.initialized = True
+
         # Do a pass to register all functions in the global scope. This is
         # necessary to avoid creating these symbols as global variables
         # when there are forward references.
         for expr in program:
-            if expr[0] == 'function':
+            if is_function_definition(expr):
                 self.globals[expr[1]] = Symbol(Symbol.FUNCTION)
 
+        self.call_graph = CallGraph(program)
+        self.closure_analysis = ClosureAnalysis(program, self.call_graph)
+
         # Compile
         for expr in program:
-            if expr[0] == 'function':
-                self.compile_function(expr)
-            else:
-                self.compile_expression(expr)
-                self.current_function.emit_instruction(OP_POP) # Clean up stack
+            try:
+                if is_function_definition(expr):
+                    self.compile_function(expr)
+                else:
+                    self.compile_expression(expr)
+                    self.current_function.emit_instruction(OP_POP) # Clean up stack
+            except CompileError as ex:
+                if ex.location is None:
+                    ex.location = get_location(expr)
+
+                raise
 
         # Call (halt) library call at end
         self.compile_identifier('halt')
@@ -522,6 +1045,17 @@ class Compiler(object):
             if not sym.initialized:
                 raise CompileError('unknown variable {}'.format(name))
 
+        for function in self.function_list:
+            function.allocate_stack_slots()
+            optimize_instructions(function)
+
+        # Lay out literals that are still referenced after optimization.
+        static_data = StaticData(self.next_global_slot)
+        for function in self.function_list:
+            for _, target in function.fixups:
+                if isinstance(target, Symbol) and target.literal is not None:
+                    static_data.add_literal(target)
+
         # Generate prologues and determine function addresses
         pc = 0
         for function in self.function_list:
@@ -533,10 +1067,11 @@ class Compiler(object):
         for function in self.function_list:
             function.apply_fixups()
 
-        # Patch $heapsize now that we know the number of global variables.
-        # This assumes the push of the size is the first instruction emitted
-        # above.
-        self.function_list[0].patch(0, len(self.globals))
+        # Patch $heapstart now that we know the size of the global variables
+        # and static data. This assumes the push of the size is the first
+        # instruction emitted above (which the peephole optimizer leaves
+        # alone, since it is followed by another push).
+        self.function_list[0].patch(0, static_data.end_address())
 
         # Flatten all generated instructions into an array
         instructions = []
@@ -544,20 +1079,16 @@ class Compiler(object):
             instructions += function.prologue
             instructions += function.instructions
 
-        with open('program.hex', 'w') as outfile:
-            for instr in instructions:
-                outfile.write('{:06x}\n'.format(instr))
-
-        # For debugging: create a list file with the disassembly
-        with open('program.lst', 'w') as listfile:
-            # Write out table of global variables
-            listfile.write('Globals:\n')
-            for var in sorted(self.globals, key=lambda key: self.globals[key].index):
-                sym = self.globals[var]
-                if sym.type != Symbol.FUNCTION:
-                    listfile.write(' {:4d} {} \n'.format(sym.index, var))
+        data = [0] * self.next_global_slot + static_data.words
+        stack_depth, recursive_functions = find_stack_depth(self.function_list)
+        if stack_depth is None:
+            data[stack_size.index] = DEFAULT_STACK_SIZE
+        else:
+            data[stack_size.index] = stack_depth + 1
 
-            disassemble(listfile, instructions, self.function_list)
+        return CompiledProgram(instructions, data, self.function_list,
+                               self.globals, self.symbol_ids,
+                               recursive_functions)
 
     def compile_function(self, expr):
         """Compile named function definition.
@@ -606,7 +1137,7 @@ class Compiler(object):
         elif isinstance(expr, int):
             self.compile_integer_literal(expr)
         elif expr[0] == '"':
-            self.compile_string(expr[1:-1])
+            self.compile_literal(get_string_literal(expr[1:-1]))
         elif expr == 'nil' or expr == 'false':
             self.current_function.emit_instruction(OP_PUSH, 0)
         elif expr == 'true':
@@ -668,7 +1199,7 @@ class Compiler(object):
             elif function_name == 'assign':
                 self.compile_assign(expr)
             elif function_name == 'quote':
-                self.compile_quote(expr[1])
+                self.compile_literal(self.get_quoted_literal(expr[1]))
             elif function_name == 'list':
                 self.compile_list(expr)
             elif function_name == 'let':
@@ -689,75 +1220,123 @@ class Compiler(object):
         Args:
             expr (List): list of expression values
         """
-        for value in reversed(expr[1:]):
-            self.compile_expression(value)
+        self.compile_list_of(expr[1:], self.compile_expression)
 
-            # Emit a call to the cons library function
-            self.compile_identifier('cons')
+    MIN_ALLOC_CELLS = 3
+
+    def compile_list_of(self, values, compile_value):
+        """Emit code to construct a list from a sequence of values.
+
+        Short lists are created by calling cons for each element. For longer
+        ones, this evaluates all of the values (last to first, like function
+        arguments), then calls $alloc-cells to get all of the cells at once
+        and stores the values into them. This is faster when there are at
+        least MIN_ALLOC_CELLS elements.
+
+        Args:
+            values (List): things to put in the list.
+            compile_value (function): called with each item in values to
+              emit code that pushes it.
+        """
+        if len(values) < self.MIN_ALLOC_CELLS:
+            self.compile_integer_literal(0)     # Terminate the list
+            for value in reversed(values):
+                compile_value(value)
+                self.compile_cons()
+        else:
+            for value in reversed(values):
+                compile_value(value)
+
+            self.compile_integer_literal(len(values))
+            self.compile_identifier('$alloc-cells')
             self.current_function.emit_instruction(OP_CALL)
-            self.current_function.emit_instruction(OP_CLEANUP, 2)
+            self.current_function.emit_instruction(OP_CLEANUP, 1)
+
+            # The top of the stack is the first cell, followed by the values
+            # in order. Store each value into a cell, following the links.
+            self.current_function.enter_scope()
+            head = self.current_function.reserve_local_variable('list|head')
+            cell = self.current_function.reserve_local_variable('list|cell')
+            self.current_function.emit_instruction(OP_SETLOCAL, head.index)
+            for index in range(len(values)):
+                if index > 0:
+                    self.current_function.emit_instruction(
+                        OP_GETLOCAL, (head if index == 1 else cell).index)
+                    self.current_function.emit_instruction(OP_REST)
+                    if index < len(values) - 1:
+                        self.current_function.emit_instruction(
+                            OP_SETLOCAL, cell.index)
+
+                self.current_function.emit_instruction(OP_STORE)
+                self.current_function.emit_instruction(OP_POP)
+
+            self.current_function.emit_instruction(OP_GETLOCAL, head.index)
+            self.current_function.exit_scope()
+
+    def get_quoted_literal(self, expr):
+        """Convert a quoted S-expression into its static representation.
 
-    def compile_quote(self, expr):
-        """Convert quoted expression to a series of cons calls.
+        Symbols are interned: each distinct name is assigned an integer ID
+        (counting up from 1, so they are never nil), which is what the
+        quoted symbol evaluates to. Since they are just integers, symbols
+        compare with = and don't need any storage.
 
         Args:
-            expr (List|int|str): literal value to be quoted.
+            expr (List|int|str): quoted expression
+
+        Returns:
+            An integer, a (first, rest) tuple for lists (see
+            make_literal_list), or a LiteralVector.
         """
         if isinstance(expr, list):
-            if len(expr) == 3 and expr[1] == '.':
+            if expr and expr[0] == VECTOR_HEAD:
+                # Each vector in the source gets its own copy, which is
+                # shared by copies of the code containing it (such as when
+                # it is inlined). The form is saved so its id isn't reused.
+                if id(expr) not in self.vector_literals:
+                    self.vector_literals[id(expr)] = (expr, LiteralVector(
+                        [self.get_quoted_literal(element) for element in expr[1:]]))
+
+                return self.vector_literals[id(expr)][1]
+            elif len(expr) == 3 and expr[1] == '.':
                 # This is a pair, which has special syntax: ( expr . expr )
-                # Create a single cons cell for it.
-                self.compile_quote(expr[2])
-                self.compile_quote(expr[0])
-
-                # Emit a call to the cons library function
-                self.compile_identifier('cons')
-                self.current_function.emit_instruction(OP_CALL)
-                self.current_function.emit_instruction(OP_CLEANUP, 2)
-            elif len(expr) == 0:
-                # Empty list
-                self.compile_integer_literal(0)
+                return (self.get_quoted_literal(expr[0]),
+                        self.get_quoted_literal(expr[2]))
             else:
-                # List, create a chain of cons calls
-                self.compile_quoted_list(expr)
+                return make_literal_list([self.get_quoted_literal(element)
+                                          for element in expr])
         elif isinstance(expr, int):
-            self.compile_integer_literal(expr)
-        else:
-            self.compile_string(expr)
-
-    def compile_quoted_list(self, tail):
-        if len(tail) == 1:
-            self.compile_integer_literal(0)
+            return expr
+        elif expr[0] == '"':
+            return get_string_literal(expr[1:-1])
+        elif expr in LITERAL_NAMES:
+            return LITERAL_NAMES[expr]
         else:
-            # Do the tail first to avoid allocating a bunch of temporaries
-            self.compile_quoted_list(tail[1:])
-
-        self.compile_quote(tail[0])
+            return self.symbol_ids.setdefault(expr, len(self.symbol_ids) + 1)
 
-        # Emit a call to the cons library function
-        self.compile_identifier('cons')
-        self.current_function.emit_instruction(OP_CALL)
-        self.current_function.emit_instruction(OP_CLEANUP, 2)
-
-    def compile_string(self, string):
-        """Convert string literal to a cons call for each character
+    def compile_literal(self, value):
+        """Emit code to push a string or quoted expression.
 
-        There isn't not a native string type.
+        Lists are stored in static data (see StaticData) rather than being
+        constructed when the expression is evaluated, so every evaluation
+        returns the same cells. Identical literals are shared.
 
         Args:
-            string (str): literal to be encoded.
+            value: static representation, from get_quoted_literal.
         """
-        if len(string) == 1:
-            self.compile_integer_literal(0)
+        if isinstance(value, int):
+            self.compile_integer_literal(value)
         else:
-            self.compile_string(string[1:])
+            sym = self.literals.get(value)
+            if sym is None:
+                sym = Symbol(Symbol.GLOBAL_VARIABLE)
+                sym.initialized = True
+                sym.literal = value
+                self.literals[value] = sym
 
-        self.compile_integer_literal(ord(string[0]))
-
-        # Emit a call to the cons library function
-        self.compile_identifier('cons')
-        self.current_function.emit_instruction(OP_CALL)
-        self.current_function.emit_instruction(OP_CLEANUP, 2)
+            self.current_function.emit_instruction(OP_PUSH, 0)
+            self.current_function.add_fixup(sym)
+            self.current_function.emit_instruction(OP_LOAD)
 
     def compile_assign(self, expr):
         """Emit code to write to a variable (assign variable value).
@@ -985,7 +1564,10 @@ class Compiler(object):
         for param_expr in reversed(expr[1:]):
             self.compile_expression(param_expr)
 
-        if self.current_function.name == expr[0] and is_tail_call:
+        if expr[0] == 'cons' and len(expr) == 3 and \
+                self.lookup_symbol('cons').type == Symbol.FUNCTION:
+            self.compile_cons()
+        elif self.current_function.name == expr[0] and is_tail_call:
             # This is a recursive tail call. Copy parameters back into
             # frame and then jump to entry
             for opnum in range(len(expr) - 1):
@@ -994,46 +1576,232 @@ class Compiler(object):
 
             self.current_function.emit_branch_instruction(
                 OP_GOTO, self.current_function.entry)
+        elif is_tail_call and self.can_reuse_frame(expr):
+            self.compile_tail_call(expr)
         else:
-            may_be_closure = True
-            if isinstance(expr[0], str):
-                func = self.lookup_symbol(expr[0])
-                if func.type == Symbol.FUNCTION:
-                    may_be_closure = False
-
-            self.compile_expression(expr[0])
-
-            if may_be_closure:
-                # Need to check if this is a closure or just a function
-                self.current_function.emit_instruction(OP_DUP)
-                self.current_function.emit_instruction(OP_GETTAG)
-                not_closure = Label()
-                self.current_function.emit_instruction(OP_PUSH, TAG_CLOSURE)
-                self.current_function.emit_instruction(OP_EQ)
-                self.current_function.emit_instruction(OP_BFALSE, 0)
-                self.current_function.add_fixup(not_closure)
-
-                # This is a closure, extract relevant parts. Store pointer to
-                # environment at address 1, which is $closure.
-                self.current_function.emit_instruction(OP_DUP)
-                self.current_function.emit_instruction(OP_REST)  # read env
-                self.current_function.emit_instruction(OP_PUSH, 1)  # $closure
-                self.current_function.emit_instruction(OP_STORE)  # save
-                self.current_function.emit_instruction(OP_POP)
-                self.current_function.emit_instruction(
-                    OP_LOAD)  # load function
+            self.compile_callee(expr)
+            self.current_function.emit_instruction(OP_CALL)
+            if len(expr) > 1:
+                self.current_function.emit_instruction(OP_CLEANUP,
+                                                       len(expr) - 1)
+
+    def compile_cons(self):
+        """Emit code to allocate a cons cell.
+
+        The first and rest values have already been pushed, like the
+        arguments to a call. Normally this just calls cons. If inline_cons
+        is set, it instead emits the common cases of the runtime function:
+        taking a cell from the free list or the wilderness, and only
+        calls cons when both are empty (which will garbage collect). This
+        is faster, but makes each call site much larger. The copying
+        collector has no free list, so the code for it only checks the
+        wilderness.
+        """
+        if not self.inline_cons:
+            self.compile_identifier('cons')
+            self.current_function.emit_instruction(OP_CALL)
+            self.current_function.emit_instruction(OP_CLEANUP, 2)
+            return
 
-                self.current_function.emit_label(not_closure)
-                self.current_function.emit_instruction(OP_CALL)
-                if len(expr) > 1:
-                    self.current_function.emit_instruction(OP_CLEANUP,
-                                                           len(expr) - 1)
-            else:
-                # Optimized function call
-                self.current_function.emit_instruction(OP_CALL)
-                if len(expr) > 1:
-                    self.current_function.emit_instruction(
-                        OP_CLEANUP, len(expr) - 1)
+        mark_sweep = self.collector == 'mark-sweep'
+        use_wilderness = Label()
+        fill_cell = Label()
+        call_cons = Label()
+        done = Label()
+        self.current_function.enter_scope()
+        ptr = self.current_function.reserve_local_variable('cons|ptr')
+
+        if mark_sweep:
+            # Try to take a cell from the free list
+            self.compile_identifier('$freelist')
+            self.current_function.emit_instruction(OP_DUP)
+            self.current_function.emit_branch_instruction(OP_BFALSE, use_wilderness)
+            self.current_function.emit_instruction(OP_DUP)
+            self.current_function.emit_instruction(OP_REST)
+            self.current_function.emit_instruction(OP_PUSH, 0)
+            self.current_function.add_fixup(self.lookup_symbol('$freelist'))
+            self.current_function.emit_instruction(OP_STORE)
+            self.current_function.emit_instruction(OP_POP)
+        else:
+            self.compile_cons_from_wilderness(call_cons)
+
+        # Top of stack is the new cell, followed by first and rest
+        self.current_function.emit_label(fill_cell)
+        self.current_function.emit_instruction(OP_SETLOCAL, ptr.index)
+        self.current_function.emit_instruction(OP_STORE)
+        self.current_function.emit_instruction(OP_POP)
+        self.current_function.emit_instruction(OP_PUSH, 1)
+        self.current_function.emit_instruction(OP_GETLOCAL, ptr.index)
+        self.current_function.emit_instruction(OP_ADD)
+        self.current_function.emit_instruction(OP_STORE)
+        self.current_function.emit_instruction(OP_POP)
+        self.current_function.emit_instruction(OP_PUSH, TAG_CONS)
+        self.current_function.emit_instruction(OP_GETLOCAL, ptr.index)
+        self.current_function.emit_instruction(OP_SETTAG)
+        self.current_function.emit_branch_instruction(OP_GOTO, done)
+
+        if mark_sweep:
+            # The free list is empty. Check if there is space in the
+            # wilderness.
+            self.current_function.emit_label(use_wilderness)
+            self.current_function.emit_instruction(OP_POP)
+            self.compile_cons_from_wilderness(call_cons)
+            self.current_function.emit_branch_instruction(OP_GOTO, fill_cell)
+
+        # Out of memory, call the runtime function to garbage collect
+        self.current_function.emit_label(call_cons)
+        self.compile_identifier('cons')
+        self.current_function.emit_instruction(OP_CALL)
+        self.current_function.emit_instruction(OP_CLEANUP, 2)
+        self.current_function.emit_label(done)
+        self.current_function.exit_scope()
+
+    def compile_cons_from_wilderness(self, call_cons):
+        """Emit code to take a cell from the wilderness for compile_cons.
+
+        This pushes the address of the cell, or jumps to call_cons if the
+        wilderness is empty.
+
+        Args:
+            call_cons (Label): where to go if there is no space.
+        """
+        self.compile_expression(['<', '$wilderness-start', '$max-heap'])
+        self.current_function.emit_branch_instruction(OP_BFALSE, call_cons)
+        self.compile_identifier('$wilderness-start')
+        self.current_function.emit_instruction(OP_DUP)
+        self.current_function.emit_instruction(OP_PUSH, 2)
+        self.current_function.emit_instruction(OP_ADD)
+        self.current_function.emit_instruction(OP_PUSH, 0)
+        self.current_function.add_fixup(self.lookup_symbol('$wilderness-start'))
+        self.current_function.emit_instruction(OP_STORE)
+        self.current_function.emit_instruction(OP_POP)
+
+    def compile_callee(self, expr, saved_callee=None):
+        """Emit code to push the address of a function to call.
+
+        If the value may be a closure, this also checks for that and stores
+        its environment in $closure for the prologue of the called function.
+        The check is skipped if ClosureAnalysis found the value is always,
+        or never, a closure.
+
+        Args:
+            expr (List): the function call S-expr
+            saved_callee (Symbol): local variable holding the value of
+                expr[0], to use instead of evaluating it again.
+        """
+        function_expr = expr[0]
+        kind = ClosureAnalysis.UNKNOWN
+        if isinstance(function_expr, str) and \
+                self.lookup_symbol(function_expr).type == Symbol.FUNCTION:
+            kind = ClosureAnalysis.NOT_CLOSURE
+        else:
+            kind = self.closure_analysis.get_callee_kind(expr)
+            if kind != ClosureAnalysis.UNKNOWN:
+                self.current_function.closure_checks_removed += 1
+
+        if saved_callee:
+            self.current_function.emit_instruction(OP_GETLOCAL,
+                                                   saved_callee.index)
+        else:
+            self.compile_expression(function_expr)
+
+        if kind == ClosureAnalysis.NOT_CLOSURE:
+            return
+
+        if kind == ClosureAnalysis.UNKNOWN:
+            # Need to check if this is a closure or just a function
+            self.current_function.emit_instruction(OP_DUP)
+            self.current_function.emit_instruction(OP_GETTAG)
+            not_closure = Label()
+            self.current_function.emit_instruction(OP_PUSH, TAG_CLOSURE)
+            self.current_function.emit_instruction(OP_EQ)
+            self.current_function.emit_instruction(OP_BFALSE, 0)
+            self.current_function.add_fixup(not_closure)
+
+        # This is a closure, extract relevant parts. Store pointer to
+        # environment at address 1, which is $closure.
+        self.current_function.emit_instruction(OP_DUP)
+        self.current_function.emit_instruction(OP_REST)  # read env
+        self.current_function.emit_instruction(OP_PUSH, 1)  # $closure
+        self.current_function.emit_instruction(OP_STORE)  # save
+        self.current_function.emit_instruction(OP_POP)
+        self.current_function.emit_instruction(
+            OP_LOAD)  # load function
+
+        if kind == ClosureAnalysis.UNKNOWN:
+            self.current_function.emit_label(not_closure)
+
+    def can_reuse_frame(self, expr):
+        """Check if a tail call can replace the current stack frame.
+
+        The arguments are copied over the parameters of this function,
+        so there must be at least as many of them. The called function must
+        be a variable or a named function. Reusing the frame is a little
+        slower than a normal call, so calls to named functions only do it
+        when they could recurse back to this one, which is when the stack
+        could otherwise grow without limit.
+
+        Args:
+            expr (List): the function call S-expr
+
+        Returns:
+            True if compile_tail_call can be used.
+        """
+        if len(expr) - 1 > self.current_function.num_params or \
+                not isinstance(expr[0], str):
+            return False
+
+        sym = self.lookup_symbol(expr[0])
+        if sym.type == Symbol.FUNCTION:
+            return self.call_graph.may_recurse(self.current_function.name,
+                                               expr[0])
+
+        return True
+
+    def compile_tail_call(self, expr):
+        """Emit code to call a function, reusing the current stack frame.
+
+        The return address in the frame always points just after the
+        caller's call instruction. This copies the arguments (which have
+        already been pushed) over the parameters, rewrites the return address
+        to point at that call instruction, and returns with the address of
+        the new function on the top of the stack. The call instruction then
+        executes again, calling the new function with the original caller's
+        return address and the same frame location. Since the caller cleans
+        up its original arguments, any extra parameter slots are harmless.
+        If the called function is in one of the parameters that is
+        overwritten, such as a callback, it is saved in a temporary
+        variable first.
+
+        Args:
+            expr (List): the function call S-expr
+        """
+        sym = self.lookup_symbol(expr[0])
+        saved_callee = None
+        self.current_function.enter_scope()
+        if sym.type == Symbol.LOCAL_VARIABLE and 0 < sym.index < len(expr):
+            saved_callee = self.current_function.reserve_local_variable(
+                'callee|')
+            self.current_function.emit_instruction(OP_GETLOCAL, sym.index)
+            self.current_function.emit_instruction(OP_SETLOCAL,
+                                                   saved_callee.index)
+            self.current_function.emit_instruction(OP_POP)
+
+        for opnum in range(len(expr) - 1):
+            self.current_function.emit_instruction(OP_SETLOCAL, opnum + 1)
+            self.current_function.emit_instruction(OP_POP)
+
+        self.current_function.emit_instruction(OP_PUSH, 1)
+        self.current_function.emit_instruction(OP_GETLOCAL, -1)
+        self.current_function.emit_instruction(OP_SUB)
+        self.current_function.emit_instruction(OP_SETLOCAL, -1)
+        self.current_function.emit_instruction(OP_POP)
+
+        self.current_function.tail_calls.append(
+            sym if sym.type == Symbol.FUNCTION else None)
+        self.compile_callee(expr, saved_callee)
+        self.current_function.emit_instruction(OP_RETURN)
+        self.current_function.exit_scope()
 
     def compile_function_body(self, name, params, body):
         """Common code to compile body function definition.
@@ -1077,10 +1845,10 @@ class Compiler(object):
         """
         # Do an enter_scope because we may create temporary variables to
         # represent free variables while compiling. See lookup_symbol for more
-        # information.
+        # information. These are read below to create the closure, so the
+        # scope ends after that.
         self.current_function.enter_scope()
         new_function = self.compile_function_body('<anonymous function>', expr[1], expr[2:])
-        self.current_function.exit_scope()
         self.current_function.referenced_funcs.append(new_function)
 
         # Compile reference to function into enclosing function
@@ -1093,23 +1861,17 @@ class Compiler(object):
             self.current_function.emit_instruction(OP_PUSH, TAG_CLOSURE)
 
             # Copy all of the closure variables into a list
-            self.current_function.emit_instruction(OP_PUSH, 0)  # Delimiter
-            for var in reversed(new_function.free_variables):
-                self.current_function.emit_instruction(OP_GETLOCAL,
-                                                       var.closure_source.index)
-                # Append to list
-                self.compile_identifier('cons')
-                self.current_function.emit_instruction(OP_CALL)
-                self.current_function.emit_instruction(OP_CLEANUP, 2)
+            self.compile_list_of(
+                new_function.free_variables,
+                lambda var: self.current_function.emit_instruction(
+                    OP_GETLOCAL, var.closure_source.index))
 
             # Add function pointer
             self.current_function.emit_instruction(OP_PUSH, 0)
             self.current_function.add_fixup(new_function)
 
             # Create the pair of (funcaddr . valuelist)
-            self.compile_identifier('cons')
-            self.current_function.emit_instruction(OP_CALL)
-            self.current_function.emit_instruction(OP_CLEANUP, 2)
+            self.compile_cons()
 
             # Change the tag of this cons cell into a closure
             self.current_function.emit_instruction(OP_SETTAG)
@@ -1122,6 +1884,7 @@ class Compiler(object):
             self.current_function.add_fixup(new_function)
             self.current_function.emit_instruction(OP_SETTAG)
 
+        self.current_function.exit_scope()
         self.function_list.append(new_function)
 
     def compile_sequence(self, sequence, is_tail_call=False):
@@ -1176,10 +1939,17 @@ class Compiler(object):
         self.compile_sequence(expr[2:], is_tail_call)
         self.current_function.exit_scope()
 
+def is_function_definition(expr):
+    """True if this is a top level (function name (params...) body...)"""
+    return isinstance(expr, list) and len(expr) > 2 and \
+        expr[0] == 'function' and isinstance(expr[1], str)
+
+
+# Division rounds toward zero, like the runtime library.
 OPTIMIZE_BINOPS = {
     '+': (lambda x, y: x + y),
     '-': (lambda x, y: x - y),
-    '/': (lambda x, y: x // y),
+    '/': (lambda x, y: abs(x) // abs(y) * (1 if (x < 0) == (y < 0) else -1)),
     '*': (lambda x, y: x * y),
     'bitwise-and': (lambda x, y: x & y),
     'bitwise-or': (lambda x, y: x | y),
@@ -1197,7 +1967,7 @@ OPTIMIZE_BINOPS = {
 OPTIMIZE_UOPS = {
     'bitwise-not': (lambda x: ~x),
     '-': (lambda x: -x),
-    'not': (lambda x: 1 if x else 0)
+    'not': (lambda x: 0 if x else 1)
 }
 
 
@@ -1213,38 +1983,244 @@ def make_legal_constant(i):
         return i
 
 
-def optimize(expr):
-    """Optimize the program in S-Expression list format.
+# Multiplies by a constant with more than this many non-zero digits in
+# their signed-digit form call the runtime library instead.
+MAX_MULTIPLY_TERMS = 4
 
-    Perform transforms like constant folding, constant conditional folding,
-    and strength reduction to improve performance and reduce size.
+
+def get_shift_add_terms(multiplier):
+    """Break a positive constant into its non-adjacent form.
+
+    This is the signed-digit representation with the fewest non-zero digits,
+    e.g. 7 is 8 - 1 rather than 4 + 2 + 1.
 
     Args:
-        expr (List): List containing the S-expr
+        multiplier (int): Value to convert, must be positive.
 
     Returns:
-        The optimized S-Expr.
+        List of (sign, shift) tuples, from the most significant digit down.
     """
-    if isinstance(expr, list) and len(expr) > 0:
-        if expr[0] == 'quote':
-            return expr  # Don't optimize quoted elements
-        else:
-            # Fold arithmetic expressions if possible
-            optimized_params = [optimize(subexpr) for subexpr in expr[1:]]
-            if not isinstance(expr[0], list) and \
-                    expr[0] in OPTIMIZE_BINOPS and \
-                    len(expr) == 3 and \
-                    isinstance(optimized_params[0], int) and \
-                    isinstance(optimized_params[1], int):
-                return make_legal_constant(
-                    OPTIMIZE_BINOPS[
-                        expr[0]](optimized_params[0], optimized_params[1]))
+    terms = []
+    shift = 0
+    while multiplier:
+        if multiplier & 1:
+            sign = 2 - (multiplier & 3)
+            terms.append((sign, shift))
+            multiplier -= sign
 
-            if not isinstance(expr[0], list) and expr[0] in OPTIMIZE_UOPS and \
-                    len(expr) == 2 and \
-                    isinstance(optimized_params[0], int):
-                return make_legal_constant(
-                    OPTIMIZE_UOPS[expr[0]](optimized_params[0]))
+        multiplier >>= 1
+        shift += 1
+
+    terms.reverse()
+    return terms
+
+
+def reduce_multiply(left, right):
+    """Replace a multiply by a constant with shifts, adds, and subtracts.
+
+    Because arithmetic wraps at 16 bits, this produces the same result
+    as the runtime multiply for every input.
+
+    Args:
+        left: First (optimized) operand.
+        right: Second (optimized) operand.
+
+    Returns:
+        Replacement S-Expr, or None if neither operand is a constant or the
+        constant has too many non-zero digits to be worthwhile.
+    """
+    if isinstance(right, int):
+        value, constant = left, right
+    elif isinstance(left, int):
+        value, constant = right, left
+    else:
+        return None
+
+    if constant == 0:
+        return ['begin', value, 0]
+
+    terms = get_shift_add_terms(abs(constant))
+    if len(terms) > MAX_MULTIPLY_TERMS:
+        return None
+
+    if len(terms) > 1 and not isinstance(value, str):
+        # Evaluate the operand only once.
+        variable = 'multiplicand|'
+    else:
+        variable = value
+
+    result = None
+    for sign, shift in terms:
+        term = ['lshift', variable, shift] if shift else variable
+        if result is None:
+            result = term   # First digit is always positive
+        else:
+            result = ['+' if sign > 0 else '-', result, term]
+
+    if constant < 0:
+        result = ['-', 0, result]
+
+    if variable != value:
+        result = ['let', [[variable, value]], result]
+
+    return result
+
+
+def reduce_divide(value, shift):
+    """Replace a divide by a power of two with shifts.
+
+    rshift is logical, so a negative dividend is negated, shifted, and
+    negated back. This rounds toward zero, like the runtime library.
+
+    Args:
+        value: Dividend (optimized).
+        shift (int): Log base 2 of the divisor.
+
+    Returns:
+        Replacement S-Expr.
+    """
+    if shift == 0:
+        return value
+
+    if isinstance(value, str):
+        variable = value
+    else:
+        # Evaluate the operand only once.
+        variable = 'dividend|'
+
+    result = ['if', ['<', variable, 0],
+              ['-', 0, ['rshift', ['-', 0, variable], shift]],
+              ['rshift', variable, shift]]
+    if variable != value:
+        result = ['let', [[variable, value]], result]
+
+    return result
+
+
+# Division and modulus by a constant are replaced by calls to generated
+# helper functions with this prefix, followed by the divisor. The second
+# parameter is 1 to return the remainder, 0 for the quotient.
+DIVMOD_HELPER_PREFIX = 'divmod|'
+
+
+def guard_divide_steps(steps):
+    """Nest division steps so small dividends skip the high ones.
+
+    The remainder only decreases, so if it is smaller than the lowest
+    chunk in the upper half of the steps, none of those can subtract.
+    Applying this recursively means a dividend with few significant bits
+    only pays for a handful of compares.
+
+    Args:
+        steps (List): (chunk, statement) tuples, from the largest chunk
+            down.
+
+    Returns:
+        List of statements.
+    """
+    if len(steps) < 3:
+        return [statement for _, statement in steps]
+
+    upper = steps[:len(steps) // 2]
+    lower = steps[len(steps) // 2:]
+    return [['if', ['>=', 'remainder', upper[-1][0]],
+             ['begin'] + guard_divide_steps(upper)]] \
+        + guard_divide_steps(lower)
+
+
+def create_divmod_helper(divisor):
+    """Build a function that divides by a constant.
+
+    This is an unrolled restoring division, which is a compare and a
+    conditional subtract per quotient bit, with no loop overhead or
+    normalization. The results match the runtime library: the quotient
+    rounds toward zero and the remainder takes the sign of the divisor.
+
+    Args:
+        divisor (int): Constant to divide by. Must be non-zero and
+            not -32768.
+
+    Returns:
+        Function definition S-Expr
+    """
+    magnitude = abs(divisor)
+    top_bit = 0
+    while (magnitude << (top_bit + 1)) <= 0x7fff:
+        top_bit += 1
+
+    steps = []
+    for bit in range(top_bit, -1, -1):
+        chunk = magnitude << bit
+        steps.append((chunk, ['if', ['>=', 'remainder', chunk],
+                              ['begin',
+                               ['assign', 'remainder', ['-', 'remainder', chunk]],
+                               ['assign', 'quotient',
+                                ['bitwise-or', 'quotient', 1 << bit]]]]))
+
+    if divisor > 0:
+        quotient = ['if', ['<', 'num', 0], ['-', 0, 'quotient'], 'quotient']
+        remainder = 'remainder'
+    else:
+        quotient = ['if', ['<', 'num', 0], 'quotient', ['-', 0, 'quotient']]
+        remainder = ['-', 0, 'remainder']
+
+    return ['function', DIVMOD_HELPER_PREFIX + str(divisor), ['num', 'getrem'],
+            ['let', [['remainder', ['if', ['<', 'num', 0], ['-', 0, 'num'], 'num']],
+                     ['quotient', 0]]]
+            + [['if', ['>=', 'remainder', magnitude],
+                ['begin'] + guard_divide_steps(steps)]]
+            + [['if', 'getrem', remainder, quotient]]]
+
+
+def create_divmod_helpers(program):
+    """Generate the divide helpers that the optimizer referenced.
+
+    Args:
+        program (List): Optimized top level forms.
+
+    Returns:
+        List of function definitions to append to the program.
+    """
+    symbols = set()
+    find_symbols(program, symbols)
+    divisors = sorted(int(symbol[len(DIVMOD_HELPER_PREFIX):])
+                      for symbol in symbols
+                      if symbol.startswith(DIVMOD_HELPER_PREFIX))
+    return [create_divmod_helper(divisor) for divisor in divisors]
+
+
+def optimize(expr):
+    """Optimize the program in S-Expression list format.
+
+    Perform transforms like constant folding, constant conditional folding,
+    and strength reduction to improve performance and reduce size.
+
+    Args:
+        expr (List): List containing the S-expr
+
+    Returns:
+        The optimized S-Expr.
+    """
+    if isinstance(expr, list) and len(expr) > 0:
+        if expr[0] == 'quote':
+            return expr  # Don't optimize quoted elements
+        else:
+            # Fold arithmetic expressions if possible
+            optimized_params = [optimize(subexpr) for subexpr in expr[1:]]
+            if not isinstance(expr[0], list) and \
+                    expr[0] in OPTIMIZE_BINOPS and \
+                    len(expr) == 3 and \
+                    isinstance(optimized_params[0], int) and \
+                    isinstance(optimized_params[1], int):
+                return make_legal_constant(
+                    OPTIMIZE_BINOPS[
+                        expr[0]](optimized_params[0], optimized_params[1]))
+
+            if not isinstance(expr[0], list) and expr[0] in OPTIMIZE_UOPS and \
+                    len(expr) == 2 and \
+                    isinstance(optimized_params[0], int):
+                return make_legal_constant(
+                    OPTIMIZE_UOPS[expr[0]](optimized_params[0]))
 
             # If any parameters are constant 0, the whole thing is zero
             if expr[0] == 'and':
@@ -1294,8 +2270,24 @@ def optimize(expr):
                     optimized_params[1], int) and is_power_of_two(
                         optimized_params[1]) and optimized_params[1] > 0 and (
                             expr[0] == '*' or expr[0] == '/'):
-                return ['lshift' if expr[0] == '*' else 'rshift',
-                        optimized_params[0], int(math.log(int(optimized_params[1]), 2))]
+                shift = int(math.log(int(optimized_params[1]), 2))
+                if expr[0] == '*':
+                    return ['lshift', optimized_params[0], shift]
+
+                return reduce_divide(optimized_params[0], shift)
+
+            # Strength reduction for multiplies and divides by other constants
+            if expr[0] == '*' and len(optimized_params) == 2:
+                reduced = reduce_multiply(*optimized_params)
+                if reduced is not None:
+                    return reduced
+
+            if (expr[0] == '/' or expr[0] == 'mod') and \
+                    len(optimized_params) == 2 and \
+                    isinstance(optimized_params[1], int) and \
+                    optimized_params[1] not in (0, -32768):
+                return [DIVMOD_HELPER_PREFIX + str(optimized_params[1]),
+                        optimized_params[0], 1 if expr[0] == 'mod' else 0]
 
             # Nothing to optimize, return the expression as is
             return [expr[0]] + optimized_params
@@ -1344,188 +2336,903 @@ def expand_cadr(expr):
         return expr
 
 #
-# For debugging
+# Peephole optimizer
+#
+# This cleans up redundant sequences produced by the code generator, looking
+# at a few instructions at a time. Each rule below is called with the index
+# of an instruction in the list produced by Function.unpack_instructions.
+# If it matches, it rewrites the list in place and returns an estimate
+# of the cycles saved each time that code runs. Otherwise it returns None.
 #
 
-# name, hasparam
-DISASM_TABLE = {
-    OP_NOP: ('nop', False),
-    OP_CALL: ('call', False),
-    OP_RETURN: ('return', False),
-    OP_CLEANUP: ('cleanup', True),
-    OP_POP: ('pop', False),
-    OP_ADD: ('add', False),
-    OP_SUB: ('sub', False),
-    OP_PUSH: ('push', True),
-    OP_LOAD: ('load', False),
-    OP_STORE: ('store', False),
-    OP_GETLOCAL: ('getlocal', True),
-    OP_SETLOCAL: ('setlocal', True),
-    OP_GOTO: ('goto', True),
-    OP_BFALSE: ('bfalse', True),
-    OP_REST: ('rest', False),
-    OP_RESERVE: ('reserve', True),
-    OP_GTR: ('gtr', False),
-    OP_GTE: ('gte', False),
-    OP_EQ: ('eq', False),
-    OP_NEQ: ('neq', False),
-    OP_DUP: ('dup', False),
-    OP_GETTAG: ('gettag', False),
-    OP_SETTAG: ('settag', False),
-    OP_AND: ('and', False),
-    OP_OR: ('or', False),
-    OP_XOR: ('xor', False),
-    OP_LSHIFT: ('lshift', False),
-    OP_RSHIFT: ('rshift', False),
-    OP_GETBP: ('getbp', False)
+# Number of clock cycles each instruction takes in lisp_core.v, if not 1.
+INSTRUCTION_CYCLES = {
+    OP_RETURN: 3,
+    OP_POP: 2,
+    OP_LOAD: 2,
+    OP_STORE: 2,
+    OP_ADD: 2,
+    OP_SUB: 2,
+    OP_REST: 2,
+    OP_GTR: 2,
+    OP_GTE: 2,
+    OP_EQ: 2,
+    OP_NEQ: 2,
+    OP_SETTAG: 2,
+    OP_AND: 2,
+    OP_OR: 2,
+    OP_XOR: 2,
+    OP_LSHIFT: 2,
+    OP_RSHIFT: 2,
+    OP_BFALSE: 2,
+    OP_GETLOCAL: 3
 }
 
 
-def disassemble(outfile, instructions, functions):
-    """Given binary instructions, convert back readable assembly format.
+def get_cycles(instructions):
+    return sum(INSTRUCTION_CYCLES.get(instr.opcode, 1) for instr in instructions)
 
-    This is useful for debugging.
 
-    Args:
-        outfile (File): file handle to write to
-        instructions (List<int>): a list of integers representing instruction values
-        functions (List): list of instruction start addresses, used to make the
-           output more readable.
-    """
-    next_function_start = functions[0].base_address
-    func_index = 0
+def match_opcodes(code, index, *opcodes):
+    """Check if the instructions at index have the given opcodes.
 
-    for pc, word in enumerate(instructions):
-        if pc == next_function_start:
-            outfile.write('\n{}:\n'.format(functions[func_index].name))
-            func_index += 1
-            if func_index == len(functions):
-                next_function_start = 0xffffffff
-            else:
-                next_function_start = functions[func_index].base_address
+    Labels are not skipped, so a match never spans a branch destination.
 
-        outfile.write('    {:04d}    '.format(pc))
-        opcode = (word >> 16) & 0x1f
-        name, has_param = DISASM_TABLE[opcode]
-        if has_param:
-            param_value = word & 0xffff
-            if param_value & 0x8000:
-                param_value = -(((param_value ^ 0xffff) + 1) & 0xffff)
+    Returns:
+        List of matching instructions, or None if they don't match.
+    """
+    end = index + len(opcodes)
+    if end > len(code):
+        return None
 
-            outfile.write('{} {}\n'.format(name, param_value))
-        else:
-            outfile.write('{}\n'.format(name))
+    for instr, opcode in zip(code[index:end], opcodes):
+        if instr.__class__ is not Instruction or instr.opcode != opcode:
+            return None
 
+    return code[index:end]
 
-def pretty_print_sexpr(listfile, expr, indent=0):
-    if isinstance(expr, list):
-        if len(expr) > 0 and expr[0] == 'function':
-            listfile.write('\n')
 
-        listfile.write('\n')
-        listfile.write('  ' * indent)
+def is_global_address(instr):
+    return instr.opcode == OP_PUSH and isinstance(instr.target, Symbol) and \
+        instr.target.type == Symbol.GLOBAL_VARIABLE
 
-        listfile.write('(')
-        for elem in expr:
-            if elem != expr[0]:
-                listfile.write(' ')
 
-            pretty_print_sexpr(listfile, elem, indent + 1)
+def find_label_destination(code, label):
+    """Return the index of the first instruction after label."""
+    index = code.index(label)
+    while index < len(code) and isinstance(code[index], Label):
+        index += 1
 
-        listfile.write(')')
-    else:
-        listfile.write(str(expr))
+    return index
 
 
-class MacroProcessor(object):
-    """Expand macros at compile time.
+def peephole_reload_local(code, index):
+    """Remove a read of a local variable that was just written.
 
-    The macro processor is a small lisp interpreter.
-    Evaluate macro expressions with their arguments as parameters, insert
-    the result into the expression list.
+    setlocal N; pop; getlocal N => setlocal N
     """
-    def __init__(self):
-        self.macro_list = {}
+    matched = match_opcodes(code, index, OP_SETLOCAL, OP_POP, OP_GETLOCAL)
+    if matched and matched[0].param == matched[2].param:
+        del code[index + 1:index + 3]
+        return get_cycles(matched[1:])
 
-    def expand_backquote(self, expr, env):
-        if isinstance(expr, list):
-            if expr[0] == 'unquote':
-                # This gets evaluated regularly
-                return self.eval(expr[1], env)
-            else:
-                return [self.expand_backquote(term, env) for term in expr]
-        else:
-            return expr
+    return None
 
-    def eval(self, expr, env):
-        if isinstance(expr, list):
-            function = expr[0]
-            if function == 'first':
-                return self.eval(expr[1], env)[0]
-            elif function == 'rest':
-                return self.eval(expr[1], env)[1]
-            elif function == 'if':        # (if test trueexpr falsexpr)
-                if self.eval(expr[1], env):
-                    return self.eval(expr[2], env)
-                elif len(expr) > 3:
-                    return self.eval(expr[3], env)
-                else:
-                    return 0
-            elif function == 'assign':    # (assign var value)
-                env[expr[1]] = self.eval(expr[2], env)
-            elif function == 'list':
-                return [self.eval(element, env) for element in expr[1:]]
-            elif function == 'quote':
-                return expr[1]
-            elif function == 'backquote':
-                return self.expand_backquote(expr[1], env)
-            elif function == 'cons':
-                return [self.eval(expr[1], env)] + [self.eval(expr[2], env)]
-            elif function in OPTIMIZE_BINOPS:
-                return OPTIMIZE_BINOPS[function](
-                    self.eval(
-                        expr[1], env), self.eval(
-                            expr[2], env))
-            elif function in self.macro_list:
-                # Invoke a sub-macro
-                new_env = copy.copy(env)
-                arg_list, body = self.macro_list[expr[0]]
-                for name, value in zip(arg_list, expr[1:]):
-                    new_env[name] = value
 
-                return self.eval(body, new_env)
-            else:
-                # Call a function. We can't really define functions yet, so
-                # stubbed out for now.
-                # Func is (function (arg arg arg) body)
-                function = env[expr[0]]
-                if function is None or not isinstance(function, list) or \
-                        function[0] != 'function':
-                    raise CompileError(
-                        'bad function call {} during macro expansion'
-                        .format(expr[0]))
-                for name, value in zip(function[0], expr[1:]):
-                    env[name] = self.eval(value, env)
+def peephole_reload_global(code, index):
+    """Remove a read of a global variable that was just written.
 
-                return self.eval(function[1], env)
-        elif isinstance(expr, int):
-            return expr
-        else:
-            return env[expr]
+    push G; store; pop; push G; load => push G; store
+    """
+    matched = match_opcodes(code, index, OP_PUSH, OP_STORE, OP_POP, OP_PUSH,
+                            OP_LOAD)
+    if matched and is_global_address(matched[0]) and \
+            matched[0].target is matched[3].target:
+        del code[index + 2:index + 5]
+        return get_cycles(matched[2:])
 
-    def macro_pre_process(self, program):
-        updated_program = []
-        for statement in program:
-            if isinstance(statement, list) and statement[0] == 'defmacro':
-                # (defmacro <name> (arg list) replace)
-                self.macro_list[statement[1]] = (statement[2], statement[3])
-            else:
-                updated_program.append(self.macro_expand_recursive(statement))
+    return None
 
-        return updated_program
 
-    def macro_expand_recursive(self, statement):
-        if isinstance(statement, list) and len(statement) > 0:
+def peephole_rewrite_local(code, index):
+    """Remove a write of the value that was just read.
+
+    getlocal N; setlocal N => getlocal N
+    """
+    matched = match_opcodes(code, index, OP_GETLOCAL, OP_SETLOCAL)
+    if matched and matched[0].param == matched[1].param:
+        del code[index + 1]
+        return get_cycles(matched[1:])
+
+    return None
+
+
+def peephole_discard(code, index):
+    """Remove values that are pushed, then immediately popped.
+
+    push X; pop =>
+    getlocal N; pop =>
+    dup; pop =>
+    push G; load; pop =>  (G is a global)
+    """
+    instr = code[index]
+    if not isinstance(instr, Instruction):
+        return None
+
+    if instr.opcode in (OP_PUSH, OP_GETLOCAL, OP_DUP):
+        length = 2 if match_opcodes(code, index + 1, OP_POP) else 0
+        if not length and is_global_address(instr) and \
+                match_opcodes(code, index + 1, OP_LOAD, OP_POP):
+            length = 3
+
+        if length:
+            cycles = get_cycles(code[index:index + length])
+            del code[index:index + length]
+            return cycles
+
+    return None
+
+
+def peephole_constant_branch(code, index):
+    """Resolve conditional branches on constants.
+
+    push 0; bfalse L => goto L
+    push <nonzero>; bfalse L =>
+    """
+    matched = match_opcodes(code, index, OP_PUSH, OP_BFALSE)
+    if not matched or matched[0].target is not None:
+        return None
+
+    if matched[0].param & 0xffff:
+        del code[index:index + 2]
+        return get_cycles(matched)
+
+    code[index:index + 2] = [Instruction(OP_GOTO, 0, matched[1].target)]
+    return get_cycles(matched) - 1
+
+
+def peephole_branch_to_next(code, index):
+    """Remove goto to the next instruction.
+
+    goto L; L: => L:
+    """
+    instr = code[index]
+    if not isinstance(instr, Instruction) or instr.opcode != OP_GOTO:
+        return None
+
+    next_index = index + 1
+    while next_index < len(code) and isinstance(code[next_index], Label):
+        if code[next_index] is instr.target:
+            del code[index]
+            return 1
+
+        next_index += 1
+
+    return None
+
+
+def peephole_goto_return(code, index):
+    """Return directly instead of branching to a return.
+
+    goto L; ... L: return => return; ... L: return
+    """
+    instr = code[index]
+    if not isinstance(instr, Instruction) or instr.opcode != OP_GOTO or \
+            not isinstance(instr.target, Label):
+        return None
+
+    if code[find_label_destination(code, instr.target)].opcode == OP_RETURN:
+        code[index] = Instruction(OP_RETURN)
+        return 1
+
+    return None
+
+
+def peephole_boolean_branch(code, index):
+    """Branch directly where a constant that feeds a bfalse would go.
+
+    compile_boolean_expression creates this when its result is tested:
+
+    push 1; goto L; ... L: bfalse M; N: => goto N; ... L: bfalse M; N:
+    push 0; goto L; ... L: bfalse M => goto M; ... L: bfalse M
+    """
+    matched = match_opcodes(code, index, OP_PUSH, OP_GOTO)
+    if not matched or matched[0].target is not None:
+        return None
+
+    branch_index = find_label_destination(code, matched[1].target)
+    branch = code[branch_index]
+    if branch.opcode != OP_BFALSE:
+        return None
+
+    if matched[0].param & 0xffff:
+        destination = code[branch_index + 1]
+        if not isinstance(destination, Label):
+            destination = Label()
+            destination.defined = True
+            code.insert(branch_index + 1, destination)
+            if branch_index < index:
+                index += 1
+    else:
+        destination = branch.target
+
+    code[index:index + 2] = [Instruction(OP_GOTO, 0, destination)]
+    return get_cycles(matched[:1] + [branch])
+
+
+def peephole_merge_cleanup(code, index):
+    """cleanup M; cleanup N => cleanup M+N"""
+    matched = match_opcodes(code, index, OP_CLEANUP, OP_CLEANUP)
+    if not matched or matched[0].param + matched[1].param > 32767:
+        return None
+
+    code[index:index + 2] = [Instruction(OP_CLEANUP, matched[0].param +
+                                         matched[1].param)]
+    return 1
+
+
+# Rules to try, indexed by the opcode of the first instruction they match.
+PEEPHOLE_RULES = {
+    OP_SETLOCAL: [peephole_reload_local],
+    OP_GETLOCAL: [peephole_rewrite_local, peephole_discard],
+    OP_PUSH: [peephole_reload_global, peephole_discard,
+              peephole_constant_branch, peephole_boolean_branch],
+    OP_DUP: [peephole_discard],
+    OP_GOTO: [peephole_branch_to_next, peephole_goto_return],
+    OP_CLEANUP: [peephole_merge_cleanup]
+}
+
+# Longest sequence a rule matches. After a rewrite, matching restarts this
+# far back, since removing instructions may have completed an earlier
+# pattern.
+PEEPHOLE_WINDOW = 5
+
+
+def remove_unused_labels(code, entry):
+    """Remove labels that nothing branches to.
+
+    They would otherwise split basic blocks and prevent peephole patterns
+    from matching.
+    """
+    referenced = {entry}
+    referenced.update(instr.target for instr in code
+                      if isinstance(instr, Instruction) and
+                      isinstance(instr.target, Label))
+    return [item for item in code if not isinstance(item, Label) or
+            item in referenced]
+
+
+def peephole_optimize(code, entry):
+    """Apply peephole rules until none match.
+
+    Args:
+        code (List<Instruction|Label>): from Function.unpack_instructions
+        entry (Label): function entry point, which must be kept.
+
+    Returns:
+        Tuple of (new code, estimated cycles saved)
+    """
+    cycles_saved = 0
+    code = remove_unused_labels(code, entry)
+    while True:
+        index = 0
+        while index < len(code):
+            item = code[index]
+            rules = () if item.__class__ is Label else \
+                PEEPHOLE_RULES.get(item.opcode, ())
+            for rule in rules:
+                cycles = rule(code, index)
+                if cycles is not None:
+                    cycles_saved += cycles
+                    index = max(index - PEEPHOLE_WINDOW, 0)
+                    break
+            else:
+                index += 1
+
+        # Rewrites may have removed the last reference to some labels.
+        # Removing them may allow more patterns to match.
+        old_length = len(code)
+        code = remove_unused_labels(code, entry)
+        if len(code) == old_length:
+            return code, cycles_saved
+
+#
+# Control flow graph
+#
+
+
+class BasicBlock(object):
+    """A sequence of instructions that is only entered at the top.
+
+    Attributes:
+        labels (List<Label>): labels that point to the first instruction.
+        instructions (List<Instruction>): contents. Only the last one may be
+            a branch or return.
+    """
+
+    def __init__(self):
+        self.labels = []
+        self.instructions = []
+
+    def branch_target(self):
+        """Label of the goto or bfalse that ends this block, or None."""
+        if self.instructions and \
+                self.instructions[-1].opcode in (OP_GOTO, OP_BFALSE):
+            return self.instructions[-1].target
+
+        return None
+
+    def falls_through(self):
+        """True if execution can continue into the next block in order."""
+        return not self.instructions or \
+            self.instructions[-1].opcode not in (OP_GOTO, OP_RETURN)
+
+
+def split_basic_blocks(code):
+    """Convert a list from Function.unpack_instructions into BasicBlocks."""
+    blocks = [BasicBlock()]
+    for item in code:
+        if isinstance(item, Label):
+            if blocks[-1].instructions:
+                blocks.append(BasicBlock())
+
+            blocks[-1].labels.append(item)
+        else:
+            blocks[-1].instructions.append(item)
+            if item.opcode in (OP_GOTO, OP_BFALSE, OP_RETURN):
+                blocks.append(BasicBlock())
+
+    return blocks
+
+
+def join_basic_blocks(blocks):
+    """Inverse of split_basic_blocks"""
+    code = []
+    for block in blocks:
+        code += block.labels
+        code += block.instructions
+
+    return code
+
+
+def count_instructions(code):
+    return sum(1 for item in code if isinstance(item, Instruction))
+
+
+def simplify_control_flow(code):
+    """Thread jump chains and remove unreachable basic blocks.
+
+    Code is unreachable after a goto or return that isn't a branch
+    destination, for example after a break, or the recursive tail call
+    in compile_function_call.
+
+    Args:
+        code (List<Instruction|Label>): from Function.unpack_instructions
+
+    Returns:
+        Tuple of (new code, instructions removed, estimated cycles saved)
+    """
+    blocks = split_basic_blocks(code)
+    label_blocks = {label: block for block in blocks for label in block.labels}
+
+    # If a branch goes to a block that only contains a goto, go directly
+    # to the final destination instead.
+    cycles_saved = 0
+    for block in blocks:
+        target = block.branch_target()
+        if target is None:
+            continue
+
+        visited = {target}
+        while True:
+            instructions = label_blocks[target].instructions
+            if len(instructions) != 1 or instructions[0].opcode != OP_GOTO or \
+                    instructions[0].target in visited:
+                break
+
+            target = instructions[0].target
+            visited.add(target)
+
+        if target is not block.branch_target():
+            block.instructions[-1].target = target
+            cycles_saved += 1
+
+    # Find all blocks that can be reached from the entry point
+    reachable = set()
+    worklist = [0]
+    block_index = {block: index for index, block in enumerate(blocks)}
+    while worklist:
+        index = worklist.pop()
+        if index in reachable or index == len(blocks):
+            continue
+
+        reachable.add(index)
+        block = blocks[index]
+        if block.falls_through():
+            worklist.append(index + 1)
+
+        if block.branch_target() is not None:
+            worklist.append(block_index[label_blocks[block.branch_target()]])
+
+    new_code = join_basic_blocks(block for index, block in enumerate(blocks)
+                                 if index in reachable)
+    return (new_code, count_instructions(code) - count_instructions(new_code),
+            cycles_saved)
+
+
+# Longest loop condition that rotate_loops will duplicate.
+MAX_ROTATED_CONDITION = 4
+
+# gtr and gte aren't here: the hardware compares by checking the sign of the
+# 16 bit difference, so not (a > b) isn't the same as (b >= a) when a - b is
+# 0x8000. There is also no branch if true, so the only other way to invert
+# them is to add instructions that cost more than the goto they would save.
+INVERTED_COMPARISONS = {
+    OP_EQ: OP_NEQ,
+    OP_NEQ: OP_EQ
+}
+
+
+def invert_condition(instructions):
+    """Create code that computes the opposite of a comparison.
+
+    Args:
+        instructions (List<Instruction>): code that leaves 1 on the stack
+            for true and 0 for false.
+
+    Returns:
+        List of new instructions, or None if this can't be done cheaply.
+        Only eq and neq, which are swapped, can be inverted (see
+        INVERTED_COMPARISONS).
+    """
+    if len(instructions) > MAX_ROTATED_CONDITION or not instructions or \
+            instructions[-1].opcode not in INVERTED_COMPARISONS:
+        return None
+
+    copied = [Instruction(instr.opcode, instr.param, instr.target)
+              for instr in instructions]
+    copied[-1].opcode = INVERTED_COMPARISONS[copied[-1].opcode]
+    return copied
+
+
+def rotate_loops(code):
+    """Move loop conditions to the bottom of the loop body.
+
+    compile_while creates this, which executes a goto every iteration:
+
+        top: <condition>; bfalse bottom
+        body: ...; goto top
+        bottom:
+
+    Branches take the same number of cycles whether they are taken or not,
+    so reordering blocks alone doesn't help. But if the condition is short
+    and can be inverted, the goto can be replaced with a copy of the test,
+    leaving the original as a guard for the first iteration:
+
+        top: <condition>; bfalse bottom
+        body: ...; <inverted condition>; bfalse body
+        bottom:
+
+    Returns:
+        Tuple of (new code, number of loops rotated)
+    """
+    blocks = split_basic_blocks(code)
+    label_blocks = {label: block for block in blocks for label in block.labels}
+    block_index = {block: index for index, block in enumerate(blocks)}
+    num_rotated = 0
+    for index, block in enumerate(blocks[:-1]):
+        if not block.instructions or block.instructions[-1].opcode != OP_GOTO:
+            continue
+
+        header = label_blocks[block.instructions[-1].target]
+        header_index = block_index[header]
+        if header_index > index or header.branch_target() is None or \
+                header.instructions[-1].opcode != OP_BFALSE or \
+                header.branch_target() not in blocks[index + 1].labels:
+            continue
+
+        condition = invert_condition(header.instructions[:-1])
+        if condition is None:
+            continue
+
+        body = blocks[header_index + 1]
+        if not body.labels:
+            new_label = Label()
+            new_label.defined = True
+            body.labels.append(new_label)
+
+        block.instructions[-1:] = condition + [Instruction(OP_BFALSE, 0,
+                                                           body.labels[0])]
+        num_rotated += 1
+
+    return join_basic_blocks(blocks), num_rotated
+
+
+def optimize_instructions(function):
+    """Apply instruction level optimizations to a function.
+
+    This must be called before Function.add_prologue and apply_fixups.
+    It records what it did in the function object, for the listing.
+
+    Args:
+        function (Function): function to optimize.
+    """
+    code = function.unpack_instructions()
+    old_size = len(function.instructions)
+    rotated_size = 0
+    for rotate in (False, True):
+        if rotate:
+            size = count_instructions(code)
+            code, function.loops_rotated = rotate_loops(code)
+            rotated_size = count_instructions(code) - size
+
+        while True:
+            code, cycles = peephole_optimize(code, function.entry)
+            function.peephole_cycles_saved += cycles
+            code, removed, cycles = simplify_control_flow(code)
+            function.unreachable_words_removed += removed
+            function.peephole_cycles_saved += cycles
+            if not removed and not cycles:
+                break
+
+    function.pack_instructions(code)
+    function.peephole_words_saved = old_size + rotated_size - \
+        len(function.instructions) - function.unreachable_words_removed
+
+# Change in the number of values on the stack for each instruction that
+# falls through to the next. Everything else leaves it unchanged. This
+# counts the top of stack (which is kept in a register), so on entry to a
+# function, when the return address is on top, the depth is 1.
+STACK_EFFECTS = {
+    OP_PUSH: 1,
+    OP_GETLOCAL: 1,
+    OP_DUP: 1,
+    OP_GETBP: 1,
+    OP_POP: -1,
+    OP_BFALSE: -1,
+    OP_STORE: -1,
+    OP_SETTAG: -1,
+    OP_ADD: -1,
+    OP_SUB: -1,
+    OP_GTR: -1,
+    OP_GTE: -1,
+    OP_EQ: -1,
+    OP_NEQ: -1,
+    OP_AND: -1,
+    OP_OR: -1,
+    OP_XOR: -1,
+    OP_LSHIFT: -1,
+    OP_RSHIFT: -1
+}
+
+# Words reserved for the stack if the maximum depth can't be determined.
+DEFAULT_STACK_SIZE = 1024
+
+# Stack depth at the start of main. lisp_core.v resets the stack pointer
+# four words below the frame pointer.
+MAIN_ENTRY_DEPTH = 5
+
+def find_frame_usage(function, function_addresses, entry_depth=1):
+    """Determine how much stack a function uses, not counting its callees.
+
+    This follows every path through the function's code, starting after
+    the call instruction, to find how many words are on the stack before
+    each instruction. It must be called after apply_fixups.
+
+    Args:
+        function (Function): function to analyze.
+        function_addresses (dict): address -> Function for every function.
+        entry_depth (int): stack depth when the function starts.
+
+    Returns:
+        Tuple of (max depth, calls, address taken), where calls is a list
+        of (stack depth at call, called Function or None if it isn't known)
+        and address taken is a list of Functions that are referenced in
+        some way other than being called directly.
+    """
+    code = function.prologue + function.instructions
+    function_refs = set()
+    base_address = function.base_address + len(function.prologue)
+    for pc, target in function.fixups:
+        if isinstance(target, Function) or (isinstance(target, Symbol) and
+                                            target.type == Symbol.FUNCTION):
+            function_refs.add(pc + len(function.prologue))
+
+    depths = {0: entry_depth}
+    to_visit = [0]
+    calls = []
+    address_taken = []
+    max_depth = entry_depth
+    while to_visit:
+        pc = to_visit.pop()
+        depth = depths[pc]
+        opcode = code[pc] >> 16
+        param = code[pc] & 0xffff
+        successors = [pc + 1]
+        if opcode == OP_RESERVE:
+            if param:
+                depth += param
+        elif opcode == OP_CLEANUP:
+            depth -= param
+        elif opcode == OP_CALL:
+            if pc - 1 in function_refs:
+                calls.append((depth, function_addresses[code[pc - 1] & 0xffff]))
+            else:
+                calls.append((depth, None))
+        elif opcode == OP_GOTO:
+            successors = [param - function.base_address]
+        elif opcode == OP_BFALSE:
+            successors.append(param - function.base_address)
+        elif opcode == OP_RETURN:
+            successors = []
+
+        if pc in function_refs and (pc + 1 == len(code) or
+                                    code[pc + 1] >> 16 != OP_CALL):
+            address_taken.append(function_addresses[param])
+
+        depth += STACK_EFFECTS.get(opcode, 0)
+        max_depth = max(max_depth, depth)
+        for successor in successors:
+            # Main falls off the end after calling halt
+            if successor < len(code) and successor not in depths:
+                depths[successor] = depth
+                to_visit.append(successor)
+
+    return max_depth, calls, address_taken
+
+
+def find_stack_depth(functions):
+    """Compute the most stack space the program can use.
+
+    This combines the usage of each function with that of the functions it
+    calls. A call through a variable could go to any function whose address
+    is used as a value. A tail call that reuses the current frame
+    (Compiler.compile_tail_call) needs as much space as the called
+    function. The depth of each function is stored in its stack_depth
+    field.
+
+    Args:
+        functions (List<Function>): all functions in the program, with
+            fixups applied. The first one is main.
+
+    Returns:
+        Tuple of (depth, recursive function names). depth is the number
+        of words below main's frame pointer that can be used, or None
+        if some function that can be called is recursive.
+    """
+    function_addresses = {function.base_address: function for function in functions}
+    usage = {}
+    indirect_callees = set()
+    for function in functions:
+        usage[function] = find_frame_usage(
+            function, function_addresses,
+            MAIN_ENTRY_DEPTH if function is functions[0] else 1)
+        indirect_callees.update(usage[function][2])
+
+    recursive = set()
+    active = []
+
+    def visit(function):
+        if function in active:
+            recursive.update(active[active.index(function):])
+            return 0
+
+        if function.stack_depth is not None:
+            return function.stack_depth
+
+        active.append(function)
+        depth, calls, _ = usage[function]
+        for call_depth, callee in calls:
+            for target in [callee] if callee else indirect_callees:
+                depth = max(depth, call_depth + visit(target))
+
+        for sym in function.tail_calls:
+            for target in [sym.function] if sym else indirect_callees:
+                depth = max(depth, visit(target))
+
+        active.pop()
+        function.stack_depth = depth
+        return depth
+
+    depth = visit(functions[0])
+    if recursive:
+        return None, sorted(set(function.name for function in recursive))
+
+    return depth, []
+
+#
+# For debugging
+#
+
+# name, hasparam
+DISASM_TABLE = {
+    OP_NOP: ('nop', False),
+    OP_CALL: ('call', False),
+    OP_RETURN: ('return', False),
+    OP_CLEANUP: ('cleanup', True),
+    OP_POP: ('pop', False),
+    OP_ADD: ('add', False),
+    OP_SUB: ('sub', False),
+    OP_PUSH: ('push', True),
+    OP_LOAD: ('load', False),
+    OP_STORE: ('store', False),
+    OP_GETLOCAL: ('getlocal', True),
+    OP_SETLOCAL: ('setlocal', True),
+    OP_GOTO: ('goto', True),
+    OP_BFALSE: ('bfalse', True),
+    OP_REST: ('rest', False),
+    OP_RESERVE: ('reserve', True),
+    OP_GTR: ('gtr', False),
+    OP_GTE: ('gte', False),
+    OP_EQ: ('eq', False),
+    OP_NEQ: ('neq', False),
+    OP_DUP: ('dup', False),
+    OP_GETTAG: ('gettag', False),
+    OP_SETTAG: ('settag', False),
+    OP_AND: ('and', False),
+    OP_OR: ('or', False),
+    OP_XOR: ('xor', False),
+    OP_LSHIFT: ('lshift', False),
+    OP_RSHIFT: ('rshift', False),
+    OP_GETBP: ('getbp', False)
+}
+
+
+def disassemble(outfile, instructions, functions):
+    """Given binary instructions, convert back readable assembly format.
+
+    This is useful for debugging.
+
+    Args:
+        outfile (File): file handle to write to
+        instructions (List<int>): a list of integers representing instruction values
+        functions (List): list of instruction start addresses, used to make the
+           output more readable.
+    """
+    next_function_start = functions[0].base_address
+    func_index = 0
+
+    for pc, word in enumerate(instructions):
+        if pc == next_function_start:
+            function = functions[func_index]
+            outfile.write('\n{}:\n'.format(function.name))
+            if function.num_local_variables_before_reuse:
+                outfile.write('    ; {} local slots ({} before reuse)\n'.format(
+                    function.num_local_variables,
+                    function.num_local_variables_before_reuse))
+
+            func_index += 1
+            if func_index == len(functions):
+                next_function_start = 0xffffffff
+            else:
+                next_function_start = functions[func_index].base_address
+
+        outfile.write('    {:04d}    '.format(pc))
+        opcode = (word >> 16) & 0x1f
+        name, has_param = DISASM_TABLE[opcode]
+        if has_param:
+            param_value = word & 0xffff
+            if param_value & 0x8000:
+                param_value = -(((param_value ^ 0xffff) + 1) & 0xffff)
+
+            outfile.write('{} {}\n'.format(name, param_value))
+        else:
+            outfile.write('{}\n'.format(name))
+
+
+def pretty_print_sexpr(listfile, expr, indent=0):
+    if isinstance(expr, list):
+        if len(expr) > 0 and expr[0] == 'function':
+            listfile.write('\n')
+
+        listfile.write('\n')
+        listfile.write('  ' * indent)
+
+        listfile.write('(')
+        for elem in expr:
+            if elem != expr[0]:
+                listfile.write(' ')
+
+            pretty_print_sexpr(listfile, elem, indent + 1)
+
+        listfile.write(')')
+    else:
+        listfile.write(str(expr))
+
+
+class MacroProcessor(object):
+    """Expand macros at compile time.
+
+    The macro processor is a small lisp interpreter.
+    Evaluate macro expressions with their arguments as parameters, insert
+    the result into the expression list.
+    """
+    def __init__(self):
+        self.macro_list = {}
+
+    def expand_backquote(self, expr, env):
+        if isinstance(expr, list):
+            if expr[0] == 'unquote':
+                # This gets evaluated regularly
+                return self.eval(expr[1], env)
+            else:
+                return [self.expand_backquote(term, env) for term in expr]
+        else:
+            return expr
+
+    def eval(self, expr, env):
+        if isinstance(expr, list):
+            function = expr[0]
+            if function == 'first':
+                return self.eval(expr[1], env)[0]
+            elif function == 'rest':
+                return self.eval(expr[1], env)[1]
+            elif function == 'if':        # (if test trueexpr falsexpr)
+                if self.eval(expr[1], env):
+                    return self.eval(expr[2], env)
+                elif len(expr) > 3:
+                    return self.eval(expr[3], env)
+                else:
+                    return 0
+            elif function == 'assign':    # (assign var value)
+                env[expr[1]] = self.eval(expr[2], env)
+            elif function == 'list':
+                return [self.eval(element, env) for element in expr[1:]]
+            elif function == 'quote':
+                return expr[1]
+            elif function == 'backquote':
+                return self.expand_backquote(expr[1], env)
+            elif function == 'cons':
+                return [self.eval(expr[1], env)] + [self.eval(expr[2], env)]
+            elif function in OPTIMIZE_BINOPS:
+                return OPTIMIZE_BINOPS[function](
+                    self.eval(
+                        expr[1], env), self.eval(
+                            expr[2], env))
+            elif function in self.macro_list:
+                # Invoke a sub-macro
+                new_env = copy.copy(env)
+                arg_list, body = self.macro_list[expr[0]]
+                for name, value in zip(arg_list, expr[1:]):
+                    new_env[name] = value
+
+                return self.eval(body, new_env)
+            else:
+                # Call a function. We can't really define functions yet, so
+                # stubbed out for now.
+                # Func is (function (arg arg arg) body)
+                function = env[expr[0]]
+                if function is None or not isinstance(function, list) or \
+                        function[0] != 'function':
+                    raise CompileError(
+                        'bad function call {} during macro expansion'
+                        .format(expr[0]))
+                for name, value in zip(function[0], expr[1:]):
+                    env[name] = self.eval(value, env)
+
+                return self.eval(function[1], env)
+        elif isinstance(expr, int):
+            return expr
+        else:
+            return env[expr]
+
+    @staticmethod
+    def is_macro_definition(statement):
+        return isinstance(statement, list) and statement[0] == 'defmacro'
+
+    def macro_pre_process(self, program):
+        updated_program = []
+        for statement in program:
+            if self.is_macro_definition(statement):
+                # (defmacro <name> (arg list) replace)
+                self.macro_list[statement[1]] = (statement[2], statement[3])
+            else:
+                updated_program.append(self.macro_expand_recursive(statement))
+
+        return updated_program
+
+    def macro_expand_recursive(self, statement):
+        if isinstance(statement, list) and len(statement) > 0:
             if not isinstance(statement[0], list) and statement[
                     0] in self.macro_list:
                 # This is a macro form. Evalute the macro now and replace this form with
@@ -1539,18 +3246,1231 @@ class MacroProcessor(object):
                     for arg in statement[1:]:
                         print(arg)
 
-                env = {}
-                for name, value in zip(arg_names, statement[1:]):
-                    env[name] = self.macro_expand_recursive(value)
+                env = {}
+                for name, value in zip(arg_names, statement[1:]):
+                    env[name] = self.macro_expand_recursive(value)
+
+                return self.eval(body, env)
+            else:
+                return [self.macro_expand_recursive(
+                    term) for term in statement]
+        else:
+            return statement
+
+LITERAL_NAMES = {
+    'nil': 0,
+    'false': 0,
+    'true': 1
+}
+
+
+class ConstantPropagator(object):
+    """Replace references to constant global variables with their values.
+
+    A global is constant if it is defined with (defconstant name value), or
+    if it is only assigned once, by a top level (assign name value), where
+    the value is a literal (after folding). In the latter case, no earlier
+    top level code may read it, directly or through a function call, since
+    that would have seen the value before the assignment. A global defined
+    with (defvar name value) is never constant; the definition becomes an
+    assign.
 
-                return self.eval(body, env)
+    References become literals, which the optimizer can fold further.
+    The definitions are removed, so constants don't take up a global
+    variable slot.
+    """
+
+    def __init__(self):
+        self.constants = {}     # name -> value
+
+    def process(self, program):
+        """Find constants and substitute them.
+
+        Args:
+            program (List): top level S-Exprs
+
+        Returns:
+            The transformed list of S-Exprs
+        """
+        functions = {}
+        assign_counts = {}
+        variables = set()
+        for statement in program:
+            if is_function_definition(statement):
+                functions[statement[1]] = statement[3:]
+            elif isinstance(statement, list) and statement and \
+                    statement[0] == 'defconstant':
+                self.add_definition(statement)
+            elif isinstance(statement, list) and statement and \
+                    statement[0] == 'defvar':
+                # (defvar name value)
+                if len(statement) != 3 or not isinstance(statement[1], str):
+                    raise CompileError('bad defvar', get_location(statement))
+
+                variables.add(statement[1])
+
+            self.count_assignments(statement, assign_counts)
+
+        # Globals that are read by each function, directly or indirectly.
+        references = {}
+        for name in functions:
+            visited = set()
+            to_visit = [name]
+            while to_visit:
+                function_name = to_visit.pop()
+                if function_name not in visited:
+                    visited.add(function_name)
+                    symbols = set()
+                    find_symbols(functions[function_name], symbols)
+                    references.setdefault(name, set()).update(symbols)
+                    to_visit.extend(symbols.intersection(functions))
+
+        used_earlier = set()
+        for statement in program:
+            if not isinstance(statement, list) or not statement or \
+                    statement[0] in ('function', 'defconstant'):
+                continue
+
+            if statement[0] == 'assign' and len(statement) == 3:
+                name = statement[1]
+                value = self.get_literal_value(statement[2])
+                if value is not None and assign_counts.get(name) == 1 and \
+                        name not in used_earlier and name not in functions \
+                        and name not in variables:
+                    self.constants[name] = value
+
+            symbols = set()
+            find_symbols(statement, symbols)
+            used_earlier.update(symbols)
+            for function_name in symbols.intersection(functions):
+                used_earlier.update(references[function_name])
+
+        new_program = []
+        for statement in program:
+            if isinstance(statement, list) and statement and \
+                    (statement[0] == 'defconstant' or
+                     (statement[0] == 'assign' and
+                      statement[1] in self.constants)):
+                continue    # Remove definition
+
+            if isinstance(statement, list) and statement and \
+                    statement[0] == 'defvar':
+                statement = SourceForm(['assign'] + statement[1:],
+                                       get_location(statement))
+
+            new_statement = self.substitute(statement, frozenset())
+            if isinstance(new_statement, list):
+                new_statement = SourceForm(new_statement,
+                                           get_location(statement))
+
+            new_program.append(new_statement)
+
+        return new_program
+
+    def add_definition(self, statement):
+        # (defconstant name value)
+        if len(statement) != 3 or not isinstance(statement[1], str):
+            raise CompileError('bad defconstant', get_location(statement))
+
+        value = self.get_literal_value(self.substitute(statement[2],
+                                                       frozenset()))
+        if value is None:
+            raise CompileError('value of constant {} is not constant'
+                               .format(statement[1]), get_location(statement))
+
+        if statement[1] in self.constants:
+            raise CompileError('constant {} redefined'.format(statement[1]),
+                               get_location(statement))
+
+        self.constants[statement[1]] = value
+
+    @staticmethod
+    def get_literal_value(expr):
+        expr = optimize(expr)
+        if isinstance(expr, int):
+            return expr
+        elif isinstance(expr, str) and expr in LITERAL_NAMES:
+            return LITERAL_NAMES[expr]
+        else:
+            return None
+
+    def count_assignments(self, expr, assign_counts):
+        if isinstance(expr, list) and expr and expr[0] != 'quote':
+            if expr[0] == 'assign':
+                assign_counts[expr[1]] = assign_counts.get(expr[1], 0) + 1
+
+            for subexpr in expr:
+                self.count_assignments(subexpr, assign_counts)
+
+    def substitute(self, expr, scope):
+        """Replace constant references in expr with their values.
+
+        Args:
+            expr (List|str|int): S-Expression
+            scope (frozenset): names of local variables visible here, which
+                hide globals with the same name.
+
+        Returns:
+            New S-Expression
+        """
+        if isinstance(expr, str):
+            if expr in self.constants and expr not in scope:
+                return self.constants[expr]
+
+            return expr
+        elif not isinstance(expr, list) or not expr or expr[0] == 'quote':
+            return expr
+        elif expr[0] == 'function':
+            if isinstance(expr[1], str):
+                # Named function (name (params) body...)
+                return expr[:3] + [self.substitute(subexpr, scope.union(expr[2]))
+                                   for subexpr in expr[3:]]
             else:
-                return [self.macro_expand_recursive(
-                    term) for term in statement]
+                # Anonymous function
+                return expr[:2] + [self.substitute(subexpr, scope.union(expr[1]))
+                                   for subexpr in expr[2:]]
+        elif expr[0] == 'let':
+            # As in Compiler.compile_let, each variable is visible when
+            # computing its initial value.
+            bindings = []
+            for variable, value in expr[1]:
+                scope = scope.union([variable])
+                bindings.append([variable, self.substitute(value, scope)])
+
+            return ['let', bindings] + [self.substitute(subexpr, scope)
+                                        for subexpr in expr[2:]]
+        elif expr[0] == 'assign':
+            if expr[1] in self.constants and expr[1] not in scope:
+                raise CompileError('cannot assign constant {}'.format(expr[1]),
+                                   get_location(expr))
+
+            return expr[:2] + [self.substitute(subexpr, scope)
+                               for subexpr in expr[2:]]
+        elif expr[0] == 'if':
+            # If the condition is now constant, drop the branch that can't
+            # be taken. optimize would also do this, but only after the
+            # Inliner has decided which functions are small enough.
+            test = self.substitute(expr[1], scope)
+            if isinstance(test, int):
+                if test:
+                    return self.substitute(expr[2], scope)
+                elif len(expr) > 3:
+                    return self.substitute(expr[3], scope)
+                else:
+                    return 0
+
+            return ['if', test] + [self.substitute(subexpr, scope)
+                                   for subexpr in expr[2:]]
         else:
-            return statement
+            return [self.substitute(subexpr, scope) for subexpr in expr]
+
+
+# Largest function body (counted in atoms) that will be inlined at every
+# call site.
+DEFAULT_INLINE_LIMIT = 12
+
+
+def expression_size(expr):
+    """Number of atoms in an S-Expression"""
+    if isinstance(expr, list):
+        return sum(expression_size(subexpr) for subexpr in expr)
+    else:
+        return 1
+
+
+def find_symbols(expr, symbols):
+    """Add all identifiers referenced in an S-Expression to a set.
+
+    This doesn't account for scoping, so it may find more than are
+    actually referenced.
+    """
+    if isinstance(expr, list):
+        if expr and expr[0] == 'quote':
+            return
+
+        for subexpr in expr:
+            find_symbols(subexpr, symbols)
+    elif isinstance(expr, str):
+        symbols.add(expr)
+
+
+def has_stray_break(expr):
+    """True if expr contains a break that isn't inside a while loop in expr."""
+    if not isinstance(expr, list) or not expr or expr[0] in ('quote', 'while'):
+        return False
+    elif expr[0] == 'break':
+        return True
+    else:
+        return any(has_stray_break(subexpr) for subexpr in expr)
+
+
+class CallGraph(object):
+    """Determine which named functions may end up calling each other.
+
+    A call through a variable could go to any function whose name is used
+    as a value, or to any anonymous function, so those are all treated as
+    possible callees. All anonymous functions are lumped together under
+    one name. Like find_symbols, this ignores scoping, so it may find calls
+    that can't happen, but never misses one.
+    """
+
+    ANONYMOUS = '<anonymous function>'
+    NON_CALL_FORMS = {'function', 'begin', 'while', 'break', 'if', 'assign',
+                      'quote', 'list', 'let', 'getbp', 'and', 'or', 'not'}
+
+    def __init__(self, program):
+        """
+        Args:
+            program (List): top level S-Exprs
+        """
+        self.callees = {self.ANONYMOUS: set()}  # name -> direct callees
+        for statement in program:
+            if is_function_definition(statement):
+                self.callees[statement[1]] = set()
+
+        self.indirect_callers = set()   # Functions that call through variables
+        self.escaping = {self.ANONYMOUS}  # Functions that are used as values
+        for statement in program:
+            if is_function_definition(statement):
+                for subexpr in statement[3:]:
+                    self.scan(subexpr, statement[1])
+            else:
+                self.scan(statement, None)
+
+    def scan(self, expr, caller):
+        if isinstance(expr, list):
+            if not expr or expr[0] == 'quote':
+                return
+
+            head = expr[0]
+            if head == 'function':
+                for subexpr in expr[2:]:
+                    self.scan(subexpr, self.ANONYMOUS)
+            elif head == 'let':
+                for _, value in expr[1]:
+                    self.scan(value, caller)
+
+                for subexpr in expr[2:]:
+                    self.scan(subexpr, caller)
+            else:
+                if not isinstance(head, str):
+                    self.add_indirect_caller(caller)
+                    self.scan(head, caller)
+                elif head in self.callees:
+                    if caller is not None:
+                        self.callees[caller].add(head)
+                elif head not in self.NON_CALL_FORMS and \
+                        head not in Compiler.PRIMITIVES:
+                    self.add_indirect_caller(caller)
+
+                for subexpr in expr[1:]:
+                    self.scan(subexpr, caller)
+        elif isinstance(expr, str) and expr in self.callees:
+            self.escaping.add(expr)
+
+    def add_indirect_caller(self, caller):
+        if caller is not None:
+            self.indirect_callers.add(caller)
+
+    def may_recurse(self, caller, callee):
+        """Check if calling a function could lead back to the caller.
+
+        Args:
+            caller (str): name of the function containing the call.
+            callee (str): name of the function being called.
+
+        Returns:
+            True if callee may directly or indirectly call caller, or if
+            either isn't a named function.
+        """
+        if caller not in self.callees or callee not in self.callees:
+            return True
+
+        visited = set()
+        to_visit = [callee]
+        while to_visit:
+            name = to_visit.pop()
+            if name not in visited:
+                visited.add(name)
+                to_visit.extend(self.callees[name])
+                if name in self.indirect_callers:
+                    to_visit.extend(self.escaping)
+
+        return caller in visited
+
+
+class ClosureAnalysis(object):
+    """Find which calls through variables can only call a closure, or can
+    never call one.
+
+    Calling a value that isn't a named function normally checks its tag at
+    runtime to see if it is a closure (see Compiler.compile_callee). This
+    tracks the kinds of values that flow into each variable: an anonymous
+    function is a closure only if it has free variables, and function names,
+    numbers, and lists are never closures. A parameter of a named function
+    gets the values of the arguments at every direct call, unless the
+    function is used as a value (so it may be called with anything).
+    Named functions also propagate the kinds of their return values.
+    Anything else, like the result of a primitive or of a call through a
+    variable, may be either. The kinds only ever grow, so this repeats
+    until nothing changes.
+
+    Variables are tracked per declaration, following the same scoping as
+    lookup_symbol. Calls are identified by the S-expr list itself, so this
+    must run on the same lists the compiler compiles. Calls that the
+    compiler adds itself (such as to cons) aren't seen, which is fine as
+    long as those functions don't call their parameters.
+    """
+
+    CLOSURE = 1
+    NOT_CLOSURE = 2
+    UNKNOWN = CLOSURE | NOT_CLOSURE
+
+    def __init__(self, program, call_graph):
+        """
+        Args:
+            program (List): top level S-Exprs
+            call_graph (CallGraph): used to find functions that escape.
+        """
+        self.functions = {}         # name -> definition S-expr
+        for statement in program:
+            if is_function_definition(statement):
+                self.functions[statement[1]] = statement
+
+        # Key -> kind bits. Keys are (id of declaring form, name) for local
+        # variables, the name for globals, and ('return', name) for the
+        # return value of a named function.
+        self.kinds = {}
+        self.callee_kinds = {}      # id of call S-expr -> kind bits
+        for name, definition in self.functions.items():
+            if name in call_graph.escaping:
+                for param in definition[2]:
+                    self.kinds[(id(definition), param)] = self.UNKNOWN
+
+        self.changed = True
+        while self.changed:
+            self.changed = False
+            for statement in program:
+                if is_function_definition(statement):
+                    params = {param: (id(statement), param)
+                              for param in statement[2]}
+                    kind = self.scan_sequence(statement[3:], [(0, params)], [])
+                    self.merge(('return', statement[1]), kind)
+                else:
+                    self.scan(statement, [(0, {})], [])
+
+    def get_callee_kind(self, expr):
+        """Determine what a call through a variable may call.
+
+        Args:
+            expr (List): the function call S-expr
+
+        Returns:
+            CLOSURE, NOT_CLOSURE, or UNKNOWN
+        """
+        return self.callee_kinds.get(id(expr)) or self.UNKNOWN
+
+    def merge(self, key, kind):
+        old_kind = self.kinds.get(key, 0)
+        if old_kind | kind != old_kind:
+            self.kinds[key] = old_kind | kind
+            self.changed = True
+
+    @staticmethod
+    def resolve(name, scopes, lambdas):
+        """Find the key of the local variable that a name refers to.
+
+        If the variable is declared outside the anonymous function being
+        scanned, this marks the function (and any between) as having free
+        variables.
+
+        Args:
+            name (str): variable name
+            scopes (List): (function depth, dict of name -> key) for each
+                scope, innermost last.
+            lambdas (List): [has free variables] for each anonymous
+                function being scanned, innermost last.
+
+        Returns:
+            Key, or None if this is not a local variable.
+        """
+        for depth, variables in reversed(scopes):
+            if name in variables:
+                for has_free_variables in lambdas[depth:]:
+                    has_free_variables[0] = True
+
+                return variables[name]
+
+        return None
+
+    def get_variable_kind(self, name, scopes, lambdas):
+        key = self.resolve(name, scopes, lambdas)
+        if key is None:
+            if name in self.functions:
+                return self.NOT_CLOSURE
+
+            key = name
+
+        return self.kinds.get(key, 0)
+
+    def scan_sequence(self, sequence, scopes, lambdas):
+        kind = self.NOT_CLOSURE     # Empty sequence is nil
+        for expr in sequence:
+            kind = self.scan(expr, scopes, lambdas)
+
+        return kind
+
+    def scan(self, expr, scopes, lambdas):
+        """Walk an expression, updating the kinds of variables it assigns.
+
+        Returns:
+            Kind bits for the value of the expression.
+        """
+        if isinstance(expr, int):
+            return self.NOT_CLOSURE
+        elif isinstance(expr, str):
+            if expr[0] == '"' or expr in ('nil', 'true', 'false'):
+                return self.NOT_CLOSURE
+
+            return self.get_variable_kind(expr, scopes, lambdas)
+        elif not expr or expr[0] in ('quote', 'getbp'):
+            return self.NOT_CLOSURE
+
+        head = expr[0]
+        if head == 'function':
+            params = {param: (id(expr), param) for param in expr[1]}
+            for key in params.values():
+                self.merge(key, self.UNKNOWN)
+
+            has_free_variables = [False]
+            self.scan_sequence(expr[2:], scopes + [(len(lambdas) + 1, params)],
+                               lambdas + [has_free_variables])
+            return self.CLOSURE if has_free_variables[0] else self.NOT_CLOSURE
+        elif head == 'let':
+            # Like compile_let, each variable is in scope for its own
+            # initializer and the ones after it.
+            variables = {}
+            inner_scopes = scopes + [(len(lambdas), variables)]
+            for name, value in expr[1]:
+                variables[name] = (id(expr), name)
+                self.merge(variables[name],
+                           self.scan(value, inner_scopes, lambdas))
+
+            return self.scan_sequence(expr[2:], inner_scopes, lambdas)
+        elif head == 'begin':
+            return self.scan_sequence(expr[1:], scopes, lambdas)
+        elif head == 'if':
+            self.scan(expr[1], scopes, lambdas)
+            kind = self.scan(expr[2], scopes, lambdas)
+            if len(expr) > 3:
+                return kind | self.scan(expr[3], scopes, lambdas)
+
+            return kind | self.NOT_CLOSURE
+        elif head == 'assign':
+            kind = self.scan(expr[2], scopes, lambdas)
+            key = self.resolve(expr[1], scopes, lambdas)
+            self.merge(expr[1] if key is None else key, kind)
+            return kind
+
+        arg_kinds = [self.scan(subexpr, scopes, lambdas)
+                     for subexpr in expr[1:]]
+        if not isinstance(head, str):
+            pass
+        elif head in ('list', 'and', 'or', 'not'):
+            return self.NOT_CLOSURE
+        elif head in ('while', 'break') or head in Compiler.PRIMITIVES:
+            return self.UNKNOWN
+        elif head in self.functions and \
+                self.resolve(head, scopes, lambdas) is None:
+            definition = self.functions[head]
+            for index, param in enumerate(definition[2]):
+                self.merge((id(definition), param),
+                           arg_kinds[index] if index < len(arg_kinds)
+                           else self.UNKNOWN)
+
+            return self.kinds.get(('return', head), 0)
+
+        # Call through a variable
+        self.callee_kinds[id(expr)] = self.scan(head, scopes, lambdas)
+        return self.UNKNOWN
+
+
+class Inliner(object):
+    """Replace calls to named functions with the body of the function.
+
+    This avoids the overhead of pushing arguments, call, return, and cleanup.
+    A function is inlined at a call site if it is small enough (size_limit),
+    or if that is the only place it is used. The call becomes a let that
+    binds the arguments to the parameters, followed by the body:
+
+        (function foo (a b) (+ a b))
+        (foo 1 x) => (let ((b|2 x)) (+ 1 b|2))
+
+    Variables declared in the inlined code are given new names that can't
+    conflict with anything in the program ('|' can't appear in an
+    identifier read by the parser), so neither the arguments nor the
+    body can capture each other's variables. Arguments are evaluated in the
+    same order as a call (right to left). Parameters that are passed
+    constants and not modified are replaced with the constant, so the
+    optimizer can fold it.
+
+    Functions are not inlined if they are recursive (directly or through
+    other functions), which also means the self tail call optimization in
+    Compiler.compile_function_call applies the same as before. Functions
+    that use getbp or break outside of their own loop aren't inlined, since
+    those behave differently in another frame. A call is also not inlined
+    if a local variable at the call site hides the function or any global
+    the body uses, since lookup_symbol would find the wrong variable.
+    """
+
+    def __init__(self, size_limit=DEFAULT_INLINE_LIMIT):
+        self.size_limit = size_limit
+        self.functions = {}         # name -> (params, body)
+        self.num_calls = {}         # name -> number of direct calls
+        self.num_references = {}    # name -> number of non call uses
+        self.inlinable = set()
+        self.expanded_bodies = {}   # name -> body with inlining applied
+        self.next_id = 0
+        self.num_inlined = 0
+
+    def analyze(self, program):
+        """Find the functions in the program and how they are used.
+
+        This must be called before inline_statement.
+
+        Args:
+            program (List): top level S-Exprs
+        """
+        for statement in program:
+            if is_function_definition(statement):
+                self.functions[statement[1]] = (statement[2], statement[3:])
+
+        for name in self.functions:
+            self.num_calls[name] = 0
+            self.num_references[name] = 0
+
+        for statement in program:
+            self.count_references(statement)
+
+        self.find_inlinable_functions()
+
+    def inline_statement(self, statement):
+        """Return a top level form with calls in it inlined."""
+        if is_function_definition(statement):
+            return statement[:3] + self.get_expanded_body(statement[1])
+        else:
+            return self.expand(statement, frozenset())
+
+    def count_references(self, expr):
+        if isinstance(expr, list):
+            if not expr or expr[0] == 'quote':
+                return
+
+            if isinstance(expr[0], str) and expr[0] in self.functions:
+                self.num_calls[expr[0]] += 1
+                params = expr[1:]
+            else:
+                params = expr
+
+            for subexpr in params:
+                self.count_references(subexpr)
+        elif isinstance(expr, str) and expr in self.functions:
+            self.num_references[expr] += 1
+
+    def find_inlinable_functions(self):
+        callees = {}
+        for name, (params, body) in self.functions.items():
+            symbols = set()
+            find_symbols(body, symbols)
+            callees[name] = symbols.intersection(self.functions)
+
+        for name, (params, body) in self.functions.items():
+            # Check if this is recursive
+            visited = set()
+            to_visit = list(callees[name])
+            while to_visit:
+                callee = to_visit.pop()
+                if callee not in visited:
+                    visited.add(callee)
+                    to_visit.extend(callees[callee])
+
+            symbols = set()
+            find_symbols(body, symbols)
+            if name not in visited and 'getbp' not in symbols and \
+                    not has_stray_break(body):
+                self.inlinable.add(name)
+
+    def get_expanded_body(self, name):
+        """Return the body of a function, with calls in it inlined."""
+        if name not in self.expanded_bodies:
+            params, body = self.functions[name]
+            scope = frozenset(params)
+            self.expanded_bodies[name] = [self.expand(expr, scope)
+                                          for expr in body]
+
+        return self.expanded_bodies[name]
+
+    def expand(self, expr, scope):
+        """Inline calls in an expression.
 
-def compile_program(files):
+        Args:
+            expr (List|str|int): S-Expression
+            scope (frozenset): names of local variables visible here.
+
+        Returns:
+            New S-Expression
+        """
+        if not isinstance(expr, list) or not expr or expr[0] == 'quote':
+            return expr
+        elif expr[0] == 'function':
+            # Anonymous function
+            inner_scope = scope.union(expr[1])
+            return expr[:2] + [self.expand(subexpr, inner_scope)
+                               for subexpr in expr[2:]]
+        elif expr[0] == 'let':
+            # As in Compiler.compile_let, each variable is visible when
+            # computing its initial value.
+            bindings = []
+            for variable, value in expr[1]:
+                scope = scope.union([variable])
+                bindings.append([variable, self.expand(value, scope)])
+
+            return ['let', bindings] + [self.expand(subexpr, scope)
+                                        for subexpr in expr[2:]]
+        elif expr[0] == 'assign':
+            return expr[:2] + [self.expand(subexpr, scope)
+                               for subexpr in expr[2:]]
+
+        expr = [self.expand(subexpr, scope) for subexpr in expr]
+        if self.should_inline(expr, scope):
+            return self.inline_call(expr, scope)
+
+        return expr
+
+    def should_inline(self, expr, scope):
+        name = expr[0]
+        if not isinstance(name, str) or name not in self.inlinable or \
+                name in scope:
+            return False
+
+        params, body = self.functions[name]
+        if len(params) != len(expr) - 1:
+            return False
+
+        if self.num_calls[name] == 1 and self.num_references[name] == 0:
+            return True     # This is the only use of the function
+
+        return expression_size(self.get_expanded_body(name)) <= self.size_limit
+
+    def inline_call(self, expr, scope):
+        params, body = self.functions[expr[0]]
+
+        # Parameters that are assigned or captured by a closure must stay
+        # variables. A closure that captured only constants would become a
+        # plain function.
+        keep_variables = set()
+        self.find_assigned_or_captured(body, keep_variables)
+        renames = {}
+        bindings = []
+        for param, value in zip(params, expr[1:]):
+            if isinstance(value, int) and param not in keep_variables:
+                renames[param] = value
+            else:
+                renames[param] = self.new_name(param)
+                bindings.insert(0, [renames[param], value])
+
+        new_body = [self.rename(subexpr, renames)
+                    for subexpr in self.get_expanded_body(expr[0])]
+
+        # Check if a variable at the call site hides something the body
+        # uses.
+        free_symbols = set()
+        find_symbols(new_body, free_symbols)
+        if not free_symbols.isdisjoint(scope):
+            return expr
+
+        self.num_inlined += 1
+        if bindings:
+            return ['let', bindings] + new_body
+        else:
+            return ['begin'] + new_body
+
+    def new_name(self, name):
+        self.next_id += 1
+        return '{}|{}'.format(name, self.next_id)
+
+    def find_assigned_or_captured(self, expr, symbols):
+        if isinstance(expr, list) and expr and expr[0] != 'quote':
+            if expr[0] == 'assign':
+                symbols.add(expr[1])
+            elif expr[0] == 'function':
+                find_symbols(expr, symbols)
+                return
+
+            for subexpr in expr:
+                self.find_assigned_or_captured(subexpr, symbols)
+
+    def rename(self, expr, renames):
+        """Give every variable declared in expr a new, unique name.
+
+        Args:
+            expr (List|str|int): S-Expression
+            renames (dict): old name -> new name (or constant value) for
+                variables that are visible here.
+
+        Returns:
+            New S-Expression
+        """
+        if isinstance(expr, str):
+            return renames.get(expr, expr)
+        elif not isinstance(expr, list) or not expr or expr[0] == 'quote':
+            return expr
+        elif expr[0] == 'function':
+            renames = dict(renames)
+            params = []
+            for param in expr[1]:
+                renames[param] = self.new_name(param)
+                params.append(renames[param])
+
+            return ['function', params] + [self.rename(subexpr, renames)
+                                           for subexpr in expr[2:]]
+        elif expr[0] == 'let':
+            renames = dict(renames)
+            bindings = []
+            for variable, value in expr[1]:
+                renames[variable] = self.new_name(variable)
+                bindings.append([renames[variable],
+                                 self.rename(value, renames)])
+
+            return ['let', bindings] + [self.rename(subexpr, renames)
+                                        for subexpr in expr[2:]]
+        else:
+            return [self.rename(subexpr, renames) for subexpr in expr]
+
+
+class Specializer(object):
+    """Make a copy of a higher order function for each function passed to it.
+
+    A parameter is functional if it is only ever called, or passed as a
+    functional argument of a named function (including recursive calls to
+    the same function), and is never assigned or hidden by another variable.
+    When a call passes a named function or an anonymous function without
+    free variables as a functional argument, it is replaced by a call to a
+    copy of the function with that parameter removed, which calls the
+    function directly:
+
+        (map values square) => (map|square values)
+        (function map|square (values)
+            (if values (cons (square (first values)) (map|square (rest values))) nil))
+
+    This avoids checking for a closure on each call, and the Inliner can
+    then inline the function into the copy. Anonymous functions are first
+    moved into a new named function (fn|N). Only the first functional
+    argument of a call is specialized, and copies are not specialized again.
+    """
+
+    def __init__(self):
+        self.functions = {}         # name -> (params, body)
+        self.functional_params = set()  # (function name, parameter index)
+        self.passed_to = {}         # (name, index) -> set of (name, index)
+        self.specialized = {}       # (name, index, callee) -> copy name
+        self.new_functions = []
+        self.next_id = 0
+
+    def process(self, program):
+        """Specialize calls in a program.
+
+        Args:
+            program (List): top level S-Exprs
+
+        Returns:
+            New list of top level S-Exprs, including the copies.
+        """
+        for statement in program:
+            if is_function_definition(statement):
+                self.functions[statement[1]] = (statement[2], statement[3:])
+
+        self.find_functional_params()
+        program = map_statements(self.specialize_statement, program)
+        return program + self.new_functions
+
+    def find_functional_params(self):
+        """Fill in functional_params and passed_to.
+
+        This starts by assuming every parameter is functional, and removes
+        those that are used some other way (which may also rule out the
+        parameters they are passed from) until nothing changes.
+        """
+        self.functional_params = set()
+        for name, (params, _) in self.functions.items():
+            for index, param in enumerate(params):
+                if params.count(param) == 1:
+                    self.functional_params.add((name, index))
+
+        changed = True
+        while changed:
+            changed = False
+            for name, index in list(self.functional_params):
+                params, body = self.functions[name]
+                passed_to = set()
+                if not all(self.is_functional_use(params[index], expr,
+                                                  frozenset(params), passed_to)
+                           for expr in body):
+                    self.functional_params.remove((name, index))
+                    changed = True
+                else:
+                    self.passed_to[(name, index)] = passed_to
+
+    def is_functional_use(self, param, expr, scope, passed_to):
+        """Check that a parameter is only used as a function in expr.
+
+        Args:
+            param (str): name of the parameter
+            expr (List|str|int): S-Expression
+            scope (frozenset): local variable names visible here.
+            passed_to (set): (name, index) of each functional parameter
+                that param is passed as is added to this.
+
+        Returns:
+            True if every use of param in expr is a call or is passing it
+            to a functional parameter.
+        """
+        if isinstance(expr, str):
+            return expr != param
+        elif not isinstance(expr, list) or not expr or expr[0] == 'quote':
+            return True
+
+        head = expr[0]
+        if head == 'function':
+            return param not in expr[1] and all(
+                self.is_functional_use(param, subexpr, scope.union(expr[1]),
+                                       passed_to)
+                for subexpr in expr[2:])
+        elif head == 'let':
+            for variable, value in expr[1]:
+                scope = scope.union([variable])
+                if variable == param or not self.is_functional_use(
+                        param, value, scope, passed_to):
+                    return False
+
+            return all(self.is_functional_use(param, subexpr, scope, passed_to)
+                       for subexpr in expr[2:])
+        elif head == 'assign' and expr[1] == param:
+            return False
+
+        args = expr[1:]
+        if head != param and not self.is_functional_use(param, head, scope,
+                                                        passed_to):
+            return False
+
+        for index, arg in enumerate(args):
+            if arg == param:
+                if not isinstance(head, str) or head in scope or \
+                        (head, index) not in self.functional_params or \
+                        args.count(param) != 1:
+                    return False
+
+                passed_to.add((head, index))
+            elif not self.is_functional_use(param, arg, scope, passed_to):
+                return False
+
+        return True
+
+    def specialize_statement(self, statement):
+        """Return a top level form with calls in it specialized."""
+        if is_function_definition(statement):
+            return statement[:3] + [self.expand(expr, frozenset(statement[2]))
+                                    for expr in statement[3:]]
+        else:
+            return self.expand(statement, frozenset())
+
+    def expand(self, expr, scope):
+        """Specialize calls in an expression.
+
+        Args:
+            expr (List|str|int): S-Expression
+            scope (frozenset): names of local variables visible here.
+
+        Returns:
+            New S-Expression
+        """
+        if not isinstance(expr, list) or not expr or expr[0] == 'quote':
+            return expr
+        elif expr[0] == 'function':
+            inner_scope = scope.union(expr[1])
+            return expr[:2] + [self.expand(subexpr, inner_scope)
+                               for subexpr in expr[2:]]
+        elif expr[0] == 'let':
+            bindings = []
+            for variable, value in expr[1]:
+                scope = scope.union([variable])
+                bindings.append([variable, self.expand(value, scope)])
+
+            return ['let', bindings] + [self.expand(subexpr, scope)
+                                        for subexpr in expr[2:]]
+        elif expr[0] == 'assign':
+            return expr[:2] + [self.expand(subexpr, scope)
+                               for subexpr in expr[2:]]
+
+        expr = [self.expand(subexpr, scope) for subexpr in expr]
+        name = expr[0]
+        if isinstance(name, str) and name in self.functions and \
+                name not in scope:
+            for index, arg in enumerate(expr[1:]):
+                if (name, index) in self.functional_params:
+                    callee = self.get_callee(name, index, arg, scope)
+                    if callee:
+                        return [self.specialize(name, index, callee)] + \
+                            expr[1:index + 1] + expr[index + 2:]
+
+        return expr
+
+    def get_callee(self, name, index, arg, scope):
+        """Find the named function to call in a specialized copy.
+
+        Args:
+            name (str): function being called
+            index (int): which functional parameter arg is passed as.
+            arg (List|str|int): S-Expression for the argument
+            scope (frozenset): local variables visible at the call.
+
+        Returns:
+            Name of a function, or None if arg can't be specialized.
+        """
+        if isinstance(arg, str) and arg in self.functions and arg not in scope:
+            callee = arg
+        elif isinstance(arg, list) and arg and arg[0] == 'function':
+            symbols = set()
+            find_symbols(arg, symbols)
+            if not symbols.isdisjoint(scope):
+                return None  # May have free variables
+
+            callee = None
+        else:
+            return None
+
+        # Check that no variable will hide the function in any of the copies
+        visited = set()
+        to_visit = [(name, index)]
+        while to_visit:
+            param = to_visit.pop()
+            if param not in visited:
+                visited.add(param)
+                to_visit.extend(self.passed_to[param])
+                if callee:
+                    symbols = set()
+                    find_symbols(self.functions[param[0]][1], symbols)
+                    if callee in symbols:
+                        return None
+
+        if callee is None:
+            self.next_id += 1
+            callee = 'fn|{}'.format(self.next_id)
+            self.functions[callee] = (arg[1], arg[2:])
+            self.new_functions.append(['function', callee] + arg[1:])
+
+        return callee
+
+    def specialize(self, name, index, callee):
+        """Create a copy of a function that calls callee in place of a
+        functional parameter.
+
+        Returns:
+            Name of the copy.
+        """
+        key = (name, index, callee)
+        if key not in self.specialized:
+            params, body = self.functions[name]
+            new_name = '{}|{}'.format(name, callee)
+            self.specialized[key] = new_name
+            new_params = params[:index] + params[index + 1:]
+            new_body = [self.expand(self.substitute(expr, params[index], callee),
+                                    frozenset(new_params))
+                        for expr in body]
+            self.new_functions.append(['function', new_name, new_params] +
+                                      new_body)
+
+        return self.specialized[key]
+
+    def substitute(self, expr, param, callee):
+        """Replace uses of a functional parameter with callee.
+
+        Args:
+            expr (List|str|int): S-Expression
+            param (str): name of the parameter
+            callee (str): name of the function it holds.
+
+        Returns:
+            New S-Expression
+        """
+        if not isinstance(expr, list) or not expr or expr[0] == 'quote':
+            return expr
+
+        expr = [self.substitute(subexpr, param, callee) for subexpr in expr]
+        if expr[0] == param:
+            return [callee] + expr[1:]
+        elif param in expr[1:] and expr[0] not in ('function', 'let'):
+            # find_functional_params checked this is a functional parameter
+            index = expr.index(param) - 1
+            return [self.specialize(expr[0], index, callee)] + \
+                expr[1:index + 1] + expr[index + 2:]
+
+        return expr
+
+
+RUNTIME_DIR = os.path.dirname(os.path.abspath(__file__))
+RUNTIME_SOURCE = os.path.join(RUNTIME_DIR, 'runtime.lisp')
+RUNTIME_CACHE_FILE = os.path.join(RUNTIME_DIR, '__pycache__',
+                                  'runtime-{}.cache')
+
+# Garbage collectors that can be linked with the runtime library, and the
+# file each one is in. Each defines cons, $alloc-cells, and $gc.
+COLLECTORS = {
+    'mark-sweep': 'gc-mark-sweep.lisp',
+    'copying': 'gc-copying.lisp'
+}
+
+# In-memory copies of the cache files for each collector, to avoid reading
+# them on every compile when many programs are compiled by one process.
+runtime_cache = {}
+
+
+def run_front_end(program, macro_processor):
+    """Apply the S-Expression passes that only need to see one file.
+
+    Args:
+        program (List): top level S-Exprs from the parser.
+        macro_processor (MacroProcessor): holds the macros that have been
+            defined so far. New definitions in program will be added.
+
+    Returns:
+        The transformed list of S-Exprs
+    """
+    passes = [
+        expand_cadr,
+        macro_processor.macro_pre_process
+    ]
+
+    # The passes build new lists, so remember where each top level form
+    # came from to put back afterward. defmacro forms are removed by the
+    # macro processor.
+    locations = [get_location(statement) for statement in program
+                 if not macro_processor.is_macro_definition(statement)]
+    for passfn in passes:
+        program = passfn(program)
+
+    return [SourceForm(statement, location)
+            if isinstance(statement, list) else statement
+            for statement, location in zip(program, locations)]
+
+
+def strip_locations(expr):
+    """Convert SourceForms in expr back to plain lists."""
+    if isinstance(expr, list):
+        return [strip_locations(subexpr) for subexpr in expr]
+    elif isinstance(expr, tuple):
+        return tuple(strip_locations(subexpr) for subexpr in expr)
+    elif isinstance(expr, dict):
+        return {key: strip_locations(value) for key, value in expr.items()}
+    else:
+        return expr
+
+
+def get_runtime_cache_key(collector):
+    """Hash of everything that affects the processed runtime library."""
+    digest = hashlib.sha256()
+    for filename in [RUNTIME_SOURCE,
+                     os.path.join(RUNTIME_DIR, COLLECTORS[collector]),
+                     os.path.abspath(__file__)]:
+        with open(filename, 'rb') as infile:
+            digest.update(infile.read())
+
+    return digest.hexdigest()
+
+
+def load_runtime(collector=DEFAULT_COLLECTOR):
+    """Read the runtime library and run the front end passes on it.
+
+    The result doesn't depend on the user program, so it is saved to
+    RUNTIME_CACHE_FILE and reused until runtime.lisp, the collector's
+    file, or this file changes.
+
+    Args:
+        collector (str): which garbage collector to include (a key of
+            COLLECTORS).
+
+    Returns:
+        Tuple of (List of S-Exprs, dict of macros the runtime defined)
+    """
+    key = get_runtime_cache_key(collector)
+    cache_filename = RUNTIME_CACHE_FILE.format(collector)
+    cached = runtime_cache.get(collector)
+    if cached is None or cached[0] != key:
+        cached = None
+        try:
+            with open(cache_filename, 'rb') as infile:
+                cached_key, data = pickle.load(infile)
+                if cached_key == key:
+                    cached = (key, data)
+        except (OSError, EOFError, ValueError, AttributeError,
+                pickle.PickleError):
+            pass    # Missing, corrupt, or from an old format. Will be rebuilt.
+
+    if cached is None:
+        parser = Parser()
+        parser.parse_file(RUNTIME_SOURCE)
+        parser.parse_file(os.path.join(RUNTIME_DIR, COLLECTORS[collector]))
+        macro_processor = MacroProcessor()
+        program = run_front_end(parser.program, macro_processor)
+
+        # Only builtin types are pickled. Classes defined here would be
+        # saved as __main__.<name> when this is run as a script, which
+        # can't be loaded when imported as a module.
+        locations = [(loc.filename, loc.line, loc.column) if loc else None
+                     for loc in map(get_location, program)]
+        data = pickle.dumps((strip_locations(program),
+                             strip_locations(macro_processor.macro_list),
+                             locations))
+        cached = (key, data)
+
+        # Write to a temporary file and rename it, so another compiler
+        # process never sees a partially written cache.
+        try:
+            os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+            tmp_filename = '{}.{}'.format(cache_filename, os.getpid())
+            with open(tmp_filename, 'wb') as outfile:
+                pickle.dump(cached, outfile)
+
+            os.replace(tmp_filename, cache_filename)
+        except OSError:
+            pass    # Can't write the cache. That's okay, it's just slower.
+
+    runtime_cache[collector] = cached
+
+    # Unpickle each time to get a fresh copy that later passes can modify.
+    program, macros, locations = pickle.loads(cached[1])
+    program = [SourceForm(statement, SourceLocation(*location))
+               if location else statement
+               for statement, location in zip(program, locations)]
+    return program, macros
+
+
+def map_statements(passfn, program):
+    """Apply a function to each top level form, keeping SourceLocations."""
+    result = []
+    for statement in program:
+        new_statement = passfn(statement)
+        if isinstance(new_statement, list):
+            new_statement = SourceForm(new_statement, get_location(statement))
+
+        result.append(new_statement)
+
+    return result
+
+
+def compile_program(files=(), sources=(), inline_limit=DEFAULT_INLINE_LIMIT,
+                    inline_cons=False, collector=DEFAULT_COLLECTOR,
+                    gc_stats=False):
     """Top level compiler.
 
     This loads the runtime library (written in LISP), then walks through the
@@ -1558,30 +4478,78 @@ def compile_program(files):
 
     Args:
         files (List<str>): List of filenames to read and compile.
-    """
-    parser = Parser()
+        sources (List<str>): Source code strings to compile. These come after
+            the files.
+        inline_limit (int): Largest function body that will be inlined at
+            every call site (see Inliner). 0 disables inlining.
+        inline_cons (bool): Allocate cons cells with inline code where
+            possible, which is faster but larger (see Compiler.compile_cons).
+        collector (str): which garbage collector to link with the program
+            (a key of COLLECTORS).
+        gc_stats (bool): Keep allocator statistics and write them to
+            hardware registers when the program halts (see runtime.lisp).
+            This disables inline_cons, since the inline code doesn't
+            count allocations.
 
-    # Read standard runtime library
-    parser.parse_file(os.path.dirname(os.path.abspath(__file__)) + '/runtime.lisp')
+    Returns:
+        CompiledProgram
+    """
+    runtime_program, runtime_macros = load_runtime(collector)
 
     # Read source files
+    parser = Parser()
     for filename in files:
         parser.parse_file(filename)
 
-    passes = [
-        expand_cadr,
-        lambda program: MacroProcessor().macro_pre_process(program),
-        lambda program: [optimize(sub) for sub in program]
-    ]
-
-    program = parser.program
-    for passfn in passes:
-        program = passfn(program)
+    for source in sources:
+        parser.parse_string(source)
+
+    macro_processor = MacroProcessor()
+    macro_processor.macro_list.update(runtime_macros)
+    program = runtime_program + run_front_end(parser.program, macro_processor)
+    program.insert(0, ['defconstant', '$gc-stats', 1 if gc_stats else 0])
+    program = ConstantPropagator().process(program)
+    program = Specializer().process(program)
+    if inline_limit > 0:
+        inliner = Inliner(inline_limit)
+        inliner.analyze(program)
+        program = map_statements(inliner.inline_statement, program)
+
+    program = map_statements(optimize, program)
+    program += create_divmod_helpers(program)
+    return Compiler(inline_cons and not gc_stats, collector).compile(program)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compile LISP to program.hex')
+    parser.add_argument('files', nargs='+', help='source files')
+    parser.add_argument('--inline-limit', type=int,
+                        default=DEFAULT_INLINE_LIMIT,
+                        help='largest function body (in atoms) to inline at '
+                        'every call site. 0 disables inlining. (default '
+                        '%(default)s)')
+    parser.add_argument('--inline-cons', action='store_true',
+                        help='allocate cons cells with inline code, which is '
+                        'faster but uses more instruction memory')
+    parser.add_argument('--gc', choices=sorted(COLLECTORS),
+                        default=DEFAULT_COLLECTOR,
+                        help='garbage collector to use (default '
+                        '%(default)s)')
+    parser.add_argument('--gc-stats', action='store_true',
+                        help='count allocations and garbage collections, '
+                        'and report them when the program halts')
+    args = parser.parse_args()
+    try:
+        compile_program(args.files, inline_limit=args.inline_limit,
+                        inline_cons=args.inline_cons, collector=args.gc,
+                        gc_stats=args.gc_stats).write_files()
+    except CompileError as ex:
+        if ex.location:
+            print('{}: Compile error: {}'.format(ex.location, ex))
+        else:
+            print('Compile error: ' + str(ex))
+        sys.exit(1)
 
-    Compiler().compile(program)
 
-try:
-    compile_program(sys.argv[1:])
-except CompileError as ex:
-    print('Compile error: ' + str(ex))
-    sys.exit(1)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+;
+; Copyright 2011-2016 Jeff Bush
+;
+; Licensed under the Apache License, Version 2.0 (the "License");
+; you may not use this file except in compliance with the License.
+; You may obtain a copy of the License at
+;
+;     http://www.apache.org/licenses/LICENSE-2.0
+;
+; Unless required by applicable law or agreed to in writing, software
+; distributed under the License is distributed on an "AS IS" BASIS,
+; WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+; See the License for the specific language governing permissions and
+; limitations under the License.
+;
+
+; Copying garbage collector, using Cheney's algorithm. The compiler links
+; this instead of gc-mark-sweep.lisp with --gc copying.
+;
+; The heap is split into two halves, and cells are allocated in order from
+; the one in use. When it is full, $gc copies every cell that is reachable
+; to the start of the other half, updating the pointers to them, and
+; allocation continues after them. Since the cells that are in use are
+; always together, there is no free list, and any number of cells can be
+; allocated at once. The cost is that only half of the heap can be used.
+
+; Size of each half of the heap, in words. This is rounded down to a whole
+; number of cells.
+(assign $semispace-size (lshift (rshift (- $max-heap $heapstart) 2) 1))
+
+; Start of the half that isn't in use.
+(assign $tospace (+ $heapstart $semispace-size))
+(assign $max-heap $tospace)
+
+; True if value points to a cons cell or closure in the heap. Pointers to
+; static data are skipped, since it is never moved and can't point into
+; the heap.
+(defmacro $moves? (value)
+    `(and (bitwise-and (gettag ,value) 1) (>= ,value $heapstart)))
+
+; Tag of the header of a vector that has been copied. The header is
+; replaced with the pointer to the copy.
+(defconstant $moved-vector-tag 7)
+
+; Return a pointer to the copy of the cell or vector value points to,
+; copying it to the end of the other half first if it hasn't been already.
+; When a cell is copied, its first is replaced with the address of the copy,
+; with a tag of 4 to show that it has moved. The elements of a vector don't
+; need anything special, since the header and mark word aren't pointers.
+(function $forward (value)
+    (let ((head (load (- value 2))) (copy $wilderness-start))
+        (if (= (gettag head) $vector-header-tag)
+            ; Copy every word of a vector, starting with its header. This
+            ; reuses head for the end of the copy and value for the start
+            ; of the original, to keep the stack frame small.
+            (begin
+                (gclog #\C value)
+                (assign head (+ copy ($vector-words (settag head 0))))
+                (assign value (- value 2))
+                (while (< $wilderness-start head)
+                    (store $wilderness-start
+                        (load (+ value (- $wilderness-start copy))))
+                    (assign $wilderness-start (+ $wilderness-start 1)))
+                (store value (settag (+ copy 2) $moved-vector-tag))
+                (settag (+ copy 2) 1))
+            (if (= (gettag head) $moved-vector-tag)
+                (settag head 1)
+                (begin
+                    (assign head (load value))
+                    (if (= (gettag head) 4)
+                        (settag head (gettag value))
+                        (begin
+                            (gclog #\C value)
+                            (store copy head)
+                            (store (+ copy 1) (rest value))
+                            (assign $wilderness-start (+ copy 2))
+                            (store value (settag copy 4))
+                            (settag copy (gettag value)))))))))
+
+; Update the pointers in a range of contiguous addresses.
+(function $forward-range (start end)
+    (for addr start end 1
+        (let ((value (load addr)))
+            (when ($moves? value)
+                (store addr ($forward value))))))
+
+; Garbage collect, by copying the cells that are in use to the other half
+; of the heap.
+(function $gc ()
+    (let ((start $tospace) (scan $tospace))
+        (gclog #\G $wilderness-start)
+        (assign $wilderness-start start)
+        (when $gc-stats
+            (assign $stat-collections (+ $stat-collections 1)))
+        ($forward-range 0 (- $heapstart 1))   ; Global variables
+        ($forward-range (getbp) $stacktop)    ; Stack
+
+        ; Copy the cells that the copied cells point to. They are added
+        ; after the ones being scanned, so this stops when it catches up.
+        (while (< scan $wilderness-start)
+            (let ((value (load scan)))
+                (when ($moves? value)
+                    (store scan ($forward value))))
+            (assign scan (+ scan 1)))
+
+        ; Everything that wasn't copied is free.
+        (when $gc-stats
+            (begin
+                (assign $stat-live (rshift (- $wilderness-start start) 1))
+                ($count-freed (- $stat-in-use $stat-live))))
+
+        ; Switch halves
+        (assign $tospace (- $max-heap $semispace-size))
+        (assign $max-heap (+ start $semispace-size))))
+
+; Allocate a new cell and return a pointer to it
+(function cons (_first _rest)
+    (let ((ptr $wilderness-start))
+        (when (>= ptr $max-heap)
+            (begin
+                ($gc)
+                (when (>= $wilderness-start $max-heap)
+                    ($oom))
+                (assign ptr $wilderness-start)))
+        (gclog #\A ptr)     ; debug: print cell that has been allocated
+        ($count-allocated 1)
+        (assign $wilderness-start (+ ptr 2))
+        (store ptr _first)
+        (store (+ ptr 1) _rest)
+        (settag ptr 1)))    ; Mark this as a cons cell and return
+
+; Allocate a list of count cells (at least 1), with the rest of each one
+; pointing to the next. The compiler uses this for list forms and closure
+; environments, and stores the elements into the cells itself. The first
+; element of each cell isn't set, so the caller must do that before
+; allocating anything else.
+(function $alloc-cells (count)
+    (let ((head $wilderness-start) (size (lshift count 1)))
+        (when (> (+ head size) $max-heap)
+            (begin
+                ($gc)
+                (when (> (+ $wilderness-start size) $max-heap)
+                    ($oom))
+                (assign head $wilderness-start)))
+        (assign $wilderness-start (+ head size))
+        ($count-allocated count)
+        (let ((ptr head) (end (+ head (- size 2))))
+            (while (< ptr end)
+                (gclog #\A ptr)
+                (assign ptr (setnext ptr (settag (+ ptr 2) 1))))
+            (gclog #\A ptr)
+            (setnext ptr 0))
+        (settag head 1)))
+
+; Allocate a vector with length elements, all set to 0, and return a pointer
+; to it.
+(function make-vector (length)
+    (let ((ptr $wilderness-start) (words ($vector-words length)))
+        (when (> (+ ptr words) $max-heap)
+            (begin
+                ($gc)
+                (when (> (+ $wilderness-start words) $max-heap)
+                    ($oom))
+                (assign ptr $wilderness-start)))
+        (gclog #\A ptr)
+        (assign $wilderness-start (+ ptr words))
+        ($count-allocated (rshift words 1))
+        (store ptr (settag length $vector-header-tag))
+        (store (+ ptr 1) 0)
+        (for addr (+ ptr 2) (- $wilderness-start 1) 1
+            (store addr 0))
+        (settag (+ ptr 2) 1)))
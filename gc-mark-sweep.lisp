@@ -0,0 +1,355 @@
+;
+; Copyright 2011-2016 Jeff Bush
+;
+; Licensed under the Apache License, Version 2.0 (the "License");
+; you may not use this file except in compliance with the License.
+; You may obtain a copy of the License at
+;
+;     http://www.apache.org/licenses/LICENSE-2.0
+;
+; Unless required by applicable law or agreed to in writing, software
+; distributed under the License is distributed on an "AS IS" BASIS,
+; WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+; See the License for the specific language governing permissions and
+; limitations under the License.
+;
+
+; Mark-sweep garbage collector. This is linked with runtime.lisp by
+; default (see COLLECTORS in compile.py).
+
+(assign $freelist nil)
+
+; The marks are kept in a bitmap at the top of the heap, with one bit for
+; each cell, rather than in the cells, where the program could see them.
+; Each collection clears it, which takes one store for every 16 cells.
+(assign $mark-bits (- $max-heap (rshift (- $max-heap $heapstart) 5)))
+(assign $mark-bits-end $max-heap)
+(assign $max-heap (- $mark-bits 1))
+
+; Cells from $sweep-ptr up to $sweep-end haven't been swept since the last
+; collection. $sweep-end is where the wilderness started when it happened,
+; so cells allocated from the wilderness since then are never swept. There
+; is nothing to sweep until the first one.
+(assign $sweep-ptr 0)
+(assign $sweep-end 0)
+
+; Vectors that have been marked, but whose elements haven't been. $mark
+; adds them instead of following their elements, linked through their
+; second words, and $gc marks the elements afterward. A vector is marked by
+; the bit for the cell its pointer points to, its first element.
+(assign $vectors-to-mark 0)
+
+; Number of cells checked each time $sweep is called
+(defconstant $sweep-cells 16)
+
+; Mark the cell at ptr. ptr is evaluated more than once.
+(defmacro $set-mark (ptr)
+    `(let ((__markword (+ $mark-bits (rshift (- ,ptr $heapstart) 5))))
+        (store __markword (bitwise-or (load __markword)
+            (lshift 1 (bitwise-and (rshift (- ,ptr $heapstart) 1) 15))))))
+
+; True if value points to a cons cell, vector, or closure in the heap that
+; hasn't been marked yet. Pointers to static data are skipped, since it is never
+; freed and can't point into the heap.
+(defmacro $needs-mark? (value)
+    `(and (bitwise-and (gettag ,value) 1) (>= ,value $heapstart)
+        (not (bitwise-and
+            (load (+ $mark-bits (rshift (- ,value $heapstart) 5)))
+            (lshift 1 (bitwise-and (rshift (- ,value $heapstart) 1) 15))))))
+
+; Mark everything reachable from an unmarked cell. This doesn't recurse, so
+; it needs no extra memory however long or deep the structure is. Instead,
+; it reverses the links it follows (Deutsch-Schorr-Waite): the first or
+; rest of each cell on the path back to the start (prev and the cells
+; before it) holds the previous cell, and is restored on the way back.
+; Tag bit 2 of the rest of a cell on this path is set if the rest is the
+; one holding it. This is never set in a first, so the check for a vector
+; header still works. Vectors are added to $vectors-to-mark, and otherwise
+; treated as if they had nothing to follow.
+(function $mark (ptr)
+    (let ((prev 0) (value 0) (next 0))
+        (while ptr
+            (gclog #\M ptr)
+            (when $gc-stats
+                (assign $stat-live (+ $stat-live 1)))
+            ($set-mark ptr)
+            (if (vector? ptr)
+                (begin
+                    (when $gc-stats
+                        (assign $stat-live (+ $stat-live
+                            (- (rshift ($vector-words (vector-length ptr)) 1) 1))))
+                    (store (- ptr 1) $vectors-to-mark)
+                    (assign $vectors-to-mark ptr)
+                    (assign value 0)
+                    (assign next 0))
+                (begin
+                    (assign next (rest ptr))
+                    (assign value (load ptr))))
+            (if ($needs-mark? value)
+                ; Follow first
+                (begin
+                    (store ptr prev)
+                    (assign prev ptr)
+                    (assign ptr value))
+                (if ($needs-mark? next)
+                    ; Follow rest
+                    (begin
+                        (store (+ ptr 1) (settag prev (bitwise-or (gettag prev) 4)))
+                        (assign prev ptr)
+                        (assign ptr next))
+                    ; Nothing left to follow from here. Go back to the
+                    ; last cell with a rest that hasn't been followed.
+                    (while true
+                        (unless prev
+                            (begin
+                                (assign ptr 0)
+                                (break)))
+                        (assign value (load prev))
+                        (assign next (rest prev))
+                        (if (bitwise-and (gettag next) 4)
+                            ; Done with the rest of prev
+                            (begin
+                                (store (+ prev 1) ptr)
+                                (assign ptr prev)
+                                (assign prev (settag next (bitwise-and (gettag next) 3))))
+                            ; Done with the first of prev
+                            (if ($needs-mark? next)
+                                (begin
+                                    (store prev ptr)
+                                    (store (+ prev 1) (settag value (bitwise-or (gettag value) 4)))
+                                    (assign ptr next)
+                                    (break))
+                                (begin
+                                    (store prev ptr)
+                                    (assign ptr prev)
+                                    (assign prev value))))))))))
+
+; Mark a range of contiguous addresses.
+(function $mark-range (start end)
+    (for addr start end 1
+        (let ((value (load addr)))
+            ; Skip the call for anything that isn't an unmarked cell.
+            (when ($needs-mark? value)
+                ($mark value)))))
+
+; Garbage collect, using mark-sweep algorithm. This only does the mark
+; phase. Unmarked cells are added to the free list later by $sweep, a few
+; at a time, as cons needs them.
+(function $gc ()
+    (gclog #\G $wilderness-start)
+    (when $gc-stats
+        (begin
+            (assign $stat-collections (+ $stat-collections 1))
+            (assign $stat-live 0)))
+
+    (for addr $mark-bits $mark-bits-end 1
+        (store addr 0))
+    ($mark-range 0 $heapstart)      ; Mark global variables
+    ($mark-range (getbp) $stacktop) ; Mark stack
+
+    ; Mark the elements of vectors. This may find more vectors.
+    (while $vectors-to-mark
+        (let ((vector $vectors-to-mark))
+            (assign $vectors-to-mark (load (- vector 1)))
+            (store (- vector 1) 0)
+            ($mark-range vector (+ vector (- (vector-length vector) 1)))))
+
+    ; Cells on the free list will be found again by the sweep, so clear
+    ; it to avoid adding them twice.
+    (assign $freelist nil)
+    (assign $sweep-ptr $heapstart)
+    (assign $sweep-end $wilderness-start)
+
+    ; Count everything that wasn't marked as freed now, like the copying
+    ; collector, even though the sweep finds it later.
+    (when $gc-stats
+        ($count-freed (- $stat-in-use $stat-live))))
+
+; Add up to $sweep-cells unmarked cells that haven't been swept since the
+; last collection to the free list.
+(function $sweep ()
+    (let ((ptr $sweep-ptr) (end (+ $sweep-ptr (lshift $sweep-cells 1)))
+            (word 0) (mask 0) (bits 0))
+        (when (> end $sweep-end)
+            (assign end $sweep-end))
+
+        ; word is the address of the mark bits for ptr, bits is their value,
+        ; and mask selects the one for ptr.
+        (assign word (+ $mark-bits (rshift (- ptr $heapstart) 5)))
+        (assign mask (lshift 1 (bitwise-and (rshift (- ptr $heapstart) 1) 15)))
+        (assign bits (load word))
+        (while (< ptr end)
+            (if (= (gettag (load ptr)) $vector-header-tag)
+                ; A vector. If it isn't marked, free all of its cells. The
+                ; mark is on the cell after the header.
+                (let ((vector-end (+ ptr ($vector-words (settag (load ptr) 0)))))
+                    (if (bitwise-and
+                            (load (+ $mark-bits (rshift (- (+ ptr 2) $heapstart) 5)))
+                            (lshift 1 (bitwise-and (rshift (- (+ ptr 2) $heapstart) 1) 15)))
+                        (assign ptr vector-end)
+                        (begin
+                            (store ptr 0)
+                            (while (< ptr vector-end)
+                                (store (+ 1 ptr) $freelist)
+                                (assign $freelist ptr)
+                                (gclog #\F ptr)
+                                (assign ptr (+ ptr 2)))))
+                    (assign word (+ $mark-bits (rshift (- ptr $heapstart) 5)))
+                    (assign mask (lshift 1 (bitwise-and (rshift (- ptr $heapstart) 1) 15)))
+                    (assign bits (load word)))
+                (begin
+                    (unless (bitwise-and bits mask)
+                        (begin
+                            ; This is not used, stick it back in the free list.
+                            (store (+ 1 ptr) $freelist)
+                            (assign $freelist ptr)
+                            (gclog #\F ptr)))
+                    (assign ptr (+ ptr 2))
+                    (assign mask (lshift mask 1))
+                    (unless mask
+                        (begin
+                            (assign word (+ word 1))
+                            (assign mask 1)
+                            (assign bits (load word)))))))
+
+        (assign $sweep-ptr ptr)))
+
+; Sweep everything that hasn't been swept since the last collection.
+(function $sweep-all ()
+    (while (< $sweep-ptr $sweep-end)
+        ($sweep)))
+
+; Remove count cells that are next to each other from the free list, and
+; return the address of the first one, or 0 if there aren't that many
+; together. The sweep adds cells to the free list in order of address, so
+; the list goes from the highest address down, and neighboring cells are
+; next to each other in it.
+(function $take-free-cells (count)
+    (let ((before 0) (ptr $freelist) (run 1) (next 0))
+        (while (and ptr (< run count))
+            (assign next (rest ptr))
+            (if (= next (- ptr 2))
+                (assign run (+ run 1))
+                (begin
+                    (assign before ptr)
+                    (assign run 1)))
+            (assign ptr next))
+
+        (when ptr
+            (if before
+                (store (+ before 1) (rest ptr))
+                (assign $freelist (rest ptr))))
+
+        ptr))
+
+; Make sure there is a cell on the free list, by sweeping or, if the whole
+; heap has been swept, garbage collecting.
+(function $refill-freelist ()
+    (while (and (not $freelist) (< $sweep-ptr $sweep-end))
+        ($sweep))
+
+    (unless $freelist
+        (begin
+            ($gc)
+            (while (and (not $freelist) (< $sweep-ptr $sweep-end))
+                ($sweep))
+
+            ; GC gave us nothing, give up.
+            (unless $freelist
+                ($oom)))))
+
+; Allocate a new cell and return a pointer to it
+(function cons (_first _rest)
+    (let ((ptr nil))
+        (if (or $freelist (>= $wilderness-start $max-heap))
+            ; Take a node from the freelist, refilling it if needed.
+            (begin
+                (unless $freelist
+                    ($refill-freelist))
+                (assign ptr $freelist)
+                (assign $freelist (rest ptr)))
+            ; Nothing on freelist, but space is available in frontier, snag
+            ; from there.
+            (begin
+                (assign ptr $wilderness-start)
+                (assign $wilderness-start (+ $wilderness-start 2))))
+        (gclog #\A ptr)     ; debug: print cell that has been allocated
+        ($count-allocated 1)
+        (store ptr _first)
+        (store (+ ptr 1) _rest)
+        (settag ptr 1)))    ; Mark this as a cons cell and return
+
+; Allocate a list of count cells (at least 1), with the rest of each one
+; pointing to the next. The compiler uses this for list forms and closure
+; environments, and stores the elements into the cells itself. The first
+; element of each cell isn't set, so the caller must do that before
+; allocating anything else. This takes all of the cells at once from either
+; the wilderness or the free list, or uses cons if neither has enough.
+(function $alloc-cells (count)
+    (let ((head $wilderness-start) (end (+ $wilderness-start (lshift count 1))))
+        (if (< (- end 2) $max-heap)
+            ; Take the cells from the wilderness
+            (let ((ptr head))
+                (assign $wilderness-start end)
+                (assign end (- end 2))
+                (while (< ptr end)
+                    (gclog #\A ptr)
+                    (assign ptr (setnext ptr (settag (+ ptr 2) 1))))
+                (gclog #\A ptr)
+                ($count-allocated count)
+                (setnext ptr 0))
+
+            ; Walk the free list to see if it has enough cells. Links in the
+            ; free list aren't tagged as pointers, so fix them up along the
+            ; way.
+            (let ((last $freelist) (remaining (- count 1)))
+                (assign head $freelist)
+                (while (and remaining last)
+                    (assign last (setnext last (settag (rest last) 1)))
+                    (assign remaining (- remaining 1)))
+
+                (if last
+                    (begin
+                        (assign $freelist (rest last))
+                        ($count-allocated count)
+                        (setnext last 0))
+
+                    ; Allocate them one at a time, which will garbage collect
+                    ; if needed. The cells allocated so far are in head, so
+                    ; they won't be freed.
+                    (begin
+                        (assign head 0)
+                        (while count
+                            (assign head (cons 0 head))
+                            (assign count (- count 1)))))))
+        (settag head 1)))
+
+; Allocate a vector with length elements, all set to 0, and return a pointer
+; to it. Its cells must be next to each other, so this takes them from the
+; wilderness or, if there isn't enough space there, from a part of the free
+; list that is. It sweeps the rest of the heap, then garbage collects, if it
+; can't find enough.
+(function make-vector (length)
+    (let ((words ($vector-words length)) (ptr $wilderness-start))
+        (if (< (+ ptr (- words 2)) $max-heap)
+            (assign $wilderness-start (+ ptr words))
+            (begin
+                (assign ptr ($take-free-cells (rshift words 1)))
+                (unless ptr
+                    (begin
+                        ($sweep-all)
+                        (assign ptr ($take-free-cells (rshift words 1)))))
+                (unless ptr
+                    (begin
+                        ($gc)
+                        ($sweep-all)
+                        (assign ptr ($take-free-cells (rshift words 1)))
+                        (unless ptr
+                            ($oom))))))
+        (gclog #\A ptr)
+        ($count-allocated (rshift words 1))
+        (store ptr (settag length $vector-header-tag))
+        (store (+ ptr 1) 0)
+        (for addr (+ ptr 2) (+ ptr (- words 1)) 1
+            (store addr 0))
+        (settag (+ ptr 2) 1)))
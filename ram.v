@@ -19,7 +19,8 @@
 module ram
     #(parameter MEM_SIZE = 4096,
     parameter WORD_SIZE = 20,
-    parameter ADDR_SIZE = 16)
+    parameter ADDR_SIZE = 16,
+    parameter INIT_FILE="")
 
     (input                          clk,
     input[ADDR_SIZE - 1:0]          addr_i,
@@ -36,6 +37,9 @@ module ram
         for (i = 0; i < MEM_SIZE; i = i + 1)
             data[i] = 0;
         // synthesis translate_on
+
+        if (INIT_FILE != "")
+            $readmemh(INIT_FILE, data);
     end
 
     always @(posedge clk)
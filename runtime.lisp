@@ -62,8 +62,11 @@
 (defmacro atom? (ptr)
     `(= (bitwise-and (gettag ,ptr) 3) 0))
 
+; True if ptr is a cons cell, but not a vector. ptr is evaluated more than
+; once.
 (defmacro list? (ptr)
-    `(= (bitwise-and (gettag ,ptr) 3) 1))
+    `(and (= (bitwise-and (gettag ,ptr) 3) 1)
+        (not (= (gettag (load (- ,ptr 2))) $vector-header-tag))))
 
 (defmacro function? (ptr)
     `(= (bitwise-and (gettag ,ptr) 3) 2))
@@ -77,66 +80,99 @@
 (defmacro setfirst (ptr val)
     `(store ,ptr ,val))
 
+; A vector is a block of memory. The first word is a header, which holds
+; the number of elements and has this tag. The second word is used by the
+; garbage collector. The elements follow. A vector is pointed to by a value
+; with the same tag as a cons cell, but the address is that of the first
+; element, so first and rest only reach elements, and the program can never
+; read the header. No other value has tag bit 2 set, so the word two before
+; a pointer only has this tag if it points to a vector. The compiler lays
+; out vector literals (#(...)) the same way.
+(defconstant $vector-header-tag 6)
+
+; Total number of words used by a vector with length elements. There is
+; room for at least one element, so a pointer to a vector is always inside
+; it, and this is rounded up to a whole number of cells, so the heap can
+; still be swept two words at a time.
+(defmacro $vector-words (length)
+    `(bitwise-and (+ (bitwise-or ,length 1) 3) -2))
+
+; True if ptr is a vector. ptr is evaluated more than once.
+(defmacro vector? (ptr)
+    `(and (= (bitwise-and (gettag ,ptr) 3) 1)
+        (= (gettag (load (- ,ptr 2))) $vector-header-tag)))
+
+(defmacro vector-length (vector)
+    `(settag (load (- ,vector 2)) 0))
+
+(defmacro vector-ref (vector index)
+    `(load (+ ,vector ,index)))
+
+(defmacro vector-set! (vector index value)
+    `(store (+ ,vector ,index) ,value))
+
 (defmacro setnext (ptr next)
     `(store (+ ,ptr 1) ,next))
 
-; In testbench.v, when register 4095 is written, the simulator will exit
+; Allocator statistics. The compiler defines $gc-stats as 1 if the program
+; is compiled with --gc-stats, and 0 otherwise, which removes all of the
+; code that updates them. The counters are 16 bits and wrap around.
+;   $stat-allocated     cells allocated
+;   $stat-collections   garbage collections
+;   $stat-freed         cells freed by the garbage collector
+;   $stat-live          cells in use after the last collection
+;   $stat-in-use        cells allocated and not freed yet
+;   $stat-high-water    largest value of $stat-in-use
+(when $gc-stats
+    (begin
+        (assign $stat-allocated 0)
+        (assign $stat-collections 0)
+        (assign $stat-freed 0)
+        (assign $stat-live 0)
+        (assign $stat-in-use 0)
+        (assign $stat-high-water 0)))
+
+; Count cells that were allocated. cells is evaluated more than once.
+(defmacro $count-allocated (cells)
+    `(if $gc-stats
+        (begin
+            (assign $stat-allocated (+ $stat-allocated ,cells))
+            (assign $stat-in-use (+ $stat-in-use ,cells))
+            (if (> $stat-in-use $stat-high-water)
+                (assign $stat-high-water $stat-in-use)))))
+
+; Count cells that were freed. cells is evaluated more than once.
+(defmacro $count-freed (cells)
+    `(if $gc-stats
+        (begin
+            (assign $stat-freed (+ $stat-freed ,cells))
+            (assign $stat-in-use (- $stat-in-use ,cells)))))
+
+; In testbench.v, when register 4095 is written, the simulator will exit.
+; If the allocator statistics are enabled, they are written to registers
+; 4080-4084 first, where testbench.v and simulator.py show them.
 (function halt ()
+    (when $gc-stats
+        (begin
+            (write-register 4080 $stat-allocated)
+            (write-register 4081 $stat-collections)
+            (write-register 4082 $stat-freed)
+            (write-register 4083 $stat-live)
+            (write-register 4084 $stat-high-water)))
     (write-register 4095 0))
 
 ; Note that $heapstart is a variable created automatically
 ; by the compiler.  Wilderness is memory that has never been allocated and
-; that we can simply slice off from.
+; that we can simply slice off from. The garbage collector, and cons, are
+; in a separate file that the compiler chooses (gc-mark-sweep.lisp by
+; default).
 (assign $wilderness-start $heapstart)
 
-; This is called from top level main, so BP will be top of stack
+; This is called from top level main, so BP will be top of stack. The
+; compiler sets $stack-size to the most the program can use, if it can
+; determine that.
 (assign $stacktop (getbp))
-(assign $max-heap (- $stacktop 1024))
-(assign $freelist nil)
-
-; Mark a pointer, following links if it is a pair
-(function $mark-recursive (ptr)
-    ; Check if this is a cons/closure and is not null
-    (when (and ptr (or (list? ptr) (closure? ptr)))
-        (begin
-            (let ((firstword (load ptr)) (tag (gettag firstword)))
-                (when (not (rshift tag 2))
-                    (begin
-                        ; An unmarked cons cell, mark it and continue
-                        (gclog #\M ptr)
-                        (store ptr (settag firstword (bitwise-or tag 4)))
-
-                        ; Check if we need to mark the first pointer
-                        ($mark-recursive (first ptr)))))
-            ($mark-recursive (rest ptr)))))
-
-; Mark a range of contiguous addresses.
-(function $mark-range (start end)
-    (for addr start end 1
-        ($mark-recursive (load addr))))
-
-; Garbage collect, using mark-sweep algorithm
-(function $gc ()
-    (gclog #\G $wilderness-start)
-
-    ;;; Mark phase
-
-    ; Clear GC flags
-    (for ptr $heapstart (- $wilderness-start 1) 2
-        (let ((val (load ptr)) (tag (gettag val)))
-            (store ptr (settag val (bitwise-and tag 3)))))
-    ($mark-range 0 $heapstart)      ; Mark global variables
-    ($mark-range (getbp) $stacktop) ; Mark stack
-
-    ;;; Sweep phase
-    (assign $freelist nil)    ; First clear the freelist so we don't double-add
-    (for ptr $heapstart (- $wilderness-start 1) 2
-        (unless (bitwise-and (gettag (load ptr)) 4)
-            (begin
-                ; This is not used, stick it back in the free list.
-                (store (+ 1 ptr) $freelist)
-                (assign $freelist ptr)
-                (gclog #\F ptr)))))
+(assign $max-heap (- $stacktop $stack-size))
 
 ; Called when we run out of memory
 (function $oom ()
@@ -148,37 +184,6 @@
     ($printchar #\newline)
     (halt))
 
-; Allocate a new cell and return a pointer to it
-(function cons (_first _rest)
-    (let ((ptr nil))
-        (if $freelist
-            ; There are nodes on freelist, grab one.
-            (begin
-                (assign ptr $freelist)
-                (assign $freelist (rest ptr)))
-            ; Nothing on freelist, try to expand frontier
-            (begin
-                (if (< $wilderness-start $max-heap)
-                    ; Space is available in frontier, snag from there.
-                    (begin
-                        (assign ptr $wilderness-start)
-                        (assign $wilderness-start (+ $wilderness-start 2)))
-                    ; No more space available, need to garbage collect
-                    (begin
-                        ($gc)
-                        (if $freelist
-                            ; Then: got a block, assign it
-                            (begin
-                                (assign ptr $freelist)
-                                (assign $freelist (rest ptr)))
-
-                            ; Else: GC gave us nothing, give up.
-                            ($oom))))))
-        (gclog #\A ptr)     ; debug: print cell that has been allocated
-        (store ptr _first)
-        (store (+ ptr 1) _rest)
-        (settag ptr 1)))    ; Mark this as a cons cell and return
-
 (function abs (x)
     (if (< x 0)
         (- 0 x)
@@ -280,6 +285,16 @@
                 ($printchar (+ digit (- #\A 10)))))))    ; - 10 + 'A'
 
 (function print (x)
+    (when (vector? x)
+        (begin
+            ($printchar #\#)
+            ($printchar 40)         ; Open paren
+            (for index 0 (- (vector-length x) 1) 1
+                (begin
+                    (when index
+                        ($printchar #\space))
+                    (print (vector-ref x index))))
+            ($printchar 41)))       ; Close paren
     (when (list? x)
         (begin
             ($printchar 40)         ; Open paren
@@ -290,7 +305,7 @@
                             ($printchar #\space)
                             (assign needspace true))
                         (print element))))
-            ($printchar 41)))        ; Close paren
+            ($printchar 41)))       ; Close paren
     (when (atom? x)
         ; This is a number
         ($printdec x))
@@ -316,9 +331,11 @@
         ($$length-helper (rest list) (+ length 1))
         length))
 
-; Return number of elements in the list
+; Return number of elements in the list or vector
 (function length (list)
-    ($$length-helper list 0))
+    (if (vector? list)
+        (vector-length list)
+        ($$length-helper list 0)))
 
 ; Create a new list that contains all elements if the original with
 ; a new element added on.
@@ -358,14 +375,27 @@
                 true))  ; End of both lists, equal
         false))
 
+(function $compare-vectors (vec1 vec2)
+    (if (= (vector-length vec1) (vector-length vec2))
+        (let ((index 0) (same true))
+            (while (and same (< index (vector-length vec1)))
+                (assign same (equal (vector-ref vec1 index) (vector-ref vec2 index)))
+                (assign index (+ index 1)))
+            same)
+        false)) ; Different lengths
+
 ; Check if two value are isomorphic (have the same form). For example,
-; if two lists contain the same elements.
+; if two lists or vectors contain the same elements.
 (function equal (a b)
     (if (list? a)
         (if (list? b)
             ($compare-lists a b)
             false)
-        (= a b)))   ; Non list type, compare directly
+        (if (vector? a)
+            (if (vector? b)
+                ($compare-vectors a b)
+                false)
+            (= a b))))  ; Non list type, compare directly
 
 ; Call func on each item in the list. Create a new list that
 ; contains only items that func returned a non-zero value for.
@@ -0,0 +1,941 @@
+#!/usr/bin/env python3
+#
+# Copyright 2011-2016 Jeff Bush
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Instruction set simulator for the LISP microcontroller.
+
+ ./simulator.py [-s] [-t] [-c <max cycles>] [program.hex]
+
+This executes the program.hex file produced by compile.py without going
+through the Verilog model. Data memory is initialized from the data.hex
+file in the same directory, if there is one. It mirrors the behavior of lisp_core.v and
+testbench.v: writes to register 0 are printed as characters, and a write
+to register 4095 prints HALTED and stops the simulation. Writes to
+registers 4080-4084 hold the allocator statistics from a program compiled
+with --gc-stats, which are summarized before HALTED. The number of
+instructions executed and the number of clock cycles the hardware would
+have taken are available afterwards (and printed to stderr with -s).
+
+There are two execution engines. Simulator is a straightforward
+decode-and-dispatch interpreter and is the reference. TranslatingSimulator
+(-t) converts each basic block into a python function the first time it
+is executed, which is much faster for long running programs. --verify runs
+both and checks that they agree.
+"""
+
+import argparse
+import io
+import os
+import sys
+
+# Upper 5 bits in each instruction that indicates the operation. These must
+# match compile.py and lisp_core.v
+OP_NOP = 0
+OP_CALL = 1
+OP_RETURN = 2
+OP_POP = 3
+OP_LOAD = 4
+OP_STORE = 5
+OP_ADD = 6
+OP_SUB = 7
+OP_REST = 8
+OP_GTR = 9
+OP_GTE = 10
+OP_EQ = 11
+OP_NEQ = 12
+OP_DUP = 13
+OP_GETTAG = 14
+OP_SETTAG = 15
+OP_AND = 16
+OP_OR = 17
+OP_XOR = 18
+OP_LSHIFT = 19
+OP_RSHIFT = 20
+OP_GETBP = 21
+OP_RESERVE = 24
+OP_PUSH = 25
+OP_GOTO = 26
+OP_BFALSE = 27
+OP_GETLOCAL = 29
+OP_SETLOCAL = 30
+OP_CLEANUP = 31
+
+# Number of clock cycles each instruction spends in the lisp_core state
+# machine (STATE_DECODE plus any follow-on states). Opcodes not listed
+# here (including NOP and unassigned opcodes) take one cycle.
+CYCLE_COUNTS = {
+    OP_CALL: 1,
+    OP_RETURN: 3,       # DECODE, RETURN2, RETURN3
+    OP_POP: 2,          # DECODE, PUSH_MEM_RESULT
+    OP_LOAD: 2,         # DECODE, PUSH_MEM_RESULT
+    OP_STORE: 2,        # DECODE, GOT_STORE_VALUE
+    OP_ADD: 2,          # DECODE, GOT_NOS
+    OP_SUB: 2,
+    OP_REST: 2,         # DECODE, PUSH_MEM_RESULT
+    OP_GTR: 2,
+    OP_GTE: 2,
+    OP_EQ: 2,
+    OP_NEQ: 2,
+    OP_DUP: 1,
+    OP_GETTAG: 1,
+    OP_SETTAG: 2,       # DECODE, GOT_NEW_TAG
+    OP_AND: 2,
+    OP_OR: 2,
+    OP_XOR: 2,
+    OP_LSHIFT: 2,
+    OP_RSHIFT: 2,
+    OP_GETBP: 1,
+    OP_RESERVE: 1,
+    OP_PUSH: 1,
+    OP_GOTO: 1,
+    OP_BFALSE: 2,       # DECODE, BFALSE2
+    OP_GETLOCAL: 3,     # DECODE, GETLOCAL2, PUSH_MEM_RESULT
+    OP_SETLOCAL: 1,
+    OP_CLEANUP: 1
+}
+
+# Configuration of the hardware, from ulisp.v and testbench.v
+DATA_MEM_SIZE = 4096
+INSTR_MEM_SIZE = 4096
+DEFAULT_MAX_CYCLES = 1000000    # testbench.v runs 2,000,000 half clocks
+
+# A data memory address with the top four bits set is a hardware register.
+REGISTER_BASE = 0xf000
+REGISTER_OUTPUT = 0
+REGISTER_HALT = 4095
+
+# The runtime writes allocator statistics to these registers before halting,
+# if the program was compiled with --gc-stats.
+REGISTER_GC_STATS = 4080
+GC_STAT_NAMES = ['cells allocated', 'collections', 'cells freed',
+                 'live cells', 'high water']
+
+# Instructions that take two stack operands and compute a result in the ALU.
+ALU_OPCODES = frozenset([OP_ADD, OP_SUB, OP_GTR, OP_GTE, OP_EQ, OP_NEQ,
+                         OP_AND, OP_OR, OP_XOR, OP_LSHIFT, OP_RSHIFT])
+
+VALUE_MASK = 0xffff     # Bits 15:0 of a data word
+TAG_MASK = 0x70000      # Bits 18:16 of a data word (tag plus GC flag)
+
+
+class SimulatorError(Exception):
+    pass
+
+
+def format_gc_stats(stats):
+    """Summarize the allocator statistics written by the runtime.
+
+    Args:
+        stats (dict): value of each register, keyed by GC_STAT_NAMES
+
+    Returns:
+        The summary, as a line of text.
+    """
+    return 'gc stats: {}\n'.format(', '.join(
+        '{} {}'.format(name, stats[name]) for name in GC_STAT_NAMES
+        if name in stats))
+
+
+def read_hex_file(filename):
+    """Read a file in the format written by compile.py ($readmemh format).
+
+    Args:
+        filename (str): path to the file
+
+    Returns:
+        List of integers, one per line.
+    """
+    values = []
+    with open(filename, 'r') as infile:
+        for line in infile:
+            line = line.strip()
+            if line:
+                values.append(int(line, 16))
+
+    return values
+
+
+class Simulator(object):
+    """Executes a compiled program one instruction at a time.
+
+    The architectural state is the same as lisp_core.v: the top of stack is
+    held in a register and everything below it lives in data memory. Data
+    memory words are 19 bits: a 16 bit value, a 2 bit type tag, and the
+    flag bit used by the garbage collector.
+    """
+
+    def __init__(self, instructions, output=None, data=()):
+        if len(instructions) > INSTR_MEM_SIZE:
+            raise SimulatorError('program is too large ({} instructions)'
+                                 .format(len(instructions)))
+
+        if len(data) > DATA_MEM_SIZE:
+            raise SimulatorError('data is too large ({} words)'
+                                 .format(len(data)))
+
+        self.instructions = list(instructions)
+        self.memory = list(data) + [0] * (DATA_MEM_SIZE - len(data))
+        self.output = output if output is not None else sys.stdout
+        self.halted = False
+        self.gc_stats = {}
+        self.instruction_count = 0
+        self.cycle_count = 0
+
+        # Reset state from lisp_core.v
+        self.ip = 0
+        self.top_of_stack = 0
+        self.stack_pointer = DATA_MEM_SIZE - 8
+        self.frame_pointer = DATA_MEM_SIZE - 4
+
+    def read_register(self, index):
+        """Called when the program loads from a hardware register.
+
+        testbench.v ties register_read_value to zero.
+        """
+        return 0
+
+    def write_register(self, index, value):
+        """Called when the program stores to a hardware register."""
+        if index == REGISTER_OUTPUT:
+            self.output.write(chr(value & 0xff))
+        elif index == REGISTER_HALT:
+            if self.gc_stats:
+                self.output.write(format_gc_stats(self.gc_stats))
+
+            self.output.write('HALTED\n')
+            self.halted = True
+        elif 0 <= index - REGISTER_GC_STATS < len(GC_STAT_NAMES):
+            self.gc_stats[GC_STAT_NAMES[index - REGISTER_GC_STATS]] = value
+        else:
+            self.output.write('set register {:4d} <= {:5d}\n'
+                              .format(index, value))
+
+    def load(self, address):
+        if address >= REGISTER_BASE:
+            return self.read_register(address & 0xfff) & VALUE_MASK
+
+        if address >= DATA_MEM_SIZE:
+            raise SimulatorError('load from invalid address {:04x} (pc {})'
+                                 .format(address, self.ip))
+
+        return self.memory[address]
+
+    def store(self, address, value):
+        if address >= REGISTER_BASE:
+            self.write_register(address & 0xfff, value & VALUE_MASK)
+        elif address >= DATA_MEM_SIZE:
+            raise SimulatorError('store to invalid address {:04x} (pc {})'
+                                 .format(address, self.ip))
+        else:
+            self.memory[address] = value
+
+    def run(self, max_cycles=DEFAULT_MAX_CYCLES):
+        """Execute instructions until the program halts or the cycle limit is hit.
+
+        Args:
+            max_cycles (int): stop after this many clock cycles
+
+        Returns:
+            True if the program halted, False if it ran out of cycles.
+        """
+        instructions = self.instructions
+        num_instructions = len(instructions)
+        memory = self.memory
+        load = self.load
+        store = self.store
+        cycle_counts = [CYCLE_COUNTS.get(op, 1) for op in range(32)]
+        ip = self.ip
+        tos = self.top_of_stack
+        sp = self.stack_pointer
+        fp = self.frame_pointer
+        instruction_count = self.instruction_count
+        cycle_count = self.cycle_count
+
+        try:
+            while cycle_count < max_cycles:
+                # Uninitialized instruction memory reads as zero (nop)
+                word = instructions[ip] if ip < num_instructions else 0
+                opcode = word >> 16
+                param = word & 0xffff
+                instruction_count += 1
+                cycle_count += cycle_counts[opcode]
+                next_ip = (ip + 1) & 0xffff
+
+                if opcode == OP_PUSH:
+                    sp -= 1
+                    memory[sp] = tos
+                    tos = param
+                elif opcode == OP_GETLOCAL:
+                    sp -= 1
+                    memory[sp] = tos
+                    tos = memory[(fp + param) & 0xffff]
+                elif opcode == OP_SETLOCAL:
+                    memory[(fp + param) & 0xffff] = tos
+                elif opcode == OP_POP:
+                    tos = memory[sp]
+                    sp += 1
+                elif opcode == OP_BFALSE:
+                    if not tos & VALUE_MASK:
+                        next_ip = param
+
+                    tos = memory[sp]
+                    sp += 1
+                elif opcode == OP_GOTO:
+                    next_ip = param
+                elif opcode == OP_CALL:
+                    next_ip = tos & VALUE_MASK
+                    sp -= 1
+                    memory[sp] = fp
+                    fp = sp
+                    tos = (ip + 1) & 0xffff
+                elif opcode == OP_RETURN:
+                    next_ip = memory[(fp - 1) & 0xffff] & VALUE_MASK
+                    sp = (fp + 1) & 0xffff
+                    fp = memory[fp] & VALUE_MASK
+                elif opcode == OP_CLEANUP:
+                    sp = (sp + param) & 0xffff
+                elif opcode == OP_RESERVE:
+                    if param:
+                        memory[sp - 1] = tos
+                        sp = (sp - param) & 0xffff
+                elif opcode == OP_LOAD:
+                    self.ip = ip
+                    tos = load(tos & VALUE_MASK)
+                elif opcode == OP_REST:
+                    self.ip = ip
+                    tos = load((tos + 1) & VALUE_MASK)
+                elif opcode == OP_STORE:
+                    self.ip = ip
+                    value = memory[sp]
+                    sp += 1
+                    store(tos & VALUE_MASK, value)
+                    tos = value
+                    if self.halted:
+                        ip = next_ip
+                        break
+                elif opcode == OP_DUP:
+                    sp -= 1
+                    memory[sp] = tos
+                elif opcode == OP_GETTAG:
+                    tos = tos >> 16
+                elif opcode == OP_SETTAG:
+                    tos = ((memory[sp] & 7) << 16) | (tos & VALUE_MASK)
+                    sp += 1
+                elif opcode == OP_GETBP:
+                    sp -= 1
+                    memory[sp] = tos
+                    tos = fp
+                elif opcode in ALU_OPCODES:
+                    # Binary ALU operation. The first operand is the top of
+                    # stack, the second is next on stack. The result keeps
+                    # the tag of the top of stack.
+                    op0 = tos & VALUE_MASK
+                    op1 = memory[sp] & VALUE_MASK
+                    sp += 1
+                    tos = (tos & TAG_MASK) | alu(opcode, op0, op1)
+
+                # Anything else is a nop
+                ip = next_ip
+        except IndexError:
+            raise SimulatorError('stack access out of range (pc {} sp {} fp {})'
+                                 .format(ip, sp, fp))
+        finally:
+            self.ip = ip
+            self.top_of_stack = tos
+            self.stack_pointer = sp
+            self.frame_pointer = fp
+            self.instruction_count = instruction_count
+            self.cycle_count = cycle_count
+
+        return self.halted
+
+
+def alu(opcode, op0, op1):
+    """Compute the 16 bit result of a two operand instruction.
+
+    Comparisons are performed the same way the hardware does it: by looking
+    at the sign and zero flags of op0 - op1.
+    """
+    if opcode == OP_ADD:
+        return (op0 + op1) & VALUE_MASK
+    elif opcode == OP_SUB:
+        return (op0 - op1) & VALUE_MASK
+    elif opcode == OP_AND:
+        return op0 & op1
+    elif opcode == OP_OR:
+        return op0 | op1
+    elif opcode == OP_XOR:
+        return op0 ^ op1
+    elif opcode == OP_LSHIFT:
+        return (op0 << op1) & VALUE_MASK if op1 < 16 else 0
+    elif opcode == OP_RSHIFT:
+        return op0 >> op1
+
+    diff = (op0 - op1) & VALUE_MASK
+    if opcode == OP_GTR:
+        return 1 if diff != 0 and not diff & 0x8000 else 0
+    elif opcode == OP_GTE:
+        return 0 if diff & 0x8000 else 1
+    elif opcode == OP_EQ:
+        return 1 if diff == 0 else 0
+    elif opcode == OP_NEQ:
+        return 1 if diff != 0 else 0
+
+    raise SimulatorError('internal error: bad ALU opcode {}'.format(opcode))
+
+
+# Python source for the 16 bit result of an ALU operation, given
+# expressions for the (already masked) operands.
+ALU_EXPRESSIONS = {
+    OP_ADD: '(({0} + {1}) & 0xffff)',
+    OP_SUB: '(({0} - {1}) & 0xffff)',
+    OP_AND: '({0} & {1})',
+    OP_OR: '({0} | {1})',
+    OP_XOR: '({0} ^ {1})',
+    OP_LSHIFT: '((({0} << {1}) & 0xffff) if {1} < 16 else 0)',
+    OP_RSHIFT: '({0} >> {1})',
+    OP_GTR: '(1 if 0 < (({0} - {1}) & 0xffff) < 0x8000 else 0)',
+    OP_GTE: '(0 if ({0} - {1}) & 0x8000 else 1)',
+    OP_EQ: '(1 if {0} == {1} else 0)',
+    OP_NEQ: '(0 if {0} == {1} else 1)'
+}
+
+# This is the sequence compile_function_call emits to check if the callee is
+# a closure and, if so, store its environment in $closure and replace it
+# with the function address. The bfalse skips to the call at the end. The
+# translator executes the whole thing as a single step.
+CLOSURE_DISPATCH = [
+    (OP_DUP, 0),
+    (OP_GETTAG, 0),
+    (OP_PUSH, 3),       # TAG_CLOSURE
+    (OP_EQ, 0),
+    (OP_BFALSE, None),  # Branch to the call below
+    (OP_DUP, 0),
+    (OP_REST, 0),
+    (OP_PUSH, 1),       # Address of $closure
+    (OP_STORE, 0),
+    (OP_POP, 0),
+    (OP_LOAD, 0),
+    (OP_CALL, 0)
+]
+
+CLOSURE_PATH_INSTRUCTIONS = 6
+CLOSURE_PATH_CYCLES = sum(CYCLE_COUNTS[op] for op, _ in CLOSURE_DISPATCH[5:11])
+
+MAX_BLOCK_LENGTH = 256
+
+
+class BlockHalt(Exception):
+    """Raised by translated code when the program halts in the middle of a block.
+
+    This carries the architectural state at that point and the number of
+    instructions and cycles executed in the block so far.
+    """
+
+    def __init__(self, ip, tos, sp, fp, instruction_count, cycle_count):
+        Exception.__init__(self)
+        self.state = (ip, tos, sp, fp)
+        self.instruction_count = instruction_count
+        self.cycle_count = cycle_count
+
+
+class TranslatedBlock(object):
+    def __init__(self, function, instruction_count, cycle_count, source):
+        self.function = function
+        self.instruction_count = instruction_count
+        self.cycle_count = cycle_count
+        self.source = source
+
+
+def is_constant(expr):
+    return expr.isdigit()
+
+
+def low16(expr):
+    """Python expression for the value bits of a data word."""
+    return expr if is_constant(expr) else '({} & 0xffff)'.format(expr)
+
+
+class BlockTranslator(object):
+    """Convert a run of instructions into a specialized python function.
+
+    The generated function has the signature:
+
+        block(memory, tos, sp, fp) -> (next ip, tos, sp, fp)
+
+    Within a block, the translator keeps track of the stack pointer
+    adjustment statically and remembers what values were spilled to the
+    stack, so sequences like 'push N; getlocal M; add' compile to a single
+    python expression without reading back the intermediate values.
+    Every memory write the hardware would perform is still made, so the
+    contents of data memory are identical to the reference interpreter.
+    """
+
+    def __init__(self, instructions, leaders):
+        self.instructions = instructions
+        self.leaders = leaders
+
+    def fetch(self, pc):
+        if pc < len(self.instructions):
+            word = self.instructions[pc]
+            return word >> 16, word & 0xffff
+
+        return OP_NOP, 0
+
+    def translate(self, start_pc):
+        self.lines = []
+        self.indent = 1
+        self.next_temp = 0
+        self.sp_offset = 0     # Current sp, relative to sp on block entry
+        self.known = {}        # sp offset -> expression for value in memory
+        self.tos = 'tos'
+        self.instruction_count = 0
+        self.cycle_count = 0
+        visited = set()
+
+        pc = start_pc
+        while True:
+            visited.add(pc)
+            if self.match_closure_dispatch(pc):
+                self.emit_closure_dispatch(pc)
+                break
+
+            opcode, param = self.fetch(pc)
+            self.instruction_count += 1
+            self.cycle_count += CYCLE_COUNTS.get(opcode, 1)
+            next_pc = (pc + 1) & 0xffff
+            if opcode == OP_GOTO:
+                if param in visited or \
+                        self.instruction_count >= MAX_BLOCK_LENGTH:
+                    self.emit_exit(str(param))
+                    break
+
+                # Continue translating at the destination
+                pc = param
+                continue
+            elif opcode == OP_BFALSE:
+                cond = low16(self.tos)
+                self.tos = self.pop_value()
+                self.emit('if not {}:'.format(cond))
+                self.indent += 1
+                self.emit_exit(str(param))
+                self.indent -= 1
+                self.emit_exit(str(next_pc))
+                break
+            elif opcode == OP_CALL:
+                self.emit_call(pc, self.tos)
+                break
+            elif opcode == OP_RETURN:
+                self.emit('return (memory[fp - 1] & 0xffff, {}, fp + 1, '
+                          'memory[fp] & 0xffff)'.format(self.tos))
+                break
+
+            self.translate_instruction(pc, opcode, param)
+            pc = next_pc
+            if pc in self.leaders or \
+                    self.instruction_count >= MAX_BLOCK_LENGTH:
+                self.emit_exit(str(pc))
+                break
+
+        source = 'def block(memory, tos, sp, fp):\n' + '\n'.join(self.lines) \
+            + '\n'
+        return source, self.instruction_count, self.cycle_count
+
+    def translate_instruction(self, pc, opcode, param):
+        if opcode == OP_PUSH:
+            self.push(str(param))
+        elif opcode == OP_GETLOCAL:
+            self.spill_tos()
+            self.tos = self.new_temp('memory[fp + {}]'.format(
+                param - 0x10000 if param & 0x8000 else param))
+        elif opcode == OP_SETLOCAL:
+            self.emit('memory[fp + {}] = {}'.format(
+                param - 0x10000 if param & 0x8000 else param, self.tos))
+            self.known = {}     # Could alias a stack location
+        elif opcode == OP_POP:
+            self.tos = self.pop_value()
+        elif opcode == OP_DUP:
+            self.spill_tos()
+        elif opcode == OP_GETBP:
+            self.push('fp')
+        elif opcode == OP_CLEANUP:
+            self.sp_offset += param
+        elif opcode == OP_RESERVE:
+            if param:
+                self.spill_tos()
+                self.sp_offset -= param - 1
+        elif opcode == OP_GETTAG:
+            if is_constant(self.tos):
+                self.tos = '0'
+            else:
+                self.tos = self.new_temp('{} >> 16'.format(self.tos))
+        elif opcode == OP_SETTAG:
+            nos = self.pop_value()
+            self.tos = self.new_temp('(({} & 7) << 16) | {}'.format(
+                nos, low16(self.tos)))
+        elif opcode == OP_LOAD:
+            self.tos = self.emit_load(low16(self.tos), pc)
+        elif opcode == OP_REST:
+            self.tos = self.emit_load('(({} + 1) & 0xffff)'.format(self.tos),
+                                      pc)
+        elif opcode == OP_STORE:
+            value = self.pop_value()
+            self.emit('a = {}'.format(low16(self.tos)))
+            self.emit('if a < {}:'.format(DATA_MEM_SIZE))
+            self.emit('    memory[a] = {}'.format(value))
+            self.emit('else:')
+            self.emit('    store(a, {})'.format(value))
+            self.emit('    if sim.halted:')
+            self.emit('        raise BlockHalt({}, {}, sp + {}, fp, {}, {})'
+                      .format((pc + 1) & 0xffff, value, self.sp_offset,
+                              self.instruction_count, self.cycle_count))
+            self.known = {}
+            self.tos = value
+        elif opcode in ALU_OPCODES:
+            nos = self.pop_value()
+            if is_constant(self.tos) and is_constant(nos):
+                self.tos = str(alu(opcode, int(self.tos), int(nos)))
+            else:
+                result = ALU_EXPRESSIONS[opcode].format(low16(self.tos),
+                                                        low16(nos))
+                if not is_constant(self.tos):
+                    result = '({} & 0x70000) | {}'.format(self.tos, result)
+
+                self.tos = self.new_temp(result)
+
+        # Anything else is a nop
+
+    def emit(self, line):
+        self.lines.append('    ' * self.indent + line)
+
+    def new_temp(self, expr):
+        name = 't{}'.format(self.next_temp)
+        self.next_temp += 1
+        self.emit('{} = {}'.format(name, expr))
+        return name
+
+    def sp_expr(self, offset):
+        if offset == 0:
+            return 'sp'
+        elif offset > 0:
+            return 'sp + {}'.format(offset)
+        else:
+            return 'sp - {}'.format(-offset)
+
+    def spill_tos(self):
+        """Write the top of stack register to memory (first half of a push)."""
+        self.sp_offset -= 1
+        self.emit('memory[{}] = {}'.format(self.sp_expr(self.sp_offset),
+                                           self.tos))
+        self.known[self.sp_offset] = self.tos
+
+    def push(self, expr):
+        self.spill_tos()
+        self.tos = expr
+
+    def pop_value(self):
+        """Return an expression for the next-on-stack value and remove it."""
+        value = self.known.get(self.sp_offset)
+        if value is None:
+            value = self.new_temp('memory[{}]'.format(
+                self.sp_expr(self.sp_offset)))
+
+        self.sp_offset += 1
+        return value
+
+    def emit_load(self, address, pc):
+        self.emit('a = {}'.format(address))
+        return self.new_temp('memory[a] if a < {} else load(a)'.format(
+            DATA_MEM_SIZE))
+
+    def emit_exit(self, next_pc):
+        self.emit('return ({}, {}, {}, fp)'.format(
+            next_pc, self.tos, self.sp_expr(self.sp_offset)))
+
+    def emit_call(self, pc, target):
+        self.spill_frame_pointer()
+        self.emit('return ({} & 0xffff, {}, {}, {})'.format(
+            target, (pc + 1) & 0xffff, self.sp_expr(self.sp_offset),
+            self.sp_expr(self.sp_offset)))
+
+    def spill_frame_pointer(self):
+        self.sp_offset -= 1
+        self.emit('memory[{}] = fp'.format(self.sp_expr(self.sp_offset)))
+
+    def match_closure_dispatch(self, pc):
+        for index, (opcode, param) in enumerate(CLOSURE_DISPATCH):
+            actual_opcode, actual_param = self.fetch(pc + index)
+            if actual_opcode != opcode:
+                return False
+
+            if param is None:
+                if actual_param != pc + len(CLOSURE_DISPATCH) - 1:
+                    return False
+            elif actual_param != param:
+                return False
+
+        return True
+
+    def emit_closure_dispatch(self, pc):
+        """Emit code for the CLOSURE_DISPATCH sequence starting at pc."""
+        self.instruction_count += 5     # Up to and including the bfalse
+        self.cycle_count += sum(CYCLE_COUNTS[op] for op, _ in
+                                CLOSURE_DISPATCH[:5])
+        callee = self.tos
+        self.spill_tos()    # dup
+        tag = self.new_temp('{} >> 16'.format(callee))
+        self.spill_value(tag, self.sp_offset - 1)   # push 3
+        self.emit('if {} == 3:'.format(tag))
+        self.indent += 1
+        env = self.new_temp('memory[a] if (a := ({} + 1) & 0xffff) < {} '
+                            'else load(a)'.format(callee, DATA_MEM_SIZE))
+        self.spill_value(env, self.sp_offset - 1)
+        self.emit('memory[1] = {}'.format(env))
+        self.emit('target = memory[a] if (a := {}) < {} else load(a)'.format(
+            low16(callee), DATA_MEM_SIZE))
+        self.emit('extra[0] += {}'.format(CLOSURE_PATH_INSTRUCTIONS))
+        self.emit('extra[1] += {}'.format(CLOSURE_PATH_CYCLES))
+        self.indent -= 1
+        self.emit('else:')
+        self.emit('    target = {}'.format(callee))
+        self.sp_offset += 1     # Both paths pop back to where they started
+
+        # This is where the bfalse lands
+        self.instruction_count += 1
+        self.cycle_count += CYCLE_COUNTS[OP_CALL]
+        self.emit_call(pc + len(CLOSURE_DISPATCH) - 1, 'target')
+
+    def spill_value(self, expr, offset):
+        self.emit('memory[{}] = {}'.format(self.sp_expr(offset), expr))
+
+
+def find_leaders(instructions, function_addresses=()):
+    """Find instructions that begin a basic block.
+
+    These are function entry points and the destinations of branches.
+    """
+    leaders = set(function_addresses)
+    leaders.add(0)
+    for pc, word in enumerate(instructions):
+        opcode = word >> 16
+        if opcode == OP_GOTO or opcode == OP_BFALSE:
+            leaders.add(word & 0xffff)
+
+    return leaders
+
+
+def read_listing_functions(filename):
+    """Get the start address of each function from a program.lst file.
+
+    Returns:
+        List of (name, address) tuples.
+    """
+    functions = []
+    current_name = None
+    with open(filename, 'r') as infile:
+        for line in infile:
+            line = line.rstrip()
+            if line.endswith(':') and not line.startswith(' ') and \
+                    line != 'Globals:':
+                current_name = line[:-1]
+            elif current_name is not None and line.startswith('    ') and \
+                    not line.lstrip().startswith(';'):
+                functions.append((current_name, int(line.split()[0])))
+                current_name = None
+
+    return functions
+
+
+class TranslatingSimulator(Simulator):
+    """Executes a program by translating basic blocks into python functions.
+
+    Each block is translated the first time execution reaches it and is
+    cached by its entry address. This produces the same results as
+    Simulator (including instruction and cycle counts), but runs
+    considerably faster. The cycle limit is only checked between blocks,
+    so it may be exceeded by the length of one block.
+    """
+
+    def __init__(self, instructions, output=None, function_addresses=(),
+                 data=()):
+        Simulator.__init__(self, instructions, output, data)
+        self.translator = BlockTranslator(
+            self.instructions,
+            find_leaders(self.instructions, function_addresses))
+        self.blocks = {}
+        self.extra_counts = [0, 0]
+        self.namespace = {
+            'load': self.load,
+            'store': self.store,
+            'sim': self,
+            'extra': self.extra_counts,
+            'BlockHalt': BlockHalt
+        }
+
+    def get_block(self, pc):
+        block = self.blocks.get(pc)
+        if block is None:
+            source, instruction_count, cycle_count = \
+                self.translator.translate(pc)
+            namespace = dict(self.namespace)
+            exec(compile(source, '<block {}>'.format(pc), 'exec'), namespace)
+            block = TranslatedBlock(namespace['block'], instruction_count,
+                                    cycle_count, source)
+            self.blocks[pc] = block
+
+        return block
+
+    def run(self, max_cycles=DEFAULT_MAX_CYCLES):
+        memory = self.memory
+        blocks = self.blocks
+        get_block = self.get_block
+        extra = self.extra_counts
+        ip = self.ip
+        tos = self.top_of_stack
+        sp = self.stack_pointer
+        fp = self.frame_pointer
+        instruction_count = self.instruction_count
+        cycle_count = self.cycle_count
+
+        try:
+            while cycle_count < max_cycles:
+                block = blocks.get(ip)
+                if block is None:
+                    self.ip = ip
+                    block = get_block(ip)
+
+                ip, tos, sp, fp = block.function(memory, tos, sp, fp)
+                instruction_count += block.instruction_count
+                cycle_count += block.cycle_count
+        except BlockHalt as halt:
+            ip, tos, sp, fp = halt.state
+            instruction_count += halt.instruction_count
+            cycle_count += halt.cycle_count
+        except IndexError:
+            raise SimulatorError('stack access out of range (block {} sp {} '
+                                 'fp {})'.format(ip, sp, fp))
+        finally:
+            self.ip = ip
+            self.top_of_stack = tos
+            self.stack_pointer = sp
+            self.frame_pointer = fp
+            self.instruction_count = instruction_count + extra[0]
+            self.cycle_count = cycle_count + extra[1]
+            extra[0] = 0
+            extra[1] = 0
+
+        return self.halted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('hexfile', nargs='?', default='program.hex',
+                        help='program to run (default program.hex)')
+    parser.add_argument('-c', '--max-cycles', type=int,
+                        default=DEFAULT_MAX_CYCLES,
+                        help='stop simulation after this many clock cycles')
+    parser.add_argument('-s', '--stats', action='store_true',
+                        help='print instruction and cycle counts to stderr')
+    parser.add_argument('-t', '--translate', action='store_true',
+                        help='translate basic blocks to python (faster)')
+    parser.add_argument('--verify', action='store_true',
+                        help='run with both engines and compare the results')
+    args = parser.parse_args()
+
+    instructions = read_hex_file(args.hexfile)
+    data = []
+    datafile = os.path.join(os.path.dirname(args.hexfile), 'data.hex')
+    if os.path.exists(datafile):
+        data = read_hex_file(datafile)
+
+    # The listing has the function boundaries, which are used to split
+    # blocks.
+    function_addresses = []
+    listfile = os.path.splitext(args.hexfile)[0] + '.lst'
+    if os.path.exists(listfile):
+        function_addresses = [address for _, address in
+                              read_listing_functions(listfile)]
+
+    sim = None
+    try:
+        if args.verify:
+            sys.exit(0 if verify(instructions, function_addresses,
+                                 args.max_cycles, data) else 1)
+
+        # The constructors check that the program and data fit in memory.
+        if args.translate:
+            sim = TranslatingSimulator(instructions,
+                                       function_addresses=function_addresses,
+                                       data=data)
+        else:
+            sim = Simulator(instructions, data=data)
+
+        sim.run(args.max_cycles)
+    except SimulatorError as ex:
+        print('Simulator error: ' + str(ex), file=sys.stderr)
+        sys.exit(1)
+    finally:
+        sys.stdout.flush()
+        if args.stats and sim:
+            print('instructions: {}'.format(sim.instruction_count),
+                  file=sys.stderr)
+            print('cycles: {}'.format(sim.cycle_count), file=sys.stderr)
+
+
+def verify(instructions, function_addresses, max_cycles, data=()):
+    """Check the translating simulator against the reference interpreter.
+
+    The program is run to completion with each and the output, counters and
+    final machine state are compared.
+
+    Returns:
+        True if the results matched.
+    """
+    results = []
+    for sim in [Simulator(instructions, io.StringIO(), data),
+                TranslatingSimulator(instructions, io.StringIO(),
+                                     function_addresses, data)]:
+        sim.run(max_cycles)
+        results.append(sim)
+
+    reference, translated = results
+    if reference.halted and reference.cycle_count != translated.cycle_count:
+        # The translated version only checks the cycle limit between blocks,
+        # so only compare this if the program finished.
+        print('cycle count mismatch: {} {}'.format(reference.cycle_count,
+                                                   translated.cycle_count))
+        return False
+
+    for attr in ['halted', 'instruction_count', 'ip', 'top_of_stack',
+                 'stack_pointer', 'frame_pointer', 'memory']:
+        if not reference.halted and attr != 'halted':
+            break
+
+        if getattr(reference, attr) != getattr(translated, attr):
+            print('{} mismatch'.format(attr))
+            return False
+
+    if reference.output.getvalue() != translated.output.getvalue():
+        print('output mismatch')
+        return False
+
+    print('PASS ({} instructions, {} cycles)'.format(
+        reference.instruction_count, reference.cycle_count))
+    return True
+
+
+if __name__ == '__main__':
+    main()
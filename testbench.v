@@ -31,6 +31,10 @@ module testbench;
     reg[15:0] register_read_value = 0;
     reg halt = 0;
 
+    // Allocator statistics (registers 4080-4084, see runtime.lisp)
+    reg[15:0] gc_stats[0:4];
+    reg gc_stats_written = 0;
+
     ulisp l(
         .clk(clk),
         .reset(reset),
@@ -67,9 +71,20 @@ module testbench;
                 $write("%c", register_write_value);
             else if (register_index == 4095)
             begin
+                if (gc_stats_written)
+                begin
+                    $display("gc stats: cells allocated %0d, collections %0d, cells freed %0d, live cells %0d, high water %0d",
+                        gc_stats[0], gc_stats[1], gc_stats[2], gc_stats[3], gc_stats[4]);
+                end
+
                 $display("HALTED");
                 halt = 1;
             end
+            else if (register_index >= 4080 && register_index <= 4084)
+            begin
+                gc_stats[register_index - 4080] = register_write_value;
+                gc_stats_written = 1;
+            end
             else
                 $display("set register %d <= %d", register_index, register_write_value);
         end
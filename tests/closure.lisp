@@ -102,3 +102,31 @@
     (func))
 
 ; CHECK: 2829303132
+
+; A closure with several free variables
+(function make-adder3 (a b c)
+    (function (x) (+ x (+ a (+ b c)))))
+
+(print ((make-adder3 100 20 3) 4000)) ; CHECK: 4123
+
+; Parameters that are passed only closures, only functions, or both
+(function apply-twice (f x)
+    (f (f x)))
+
+(function apply-once (f x)
+    (f x))
+
+(function apply-either (f x)
+    (f x))
+
+(function make-scaler (scale)
+    (function (x) (* x scale)))
+
+(print (apply-twice (make-scaler 3) 5)) ; CHECK: 45
+(print (apply-once (function (x) (+ x 1)) 5)) ; CHECK: 6
+(print (apply-either (make-scaler 2) 5)) ; CHECK: 10
+(print (apply-either (function (x) (- x 1)) 5)) ; CHECK: 4
+
+; A function that escapes can be called with anything
+(assign indirect apply-once)
+(print (indirect (make-scaler 7) 6)) ; CHECK: 42
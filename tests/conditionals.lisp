@@ -15,8 +15,8 @@
 ;
 
 ; Use variables so the optimizer doesn't hard code these values
-(assign yes 1)
-(assign no 0)
+(defvar yes 1)
+(defvar no 0)
 
 (if yes (print 1) (print 0)) ; CHECK: 1
 (if no (print 1) (print 0)) ; CHECK: 0
@@ -0,0 +1,70 @@
+;
+; Copyright 2011-2013 Jeff Bush
+;
+; Licensed under the Apache License, Version 2.0 (the "License");
+; you may not use this file except in compliance with the License.
+; You may obtain a copy of the License at
+;
+;     http://www.apache.org/licenses/LICENSE-2.0
+;
+; Unless required by applicable law or agreed to in writing, software
+; distributed under the License is distributed on an "AS IS" BASIS,
+; WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+; See the License for the specific language governing permissions and
+; limitations under the License.
+;
+
+; Global constants. Inspect program.lst to verify these are replaced with
+; immediate pushes and don't have global variable slots.
+
+(defconstant WIDTH 12)
+(defconstant AREA (* WIDTH 3))  ; Constants can use other constants
+(defconstant ENABLED true)
+
+(print WIDTH) ; CHECK: 12
+(print AREA) ; CHECK: 36
+(print ENABLED) ; CHECK: 1
+(print (- AREA WIDTH)) ; CHECK: 24
+(print (not ENABLED)) ; CHECK: 0
+(print (if (not (- WIDTH 12)) 5 6)) ; CHECK: 5
+
+; A global that is only assigned once, with a literal, is also a constant
+(assign limit 7)
+
+(function below-limit (x)
+    (< x limit))
+
+(print (below-limit 3)) ; CHECK: 1
+(print (below-limit 9)) ; CHECK: 0
+
+; Local variables with the same name hide the constant
+(function hide-param (WIDTH)
+    (+ WIDTH 1))
+
+(print (hide-param 100)) ; CHECK: 101
+
+(print (let ((limit 3)) (+ limit WIDTH))) ; CHECK: 15
+
+; Constants captured by a closure
+(function make-scaler (factor)
+    (function (x) (+ (* x factor) WIDTH)))
+
+(print ((make-scaler 2) 5)) ; CHECK: 22
+
+; This global is read before its only assignment runs, so it can't be
+; a constant.
+(function get-late ()
+    late)
+
+(print (get-late)) ; CHECK: 0
+(assign late 5)
+(print (get-late)) ; CHECK: 5
+
+; defvar makes a variable, even if it is only assigned once
+(defvar speed 4)
+(print speed) ; CHECK: 4
+
+; Assigned more than once
+(assign counter 1)
+(assign counter (+ counter 1))
+(print counter) ; CHECK: 2
@@ -33,9 +33,9 @@
 ; CHECK: 13579
 
 ; Parameters are variables
-(assign start 1)
-(assign end 13)
-(assign step 2)
+(defvar start 1)
+(defvar end 13)
+(defvar step 2)
 (for j start end step
     (print j))
 
@@ -53,3 +53,16 @@
         ($printchar (+ i j))))
 
 ; CHECK: ABCDEBCDEFCDEFGDEFGH
+
+; Comparisons wrap around at 16 bits. The loop stops when a - b reaches
+; 0x8000, which counts as negative.
+(function count-down (a b)
+    (let ((n 0))
+        (while (> a b)
+            (assign n (+ n 1))
+            (assign b (- b 1)))
+        n))
+
+(print (count-down 1 -32765))
+
+; CHECK: 2
@@ -0,0 +1,38 @@
+;
+; Copyright 2011-2016 Jeff Bush
+;
+; Licensed under the Apache License, Version 2.0 (the "License");
+; you may not use this file except in compliance with the License.
+; You may obtain a copy of the License at
+;
+;     http://www.apache.org/licenses/LICENSE-2.0
+;
+; Unless required by applicable law or agreed to in writing, software
+; distributed under the License is distributed on an "AS IS" BASIS,
+; WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+; See the License for the specific language governing permissions and
+; limitations under the License.
+;
+
+
+; Marking must not use stack space in proportion to the depth of a
+; structure. This builds a list nested 700 deep through first, which would
+; need much more stack than is available to mark recursively, then
+; allocates enough garbage to force a collection.
+(assign deep nil)
+(for i 1 700 1
+    (assign deep (cons deep i)))
+
+(for i 1 1500 1
+    (cons i i))
+
+(let ((node deep) (depth 0) (expected 700))
+    (while node
+        (if (= (rest node) expected)
+            (assign depth (+ depth 1))
+            ($printchar #\X))
+        (assign expected (- expected 1))
+        (assign node (first node)))
+    ($printdec depth))
+
+; CHECK: 700
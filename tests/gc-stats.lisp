@@ -0,0 +1,35 @@
+;
+; Copyright 2011-2016 Jeff Bush
+;
+; Licensed under the Apache License, Version 2.0 (the "License");
+; you may not use this file except in compliance with the License.
+; You may obtain a copy of the License at
+;
+;     http://www.apache.org/licenses/LICENSE-2.0
+;
+; Unless required by applicable law or agreed to in writing, software
+; distributed under the License is distributed on an "AS IS" BASIS,
+; WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+; See the License for the specific language governing permissions and
+; limitations under the License.
+;
+
+;
+; Allocator statistics. runtests.py always compiles this with --gc-stats.
+; Nothing here fills the heap, so the only collections are the ones it
+; asks for, and the counts are the same with either garbage collector.
+;
+
+(assign keep (list 1 2 3 4 5 6 7 8 9 10))   ; 10 cells, kept
+(assign vec (make-vector 3))                ; 3 cells, kept
+(for i 1 20 1
+    (cons i i))                             ; 20 cells of garbage
+($gc)
+(assign keep (rest keep))                   ; Drop one cell
+(for i 1 5 1
+    (assign keep (cons i keep)))            ; 5 more cells, kept
+($gc)
+(print (length keep))                       ; Printing allocates 2 cells
+
+; CHECK: 14
+; CHECK: gc stats: cells allocated 40, collections 2, cells freed 21, live cells 17, high water 33
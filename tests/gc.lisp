@@ -43,3 +43,50 @@
 (print b) ; CHECK: (5 6 7 8)
 (print e) ; CHECK: (17 18 19 20 21 22 23 24)
 (print f) ; CHECK: (25 26 27 28)
+
+; Literals are in static data, which isn't garbage collected. If one is
+; modified to point to the heap, those cells must not be freed.
+(assign h '(0))
+(setnext h (list 29 30))
+($gc)
+(assign i (list 31 32 33 34))   ; Would clobber the cells if they were freed
+(print h) ; CHECK: (0 29 30)
+(print i) ; CHECK: (31 32 33 34)
+
+; Lists with several elements allocate all of their cells at once. Fill the
+; heap with them, so they come from the wilderness, then the free list after
+; garbage collecting, and then from cons when the free list is too short.
+(function check-lists (count)
+    (let ((kept nil) (ok 1))
+        (for n 1 count 1
+            (let ((l (list n (+ n 1) (+ n 2) (+ n 3) (+ n 4))))
+                (unless (equal l (list n (+ n 1) (+ n 2) (+ n 3) (+ n 4)))
+                    (assign ok 0))
+                (when (= (bitwise-and n 15) 0)
+                    (assign kept (cons l kept)))))
+        (foreach l kept
+            (unless (= (nth l 4) (+ (first l) 4))
+                (assign ok 0)))
+        (print (length kept))
+        (print ok)))
+
+(check-lists 300) ; CHECK: 18
+; CHECK: 1
+
+; The garbage collector must not change values the program reads back. A
+; closure or function read from the rest of a cell allocated after a
+; collection still has to be callable.
+(function make-adder (n)
+    (function (x) (+ x n)))
+
+(function add-one (x)
+    (+ x 1))
+
+(assign pair (cons 0 (make-adder 10)))
+(print ((rest pair) 1))     ; CHECK: 11
+($gc)
+(assign pair (cons 0 (make-adder 20)))
+(print (gettag (rest pair)))    ; CHECK: 3
+(print ((rest pair) 1))     ; CHECK: 21
+(assign pair (cons 0 add-one))
+(print ((rest pair) 1))     ; CHECK: 2
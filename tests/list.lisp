@@ -49,6 +49,8 @@
 
 (assign foo 24)
 (print (list 25 26 foo))  ; CHECK: (25 26 24)
+(print (equal (list 1 2) (list 1 2)))  ; CHECK: 1
+(print (list))  ; CHECK: 0
 
 (print (reverse '(27 28 29 30 31)))
 ; CHECK: (31 30 29 28 27)
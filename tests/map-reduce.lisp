@@ -38,3 +38,18 @@
 (print (sum-of-squares '(8 9 10 11)))   ; CHECK: 366
 (print (sum-of-squares nil))            ; CHECK: 0
 (print (sum-of-squares '()))            ; CHECK: 0
+
+; Anonymous functions, closures, and functions passed through another
+; higher order function
+(print (map '(1 2 3) (function (x) (+ x 10)))) ; CHECK: (11 12 13)
+
+(function scale-all (values factor)
+    (map values (function (x) (* x factor))))
+
+(print (scale-all '(1 2 3) 3))          ; CHECK: (3 6 9)
+
+(function sum-of (values func)
+    (reduce (map values func) sum))
+
+(print (sum-of '(1 2 3) square))        ; CHECK: 14
+(print (sum-of '(1 2 3) (function (x) (- 0 x)))) ; CHECK: -6
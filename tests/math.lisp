@@ -16,8 +16,8 @@
 
 ; Use variables in these expressions rather than constants so the
 ; optimizer doesn't remove the operations.
-(assign NEG -7)
-(assign POS 23)
+(defvar NEG -7)
+(defvar POS 23)
 
 ; Builtin operators
 (print (+ POS NEG))             ; CHECK: 16
@@ -53,6 +53,43 @@
 (print (/ a 2)) ; CHECK: 6
 (print (* a 8)) ; CHECK: 96
 (print (* a 16)) ; CHECK: 192
+(assign a -7)
+(print (/ a 4)) ; CHECK: -1
+(print (/ a 2)) ; CHECK: -3
+(print (/ -7 4)) ; CHECK: -1
+(print (/ (+ a 1) 2)) ; CHECK: -3
+(print (/ (- 0 a) 4)) ; CHECK: 1
+;
+; Multiplies and divides by other constants
+;
+(defvar b 1234)
+(defvar c -917)
+(defvar count 0)
+(print (* b 10)) ; CHECK: 12340
+(print (* 10 c)) ; CHECK: -9170
+(print (* b 7)) ; CHECK: 8638
+(print (* c -3)) ; CHECK: 2751
+(print (* b -1)) ; CHECK: -1234
+(print (* b 1)) ; CHECK: 1234
+(print (* b 683)) ; CHECK: -9146
+(print (* c 12345)) ; CHECK: 17363
+(print (* b 0)) ; CHECK: 0
+(print (* (begin (assign count (+ count 1)) b) 10)) ; CHECK: 12340
+(print count) ; CHECK: 1
+(print (/ b 10)) ; CHECK: 123
+(print (mod b 10)) ; CHECK: 4
+(print (/ c 10)) ; CHECK: -91
+(print (mod c 10)) ; CHECK: 7
+(print (/ b -7)) ; CHECK: -176
+(print (mod b -7)) ; CHECK: -2
+(print (/ c -7)) ; CHECK: 131
+(print (mod c -7)) ; CHECK: 0
+(print (/ (* b 20) 3)) ; CHECK: 8226
+(print (mod (* b 20) 3)) ; CHECK: 2
+(print (/ (* b 20) 20000)) ; CHECK: 1
+(print (mod (* b 20) 20000)) ; CHECK: 4680
+(print (/ b 1)) ; CHECK: 1234
+(print (/ c -1)) ; CHECK: 917
 
 ; Conditionals
 (print (if (< 5 7) 12 5))  ; CHECK: 12
@@ -15,19 +15,39 @@
 # limitations under the License.
 #
 
+import argparse
+import concurrent.futures
+import io
 import os
 import subprocess
 import sys
+import tempfile
+import time
 
 TEST_DIR = os.path.normpath(os.path.dirname(os.path.abspath(__file__)))
 PROJECT_ROOT = os.path.join(TEST_DIR, '..')
 
+sys.path.insert(0, PROJECT_ROOT)
+import compile
+import simulator
+
+# Command used to run the Verilog model (from the directory containing
+# program.hex).
+VVP_CMD = ['vvp', os.path.join(PROJECT_ROOT, 'sim.vvp')]
+
+# Ways to execute the compiled program
+ENGINE_VVP = 'vvp'
+ENGINE_PYSIM = 'pysim'
+ENGINE_TRANSLATE = 'translate'
+
 POSITIVE_TESTS = [
     # Basic Compiler/Interpreter tests
     'hello.lisp',
     'scope.lisp',
     'math.lisp',
     'optimizer.lisp',
+    'constants.lisp',
+    'symbols.lisp',
     'conditionals.lisp',
     'list.lisp',
     'closure.lisp',
@@ -42,7 +62,11 @@ POSITIVE_TESTS = [
     'map-reduce.lisp',
     'filter.lisp',
     'gc.lisp',
+    'gc-deep.lisp',
     'oom.lisp',
+    'vector.lisp',
+    'vector-gc.lisp',
+    'gc-stats.lisp',
 
     # Sample programs
     'y-combinator.lisp',
@@ -54,7 +78,16 @@ POSITIVE_TESTS = [
     'dict.lisp'
 ]
 
+# Tests that are always compiled with allocator statistics, since they check
+# the summary the simulator prints.
+GC_STATS_TESTS = ['gc-stats.lisp']
+
 def check_result(output, check_filename):
+    """Compare program output against the CHECK: lines in the source.
+
+    Returns:
+        Tuple of (passed, message)
+    """
     result_offset = 0
     found_check_lines = False
     with open(check_filename, 'r') as infile:
@@ -67,61 +100,165 @@ def check_result(output, check_filename):
                 if got != -1:
                     result_offset = got + len(expected)
                 else:
-                    print('FAIL: line {} expected string {} was not found'
-                        .format(linenum + 1, expected))
-                    print('searching here:' + output[result_offset:])
-                    return False
+                    return False, ('FAIL: line {} expected string {} was not found\n'
+                                   .format(linenum + 1, expected)
+                                   + 'searching here:' + output[result_offset:])
 
     if not found_check_lines:
-        print('FAIL: no lines with CHECK: were found')
-        return False
+        return False, 'FAIL: no lines with CHECK: were found'
 
     if output.find('HALTED', result_offset) == -1:
-        print('simulation did not halt normally')
-        return False
+        return False, 'simulation did not halt normally'
 
-    print('PASS')
+    return True, 'PASS'
 
-    return True
 
+def simulate(program, engine, workdir):
+    """Run a compiled program and return everything it printed."""
+    program.write_files(workdir)
+    if engine == ENGINE_VVP:
+        return subprocess.check_output(VVP_CMD, cwd=workdir).decode()
 
-def runtest(filename):
-    try:
-        # Compile test
-        subprocess.check_call(['python3', os.path.join(PROJECT_ROOT, 'compile.py'), filename])
+    output = io.StringIO()
+    if engine == ENGINE_TRANSLATE:
+        sim = simulator.TranslatingSimulator(
+            program.instructions, output,
+            [function.base_address for function in program.functions],
+            program.data)
+    else:
+        sim = simulator.Simulator(program.instructions, output, program.data)
 
-        # Run test
-        result = subprocess.check_output(['vvp', os.path.join(PROJECT_ROOT, 'sim.vvp')]).decode().strip()
+    sim.run()
+    return output.getvalue()
+
+
+def runtest(filename, engine, workdir='.', inline_cons=False,
+            collector=compile.DEFAULT_COLLECTOR, gc_stats=False):
+    """Compile and run a test program.
+
+    Args:
+        filename (str): path to the test source
+        engine (str): one of the ENGINE_ constants
+        workdir (str): directory where program.hex/lst are written and
+            the simulator is run.
+        inline_cons (bool): compile with inline cons allocation.
+        collector (str): garbage collector to compile with.
+        gc_stats (bool): compile with allocator statistics. Tests in
+            GC_STATS_TESTS always are.
+
+    Returns:
+        Tuple of (passed, message)
+    """
+    gc_stats = gc_stats or os.path.basename(filename) in GC_STATS_TESTS
+    try:
+        program = compile.compile_program([filename], inline_cons=inline_cons,
+                                          collector=collector,
+                                          gc_stats=gc_stats)
+        result = simulate(program, engine, workdir).strip()
         if result:
-            check_result(result, filename)
+            return check_result(result, filename)
         else:
-            print('FAIL: no output')
+            return False, 'FAIL: no output'
     except KeyboardInterrupt:
         raise
-    except:
-        print('FAIL: exception thrown')
-        raise
+    except Exception as exc:
+        return False, 'FAIL: exception thrown\n' + str(exc)
+
+
+def run_isolated_test(filename, engine, inline_cons, collector, gc_stats):
+    """Run a test in its own temporary directory.
+
+    This allows multiple tests to run concurrently, since each has its
+    own copy of program.hex.
+
+    Returns:
+        Tuple of (passed, message, elapsed seconds)
+    """
+    start_time = time.time()
+    with tempfile.TemporaryDirectory(prefix='lisptest') as workdir:
+        passed, message = runtest(filename, engine, workdir, inline_cons,
+                                  collector, gc_stats)
+
+    return passed, message, time.time() - start_time
 
 
 def run_compile_error_test(filename, errorstr):
     result = subprocess.run(['python3', os.path.join(PROJECT_ROOT, 'compile.py'), filename],
         capture_output=True)
     if result.returncode != 1:
-        print('FAIL: bad return call')
+        return False, 'FAIL: bad return call'
 
     if errorstr not in str(result.stdout, 'utf-8'):
-        print('FAIL: error message not found')
+        return False, 'FAIL: error message not found'
+
+    return True, 'PASS'
 
-    print('PASS')
 
+def run_all_tests(engine, num_jobs, inline_cons, collector, gc_stats):
+    """Run every test, with up to num_jobs running at once.
 
-if len(sys.argv) > 1:
-    runtest(os.path.join(TEST_DIR, sys.argv[1]))
-else:
-    for filename in POSITIVE_TESTS:
-        print(filename, end=' ')
-        sys.stdout.flush()
-        runtest(os.path.join(TEST_DIR, filename))
+    Results are printed in the order of POSITIVE_TESTS, regardless of the
+    order in which they finish.
+
+    Returns:
+        True if all tests passed.
+    """
+    all_passed = True
+    filenames = [os.path.join(TEST_DIR, filename) for filename in POSITIVE_TESTS]
+    with concurrent.futures.ProcessPoolExecutor(num_jobs) as executor:
+        results = executor.map(run_isolated_test, filenames,
+                               [engine] * len(filenames),
+                               [inline_cons] * len(filenames),
+                               [collector] * len(filenames),
+                               [gc_stats] * len(filenames))
+        for filename, (passed, message, elapsed) in zip(POSITIVE_TESTS, results):
+            print('{} {} ({:.2f}s)'.format(filename, message, elapsed))
+            sys.stdout.flush()
+            all_passed = all_passed and passed
 
     print('compile-fail.lisp', end=' ')
-    run_compile_error_test(os.path.join(TEST_DIR, 'compile-fail.lisp'), 'Compile error: missing )')
+    passed, message = run_compile_error_test(
+        os.path.join(TEST_DIR, 'compile-fail.lisp'), 'Compile error: missing )')
+    print(message)
+    return all_passed and passed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('test', nargs='?', help='run only this test')
+    parser.add_argument('--pysim', action='store_true',
+                        help='use the python simulator instead of vvp')
+    parser.add_argument('--translate', action='store_true',
+                        help='use the python simulator with block translation')
+    parser.add_argument('-j', '--jobs', type=int, nargs='?', default=1,
+                        const=os.cpu_count(),
+                        help='number of tests to run in parallel '
+                        '(default 1, or number of CPUs if no value given)')
+    parser.add_argument('--inline-cons', action='store_true',
+                        help='compile tests with inline cons allocation')
+    parser.add_argument('--gc', choices=sorted(compile.COLLECTORS),
+                        default=compile.DEFAULT_COLLECTOR,
+                        help='garbage collector to compile tests with')
+    parser.add_argument('--gc-stats', action='store_true',
+                        help='compile tests with allocator statistics')
+    args = parser.parse_args()
+    engine = ENGINE_VVP
+    if args.pysim:
+        engine = ENGINE_PYSIM
+    elif args.translate:
+        engine = ENGINE_TRANSLATE
+
+    if args.test:
+        # Run in the current directory, so program.lst is available afterward
+        passed, message = runtest(os.path.join(TEST_DIR, args.test), engine,
+                                  inline_cons=args.inline_cons,
+                                  collector=args.gc,
+                                  gc_stats=args.gc_stats)
+        print(message)
+    else:
+        start_time = time.time()
+        passed = run_all_tests(engine, args.jobs, args.inline_cons, args.gc,
+                               args.gc_stats)
+        print('total time {:.2f}s'.format(time.time() - start_time))
+
+    sys.exit(0 if passed else 1)
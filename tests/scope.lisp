@@ -66,3 +66,28 @@
 (print foo) ; CHECK: 13
 (bar)   ; CHECK: bar
 
+
+; Variables in sibling scopes share stack slots. Make sure values that are
+; still live aren't overwritten.
+(function sibling-scopes (a)
+    (let ((outer (+ a 1)))
+        (let ((x 67) (y 71))
+            (print (+ x y)))     ; CHECK: 138
+        (let ((z 73))
+            (print z)            ; CHECK: 73
+            (print outer))       ; CHECK: 2
+        (print outer)))          ; CHECK: 2
+
+(sibling-scopes 1)
+
+; A free variable is copied into the closure's frame when it is called, so
+; it must not share a slot with earlier variables in the closure.
+(function make-closure-with-lets (captured)
+    (function ()
+        (let ((p 79) (q 83))
+            (print (+ p q)))     ; CHECK: 162
+        (let ((r 89))
+            (print r)            ; CHECK: 89
+            (print captured))))  ; CHECK: 97
+
+((make-closure-with-lets 97))
@@ -0,0 +1,47 @@
+;
+; Copyright 2011-2013 Jeff Bush
+;
+; Licensed under the Apache License, Version 2.0 (the "License");
+; you may not use this file except in compliance with the License.
+; You may obtain a copy of the License at
+;
+;     http://www.apache.org/licenses/LICENSE-2.0
+;
+; Unless required by applicable law or agreed to in writing, software
+; distributed under the License is distributed on an "AS IS" BASIS,
+; WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+; See the License for the specific language governing permissions and
+; limitations under the License.
+;
+
+; Quoted symbols are interned into unique integers, so they can be compared
+; with =.
+(defvar fruit 'apple)
+
+(print (= fruit 'apple))   ; CHECK: 1
+(print (= fruit 'banana))  ; CHECK: 0
+(print (<> 'apple 'banana)) ; CHECK: 1
+(print (if 'apple 1 0))     ; CHECK: 1
+
+; Symbols in quoted lists are the same values
+(assign fruits '(apple banana cherry))
+(print (= (first fruits) fruit)) ; CHECK: 1
+(print (= (cadr fruits) 'banana)) ; CHECK: 1
+(print (equal fruits (list 'apple 'banana 'cherry))) ; CHECK: 1
+
+(function lookup (key alist)
+    (if alist
+        (if (= (first (first alist)) key)
+            (rest (first alist))
+            (lookup key (rest alist)))
+        nil))
+
+(assign table '((red . 3) (green . 5) (blue . 7)))
+(print (lookup 'green table)) ; CHECK: 5
+(print (lookup 'blue table)) ; CHECK: 7
+(print (lookup 'purple table)) ; CHECK: 0
+
+; nil, true, and false are values, not symbols. Strings inside a quoted list
+; are lists of characters.
+(print '(nil true false)) ; CHECK: (0 1 0)
+(print '("AB" 3)) ; CHECK: ((65 66) 3)
@@ -22,3 +22,46 @@
         sum))
 
 ($printdec (tail-recurse 2000)) ; CHECK: 6000
+
+; Tail calls to other functions also reuse the stack frame. Each of these
+; recurses deeply enough that it would run out of stack otherwise.
+(function is-even (n)
+    (if n (is-odd (- n 1)) 1))
+
+(function is-odd (n)
+    (if n (is-even (- n 1)) 0))
+
+(print (is-even 3001)) ; CHECK: 0
+(print (is-odd 3001)) ; CHECK: 1
+
+; The called function can have fewer parameters than the caller
+(function count-down (n extra)
+    (if n (count-down-helper (- n 1)) extra))
+
+(function count-down-helper (n)
+    (count-down n 77))
+
+(print (count-down 100 5)) ; CHECK: 77
+
+; Calls through variables that contain functions and closures
+(assign step (function (n total)
+    (if n (step (- n 1) (+ total 2)) total)))
+
+(print (step 2500 0)) ; CHECK: 5000
+
+(assign bounce nil)
+
+(function bounce-back (n total)
+    (if n (bounce (- n 1) total) total))
+
+(function make-bouncer (increment)
+    (function (n total) (bounce-back n (+ total increment))))
+
+(assign bounce (make-bouncer 3))
+(print (bounce 2500 0)) ; CHECK: 7503
+
+; Calls to a function passed as a parameter, which the arguments overwrite
+(function walk (f n)
+    (if (= n 0) 0 (f f (- n 1))))
+
+(print (walk walk 4000)) ; CHECK: 0
@@ -0,0 +1,53 @@
+;
+; Copyright 2011-2016 Jeff Bush
+;
+; Licensed under the Apache License, Version 2.0 (the "License");
+; you may not use this file except in compliance with the License.
+; You may obtain a copy of the License at
+;
+;     http://www.apache.org/licenses/LICENSE-2.0
+;
+; Unless required by applicable law or agreed to in writing, software
+; distributed under the License is distributed on an "AS IS" BASIS,
+; WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+; See the License for the specific language governing permissions and
+; limitations under the License.
+;
+
+; Values that the garbage collectors must not mistake for vectors.
+
+; A function value read back from a cell allocated after a collection must
+; not look like a vector header, or the sweep would free the cells after it.
+; This is done after two collections in a row, in case the collector
+; alternates between two states.
+(assign f (function (x) (+ x 1)))
+(assign q nil)
+(for round 1 2 1
+    (let ((p nil))
+        ($gc)
+        (assign p (cons 1 f))
+        (assign q (cons (rest p) q))
+        (cons (rest p) nil)))
+(assign keep (list 1 2 3 4 5 6 7 8 9 10 11 12))
+(for i 1 1500 1
+    (cons i i))
+(print keep)    ; CHECK: (1 2 3 4 5 6 7 8 9 10 11 12)
+(print (vector? q))     ; CHECK: 0
+(print ((first q) 1))   ; CHECK: 2
+(print ((nth q 1) 2))   ; CHECK: 3
+
+; first and rest of a vector are its elements, so they can't be used to copy
+; its header into a cell, where the collectors would take it for a vector.
+(assign h (first (make-vector 40)))
+(print h)   ; CHECK: 0
+(assign vec #(5 6 7))
+(print (first vec))     ; CHECK: 5
+(print (rest vec))      ; CHECK: 6
+(assign l nil)
+(for i 1 31 1
+    (assign l (cons (first vec) l)))
+($gc)
+(for i 1 200 1
+    (cons i i))
+(print (length l))      ; CHECK: 31
+(print (reduce l (function (a b) (+ a b))))  ; CHECK: 155
@@ -0,0 +1,78 @@
+;
+; Copyright 2011-2016 Jeff Bush
+;
+; Licensed under the Apache License, Version 2.0 (the "License");
+; you may not use this file except in compliance with the License.
+; You may obtain a copy of the License at
+;
+;     http://www.apache.org/licenses/LICENSE-2.0
+;
+; Unless required by applicable law or agreed to in writing, software
+; distributed under the License is distributed on an "AS IS" BASIS,
+; WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+; See the License for the specific language governing permissions and
+; limitations under the License.
+;
+
+(assign v (make-vector 5))
+(print v)   ; CHECK: #(0 0 0 0 0)
+(for i 0 4 1
+    (vector-set! v i (* i i)))
+(print v)   ; CHECK: #(0 1 4 9 16)
+(print (vector-length v))   ; CHECK: 5
+(print (vector-ref v 3))    ; CHECK: 9
+(print (make-vector 0))     ; CHECK: #()
+
+(print (vector? v))         ; CHECK: 1
+(print (vector? '(1 2)))    ; CHECK: 0
+(print (vector? 7))         ; CHECK: 0
+(print (list? v))           ; CHECK: 0
+(print (length v))          ; CHECK: 5
+(print (equal #(1 2) #(1 2)))           ; CHECK: 1
+(print (equal #(1 2) #(1 3)))           ; CHECK: 0
+(print (equal #(1 2) #(1 2 3)))         ; CHECK: 0
+(print (equal (make-vector 2) #(7 7)))  ; CHECK: 0
+(print (equal #((1 2) #(3)) #((1 2) #(3))))   ; CHECK: 1
+(print (equal #(1 2) '(1 2)))           ; CHECK: 0
+(print (equal '(1 2) #(1 2)))           ; CHECK: 0
+
+; Literals. Elements aren't evaluated, and can be lists or other vectors.
+(print #(1 (2 3) #(4 5) -6))    ; CHECK: #(1 (2 3) #(4 5) -6)
+(print '(7 #(8 9)))             ; CHECK: (7 #(8 9))
+(print (= 'foo (vector-ref #(foo) 0)))  ; CHECK: 1
+
+; A literal can be modified to point to the heap, like a quoted list.
+(assign w #(0 0))
+(vector-set! w 1 (list 10 11))
+
+; Unlike quoted lists, identical vector literals are separate.
+(assign w2 #(0 0))
+(print w2)  ; CHECK: #(0 0)
+
+; Fill the heap with vectors and lists, keeping some of them, so they are
+; garbage collected several times. Each kept vector holds a list and a
+; vector, which must survive too.
+(function check-vectors (count)
+    (let ((kept nil) (ok 1))
+        (for n 1 count 1
+            (let ((vec (make-vector (bitwise-and n 7))) (l (list n n n)))
+                (for i 0 (- (vector-length vec) 1) 1
+                    (vector-set! vec i (+ n i)))
+                (when (= (bitwise-and n 15) 0)
+                    (let ((outer (make-vector 2)))
+                        (vector-set! outer 0 vec)
+                        (vector-set! outer 1 l)
+                        (assign kept (cons outer kept))))))
+        (foreach outer kept
+            (let ((vec (vector-ref outer 0)) (l (vector-ref outer 1)))
+                (for i 0 (- (vector-length vec) 1) 1
+                    (unless (= (vector-ref vec i) (+ (first l) i))
+                        (assign ok 0)))
+                (unless (equal l (list (first l) (first l) (first l)))
+                    (assign ok 0))))
+        (print (length kept))
+        (print ok)))
+
+(check-vectors 400) ; CHECK: 25
+; CHECK: 1
+(print w)   ; CHECK: #(0 (10 11))